@@ -1,6 +1,131 @@
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.util import register_after_fork
+
 from adsputils import ADSCelery
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# Connection pool counters for this worker process
+_pool_stats = {"checkouts": 0, "connects": 0, "waits": 0, "wait_seconds": 0.0, "max_wait": 0.0}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits for a connection."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            wait = time.perf_counter() - t0
+            _pool_stats["waits"] += 1
+            _pool_stats["wait_seconds"] += wait
+            _pool_stats["max_wait"] = max(_pool_stats["max_wait"], wait)
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    _pool_stats["checkouts"] += 1
+
+
+def _count_connect(dbapi_connection, connection_record):
+    _pool_stats["connects"] += 1
 
 
 class ADSCompStatCelery(ADSCelery):
     def __init__(self, app_name, *args, **kwargs):
         ADSCelery.__init__(self, app_name, *args, **kwargs)
+        self._task_session = threading.local()
+        url = self._config.get("SQLALCHEMY_URL", None)
+        if self._engine is not None and url and not url.startswith("sqlite"):
+            self._configure_pool(url)
+
+    def _configure_pool(self, url):
+        """
+        Replaces ADSCelery's engine with one whose connection pool is sized
+        and checked as set in the config, and whose checkouts are counted.
+        """
+        connect_args = {}
+        timeout = self._config.get("SQLALCHEMY_STATEMENT_TIMEOUT", None)
+        if timeout and url.startswith("postgres"):
+            connect_args["options"] = "-c statement_timeout=%d" % timeout
+        engine = create_engine(
+            url,
+            echo=self._config.get("SQLALCHEMY_ECHO", False),
+            poolclass=TimedQueuePool,
+            pool_size=self._config.get("SQLALCHEMY_POOL_SIZE", 5),
+            max_overflow=self._config.get("SQLALCHEMY_MAX_OVERFLOW", 10),
+            pool_timeout=self._config.get("SQLALCHEMY_POOL_TIMEOUT", 30),
+            pool_pre_ping=self._config.get("SQLALCHEMY_POOL_PRE_PING", True),
+            connect_args=connect_args,
+        )
+        event.listen(engine, "checkout", _count_checkout)
+        event.listen(engine, "connect", _count_connect)
+        self._engine.dispose()
+        self._engine = engine
+        self._session.configure(bind=self._engine)
+        register_after_fork(self._engine, self._engine.dispose)
+
+    @contextmanager
+    def session_scope(self):
+        """
+        As ADSCelery.session_scope, except that inside task_session() the
+        task's session is reused rather than closed after each use, so the
+        task's queries all go through one pooled connection.
+        """
+        session = getattr(self._task_session, "session", None)
+        if session is None:
+            with ADSCelery.session_scope(self) as session:
+                yield session
+        else:
+            try:
+                yield session
+            except Exception:
+                session.rollback()
+                raise
+
+    @contextmanager
+    def task_session(self):
+        """
+        Shares one session (and connection) between all the session_scope()
+        calls made inside it, committing and closing it at the end.  Nested
+        task_session() calls reuse the outermost one.
+        """
+        if getattr(self._task_session, "session", None) is not None:
+            yield self._task_session.session
+            return
+        if self._engine is None:
+            # nothing to share; session_scope() will raise as usual
+            yield None
+            return
+        # bound to one connection, so that it isn't returned to the pool
+        # when the session commits
+        connection = self._engine.connect()
+        session = self._session_factory(bind=connection)
+        self._task_session.session = session
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            self._task_session.session = None
+            session.close()
+            connection.close()
+
+    def pool_stats(self):
+        """
+        Returns this process's connection checkouts, new connections, and
+        time spent waiting for a connection, with the pool's current size,
+        connections checked out and overflow.
+        """
+        stats = dict(_pool_stats)
+        stats["avg_wait"] = stats["wait_seconds"] / stats["waits"] if stats["waits"] else 0.0
+        pool = getattr(self._engine, "pool", None)
+        if isinstance(pool, QueuePool):
+            stats["size"] = pool.size()
+            stats["checked_out"] = pool.checkedout()
+            stats["overflow"] = pool.overflow()
+        return stats
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from adsputils import load_config, setup_logging
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+
+# The fields of an ingest record that BibcodeGenerator's make_bibstem and
+# make_bibcode read: the year can come from pubDate as well as publication,
+# and the page from persistentIDs (e.g. a DOI-based article id).
+MEMO_FIELDS = ["publication", "pubDate", "pagination", "persistentIDs"]
+
+
+def memo_key(record):
+    """
+    The hash of the fields of an ingest record that its bibstem and bibcode
+    are made from: those in MEMO_FIELDS and the first author.
+    """
+    authors = record.get("authors", None) or [{}]
+    fields = dict([(k, record.get(k, None)) for k in MEMO_FIELDS])
+    fields["first_author"] = authors[0]
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
+
+
+class BibcodeMemo(object):
+    """
+    The (bibstem, bibcode) made for each set of bibliographic fields seen,
+    up to maxsize of them, evicting the least recently used.  Everything is
+    dropped when the stamp of the ISSN-bibstem map changes (see validate).
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self.stamp = None
+        self.cleared = time.time()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the (bibstem, bibcode) memoized for key, or None."""
+        value = self._entries.get(key, None)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, bibstem, bibcode):
+        self._entries[key] = (bibstem, bibcode)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.cleared = time.time()
+
+    def validate(self, stamp, max_age=None):
+        """
+        Clears the memo if the ISSN-bibstem map's stamp has changed since
+        the last call, or if it was last cleared over max_age seconds ago.
+        """
+        if stamp != self.stamp:
+            if self._entries:
+                logger.info("ISSN-bibstem map changed, clearing %s memoized bibcodes" % len(self))
+            self.stamp = stamp
+            self.clear()
+        elif max_age and time.time() - self.cleared > max_age:
+            self.clear()
+
+
+def issn_map_stamp(issn_file):
+    """
+    The (mtime, size) of the ISSN-bibstem file loaded into issn_bibstem, or
+    None if it isn't available to this process.
+    """
+    if not issn_file:
+        return None
+    try:
+        stat = os.stat(issn_file)
+    except Exception as err:
+        logger.debug("Unable to stat ISSN-bibstem file %s: %s" % (issn_file, err))
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+_memo_cache = {"memo": None}
+
+
+def get_bibcode_memo(maxsize, issn_file=None, max_age=None):
+    """
+    Returns this process's BibcodeMemo, cleared if the ISSN-bibstem file
+    issn_file has changed or max_age seconds have passed since it was last
+    cleared.
+    """
+    memo = _memo_cache["memo"]
+    if memo is None:
+        memo = _memo_cache["memo"] = BibcodeMemo(maxsize)
+    memo.maxsize = maxsize
+    memo.validate(issn_map_stamp(issn_file), max_age=max_age)
+    return memo
@@ -0,0 +1,185 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+from adsputils import load_config, setup_logging
+
+from adscompstat.exceptions import BloomFilterException
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+# Bloom filter over every classic DOI (in identifier_doi) and bibcode (in
+# alt_identifiers), written by run.py -c so that workers can skip the
+# classic lookups of DOIs and bibcodes that are certainly not in classic.
+# File layout: header, then the filter's bit array (nbits / 8 bytes).
+MAGIC = b"ADSBLOOM"
+VERSION = 1
+HEADER = struct.Struct("<8sHHQQ")
+
+# Keys are prefixed so a DOI can't match a bibcode of the same spelling
+DOI_PREFIX = "d:"
+BIBCODE_PREFIX = "b:"
+
+
+def _positions(key, nhashes, nbits):
+    # double hashing (Kirsch-Mitzenmacher) from one 128-bit blake2b digest
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[0:8], "little")
+    h2 = int.from_bytes(digest[8:16], "little") | 1
+    return [(h1 + i * h2) % nbits for i in range(nhashes)]
+
+
+def filter_size(nitems, error_rate):
+    """
+    Returns the (number of bits, number of hashes) of a Bloom filter holding
+    nitems keys with the given false positive rate.
+    """
+    nitems = max(nitems, 1)
+    nbits = int(math.ceil(-nitems * math.log(error_rate) / (math.log(2) ** 2)))
+    nbits = max(8, (nbits + 7) // 8 * 8)
+    nhashes = max(1, int(round(nbits / nitems * math.log(2))))
+    return nbits, nhashes
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of DOI and bibcode keys: `in` is always True for a key that
+    was added, and False for most keys that weren't.
+    """
+
+    def __init__(self, nbits, nhashes, bits=None, nitems=0):
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.nitems = nitems
+        self.bits = bits if bits is not None else bytearray(nbits // 8)
+
+    @classmethod
+    def for_capacity(cls, nitems, error_rate=0.01):
+        (nbits, nhashes) = filter_size(nitems, error_rate)
+        return cls(nbits, nhashes)
+
+    def add(self, key):
+        for pos in _positions(key, self.nhashes, self.nbits):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.nitems += 1
+
+    def __contains__(self, key):
+        for pos in _positions(key, self.nhashes, self.nbits):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def may_contain_doi(self, doi):
+        return DOI_PREFIX + doi in self
+
+    def may_contain_bibcode(self, bibcode):
+        return BIBCODE_PREFIX + bibcode in self
+
+    def false_positive_rate(self):
+        """The expected false positive rate for the keys added so far."""
+        if not self.nitems:
+            return 0.0
+        return (1.0 - math.exp(-self.nhashes * self.nitems / float(self.nbits))) ** self.nhashes
+
+
+def write_bloom_filter(filename, doi_records, alt_records, error_rate=0.01):
+    """
+    Writes a Bloom filter of the DOIs of doi_records (as returned by
+    utils.load_classic_doi_bib_map) and the identifiers of alt_records (as
+    returned by utils.merge_bibcode_lists) to filename, replacing it
+    atomically.  If it can't be written the old file is removed, so that
+    workers don't skip lookups of identifiers added since it was built.
+    Returns the filter.
+    """
+    try:
+        bloom = BloomFilter.for_capacity(len(doi_records) + len(alt_records), error_rate)
+        for rec in doi_records:
+            bloom.add(DOI_PREFIX + rec["doi"])
+        for rec in alt_records:
+            bloom.add(BIBCODE_PREFIX + rec["identifier"])
+        dirname = os.path.dirname(os.path.abspath(filename))
+        (fd, tmpfile) = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as fb:
+                fb.write(HEADER.pack(MAGIC, VERSION, bloom.nhashes, bloom.nbits, bloom.nitems))
+                fb.write(bloom.bits)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, filename)
+        except Exception:
+            os.unlink(tmpfile)
+            raise
+        return bloom
+    except Exception as err:
+        remove_bloom_filter(filename)
+        raise BloomFilterException("Unable to write bloom filter %s: %s" % (filename, err))
+
+
+def remove_bloom_filter(filename):
+    """
+    Removes the bloom filter file, if there is one, so that workers make
+    every classic lookup until a new one is written.
+    """
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+    except Exception as err:
+        logger.error("Unable to remove bloom filter %s: %s" % (filename, err))
+
+
+def read_bloom_filter(filename):
+    """Memory-maps a bloom filter file written by write_bloom_filter."""
+    try:
+        with open(filename, "rb") as fb:
+            stat = os.fstat(fb.fileno())
+            mm = mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, nhashes, nbits, nitems) = HEADER.unpack_from(mm, 0)
+    except Exception as err:
+        raise BloomFilterException("Unable to open bloom filter %s: %s" % (filename, err))
+    if magic != MAGIC or version != VERSION or len(mm) != HEADER.size + nbits // 8:
+        mm.close()
+        raise BloomFilterException("%s is not a version %s bloom filter" % (filename, VERSION))
+    # the view keeps the mapping open for as long as the filter is in use
+    bloom = BloomFilter(nbits, nhashes, bits=memoryview(mm)[HEADER.size :], nitems=nitems)
+    bloom.filename = filename
+    bloom.fileid = (stat.st_ino, stat.st_mtime)
+    return bloom
+
+
+_bloom_cache = {"bloom": None}
+
+
+def get_bloom_filter(filename):
+    """
+    Returns the bloom filter in filename, shared by all callers in this
+    process and reopened if the file has been replaced since it was read.
+    Returns None if the file is not available.
+    """
+    bloom = _bloom_cache["bloom"]
+    try:
+        stat = os.stat(filename)
+    except Exception as err:
+        logger.debug("Bloom filter %s not available: %s" % (filename, err))
+        return None
+    if bloom is None or bloom.filename != filename or bloom.fileid != (stat.st_ino, stat.st_mtime):
+        try:
+            bloom = read_bloom_filter(filename)
+        except Exception as err:
+            logger.warning("Unable to load bloom filter: %s" % err)
+            return None
+        logger.info(
+            "Loaded bloom filter %s: %s keys, %s bits, expected false positive rate %.4f"
+            % (filename, bloom.nitems, bloom.nbits, bloom.false_positive_rate())
+        )
+        _bloom_cache["bloom"] = bloom
+    return bloom
@@ -0,0 +1,298 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from adsputils import load_config, setup_logging
+
+from adscompstat.exceptions import ClassicStoreException
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+# Read-only snapshot of the classic identifier_doi and alt_identifiers data,
+# laid out so that it can be memory-mapped and searched in place by every
+# worker process on a host:
+#
+#   header
+#   records:   (identifier, canonical_id, idtype) rows sorted by identifier,
+#              with bibcodes NUL-padded to BIBCODE_WIDTH bytes
+#   canonical: uint32 record numbers, sorted by the records' canonical_id
+#   dois:      (64-bit DOI hash, first position in canonical, count) entries
+#              sorted by hash, pointing to the alt_identifiers rows whose
+#              canonical_id is the DOI's bibcode
+MAGIC = b"ADSCSTOR"
+VERSION = 1
+BIBCODE_WIDTH = 19
+IDTYPES = ["canonical", "alternate", "deleted", "other", "noindex"]
+
+HEADER = struct.Struct("<8sHHIIQQQ")
+RECORD = struct.Struct("<%ds%dsB" % (BIBCODE_WIDTH, BIBCODE_WIDTH))
+CANONICAL = struct.Struct("<I")
+DOI_ENTRY = struct.Struct("<QII")
+
+
+def doi_hash(doi):
+    return int.from_bytes(hashlib.blake2b(doi.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _pad_bibcode(bibcode):
+    key = bibcode.encode("utf-8")
+    if len(key) > BIBCODE_WIDTH:
+        return None
+    return key.ljust(BIBCODE_WIDTH, b"\0")
+
+
+def write_classic_store(filename, doi_records, alt_records):
+    """
+    Writes the classic DOI-bibcode map (as returned by
+    utils.load_classic_doi_bib_map) and bibcode lists (as returned by
+    utils.merge_bibcode_lists) to a classic store file.  The file is written
+    under a temporary name and then renamed, so workers that have the old
+    file mapped keep using it until they reopen.  If it can't be written
+    the old file is removed, so that workers go back to querying the
+    database.  Returns the number of (alt_identifiers, DOI) entries written.
+    """
+    try:
+        records = []
+        skipped = 0
+        for rec in alt_records:
+            identifier = _pad_bibcode(rec["identifier"])
+            canonical = _pad_bibcode(rec["canonical_id"])
+            if identifier is None or canonical is None or rec["idtype"] not in IDTYPES:
+                skipped += 1
+                continue
+            records.append((identifier, canonical, IDTYPES.index(rec["idtype"])))
+        if skipped:
+            logger.warning("%s bibcodes could not be added to the classic store" % skipped)
+        records.sort()
+
+        canonical_order = sorted(range(len(records)), key=lambda i: records[i][1])
+        # first position and count in canonical_order of each canonical_id
+        canonical_spans = {}
+        for pos, i in enumerate(canonical_order):
+            canonical = records[i][1]
+            if canonical in canonical_spans:
+                canonical_spans[canonical][1] += 1
+            else:
+                canonical_spans[canonical] = [pos, 1]
+
+        doi_entries = []
+        doi_hashes = {}
+        for rec in doi_records:
+            h = doi_hash(rec["doi"])
+            if h in doi_hashes:
+                if doi_hashes[h] != rec["doi"]:
+                    raise ClassicStoreException(
+                        "DOIs %s and %s have the same hash" % (doi_hashes[h], rec["doi"])
+                    )
+                # identifier_doi's dois are unique, and only the first bibcode
+                # of each DOI is loaded into it (see load_classic_doi_bib_map)
+                logger.debug("Duplicate DOI %s, keeping its first bibcode" % rec["doi"])
+                continue
+            doi_hashes[h] = rec["doi"]
+            key = _pad_bibcode(rec["identifier"])
+            span = canonical_spans.get(key, None) if key else None
+            if span:
+                doi_entries.append((h, span[0], span[1]))
+        doi_entries.sort()
+
+        off_records = HEADER.size
+        off_canonical = off_records + RECORD.size * len(records)
+        off_dois = off_canonical + CANONICAL.size * len(records)
+        dirname = os.path.dirname(os.path.abspath(filename))
+        (fd, tmpfile) = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as fs:
+                fs.write(
+                    HEADER.pack(
+                        MAGIC,
+                        VERSION,
+                        BIBCODE_WIDTH,
+                        len(records),
+                        len(doi_entries),
+                        off_records,
+                        off_canonical,
+                        off_dois,
+                    )
+                )
+                for rec in records:
+                    fs.write(RECORD.pack(*rec))
+                for i in canonical_order:
+                    fs.write(CANONICAL.pack(i))
+                for entry in doi_entries:
+                    fs.write(DOI_ENTRY.pack(*entry))
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, filename)
+        except Exception:
+            os.unlink(tmpfile)
+            raise
+        return len(records), len(doi_entries)
+    except Exception as err:
+        remove_classic_store(filename)
+        raise ClassicStoreException("Unable to write classic store %s: %s" % (filename, err))
+
+
+def remove_classic_store(filename):
+    """
+    Removes the classic store file, if there is one, so that workers query
+    the database until a new one is written.
+    """
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+    except Exception as err:
+        logger.error("Unable to remove classic store %s: %s" % (filename, err))
+
+
+class ClassicStore(object):
+    """
+    Read-only, memory-mapped view of a classic store file, answering the
+    same lookups as database.query_classic_bibcodes.
+    """
+
+    def __init__(self, filename):
+        try:
+            self.filename = filename
+            with open(filename, "rb") as fs:
+                stat = os.fstat(fs.fileno())
+                self.fileid = (stat.st_ino, stat.st_mtime)
+                self._mm = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+            (
+                magic,
+                version,
+                width,
+                self.nrecords,
+                self.ndois,
+                self._off_records,
+                self._off_canonical,
+                self._off_dois,
+            ) = HEADER.unpack_from(self._mm, 0)
+        except Exception as err:
+            raise ClassicStoreException("Unable to open classic store %s: %s" % (filename, err))
+        if magic != MAGIC or version != VERSION or width != BIBCODE_WIDTH:
+            self.close()
+            raise ClassicStoreException(
+                "%s is not a version %s classic store" % (filename, VERSION)
+            )
+
+    def close(self):
+        self._mm.close()
+
+    def _identifier_key(self, i):
+        offset = self._off_records + i * RECORD.size
+        return self._mm[offset : offset + BIBCODE_WIDTH]
+
+    def _canonical_record(self, pos):
+        return CANONICAL.unpack_from(self._mm, self._off_canonical + pos * CANONICAL.size)[0]
+
+    def _record(self, i):
+        (identifier, canonical, idtype) = RECORD.unpack_from(
+            self._mm, self._off_records + i * RECORD.size
+        )
+        return (
+            identifier.rstrip(b"\0").decode("utf-8"),
+            canonical.rstrip(b"\0").decode("utf-8"),
+            IDTYPES[idtype],
+        )
+
+    def _first_record(self, key):
+        # position of the first record whose identifier is >= key
+        lo = 0
+        hi = self.nrecords
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._identifier_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup_bibcode(self, bibcode):
+        """Returns the (identifier, canonical_id, idtype) rows for bibcode."""
+        key = _pad_bibcode(bibcode) if bibcode else None
+        if not key:
+            return []
+        i = self._first_record(key)
+        rows = []
+        while i < self.nrecords and self._identifier_key(i) == key:
+            rows.append(self._record(i))
+            i += 1
+        return rows
+
+    def lookup_prefixes(self, prefixes):
+        """
+        Returns the (identifier, canonical_id, idtype) rows whose identifiers
+        start with any of prefixes.
+        """
+        rows = []
+        for prefix in prefixes:
+            key = prefix.encode("utf-8")
+            i = self._first_record(key)
+            while i < self.nrecords and self._identifier_key(i).startswith(key):
+                rows.append(self._record(i))
+                i += 1
+        return rows
+
+    def lookup_doi(self, doi):
+        """
+        Returns the (identifier, canonical_id, idtype) rows whose canonical_id
+        is the classic bibcode of doi.
+        """
+        if not doi:
+            return []
+        h = doi_hash(doi)
+        lo = 0
+        hi = self.ndois
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if DOI_ENTRY.unpack_from(self._mm, self._off_dois + mid * DOI_ENTRY.size)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.ndois:
+            return []
+        (entry_hash, start, count) = DOI_ENTRY.unpack_from(
+            self._mm, self._off_dois + lo * DOI_ENTRY.size
+        )
+        if entry_hash != h:
+            return []
+        return [self._record(self._canonical_record(pos)) for pos in range(start, start + count)]
+
+    def query_classic_bibcodes(self, doi, bibcode):
+        return self.lookup_doi(doi), self.lookup_bibcode(bibcode)
+
+
+_store_cache = {"store": None}
+
+
+def get_classic_store(filename):
+    """
+    Returns a ClassicStore for filename that is shared by all callers in this
+    process, reopening it if the file has been replaced since it was opened.
+    Returns None if the file is not available.
+    """
+    store = _store_cache["store"]
+    try:
+        stat = os.stat(filename)
+    except Exception as err:
+        logger.debug("Classic store %s not available: %s" % (filename, err))
+        return None
+    if store is None or store.filename != filename or store.fileid != (stat.st_ino, stat.st_mtime):
+        try:
+            new_store = ClassicStore(filename)
+        except Exception as err:
+            logger.warning("Unable to open classic store: %s" % err)
+            return None
+        if store is not None:
+            store.close()
+        _store_cache["store"] = store = new_store
+    return store
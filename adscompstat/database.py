@@ -1,12 +1,17 @@
+import hashlib
+import json
 import os
 
-from adsputils import load_config, setup_logging
-from sqlalchemy import func
+from adsputils import get_date, load_config, setup_logging
+from sqlalchemy import bindparam, case, func, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from adscompstat.models import CompStatAltIdents as alt_identifiers
 from adscompstat.models import CompStatIdentDoi as identifier_doi
 from adscompstat.models import CompStatIssnBibstem as issn_bibstem
 from adscompstat.models import CompStatMaster as master
+from adscompstat.models import CompStatRunStatus as run_status
 from adscompstat.models import CompStatSummary as summary
 
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
@@ -39,6 +44,27 @@ class BibstemLookupException(Exception):
     pass
 
 
+# The fixed-shape lookups made for every record are built once here, so each
+# call only binds its parameters and reuses the statement's compiled form
+# from the engine's compiled cache instead of rebuilding and recompiling it.
+CLASSIC_COLUMNS = (
+    alt_identifiers.identifier,
+    alt_identifiers.canonical_id,
+    alt_identifiers.idtype,
+)
+BIBSTEM_BY_ISSN = (
+    select(issn_bibstem.bibstem).where(issn_bibstem.issn == bindparam("issn")).limit(1)
+)
+CLASSIC_BY_DOI = (
+    select(*CLASSIC_COLUMNS)
+    .join(identifier_doi, alt_identifiers.canonical_id == identifier_doi.identifier)
+    .where(identifier_doi.doi == bindparam("doi"))
+)
+CLASSIC_BY_BIBCODE = select(*CLASSIC_COLUMNS).where(
+    alt_identifiers.identifier == bindparam("bibcode")
+)
+
+
 def clear_classic_data(app):
     with app.session_scope() as session:
         try:
@@ -63,18 +89,10 @@ def clear_summary_data(app):
             raise DBClearSummaryException("Failed to clear summary table: %s" % err)
 
 
-def query_master_by_doi(app, doi):
-    with app.session_scope() as session:
-        try:
-            return session.query(master.master_doi).filter_by(master_doi=doi).all()
-        except Exception as err:
-            raise DBQueryException("Unable to query master by DOI %s: %s" % (doi, err))
-
-
 def query_bibstem_by_issn(app, issn):
     with app.session_scope() as session:
         try:
-            return session.query(issn_bibstem.bibstem).filter(issn_bibstem.issn == issn).first()
+            return session.execute(BIBSTEM_BY_ISSN, {"issn": issn}).first()
         except Exception as err:
             raise DBQueryException("Unable to get bibstem from issn %s: %s" % (issn, err))
 
@@ -112,31 +130,53 @@ def query_classic_bibcodes(app, doi, bibcode):
         bibcodesFromBib = []
         try:
             if doi:
-                bibcodesFromDoi = (
-                    session.query(
-                        alt_identifiers.identifier,
-                        alt_identifiers.canonical_id,
-                        alt_identifiers.idtype,
-                    )
-                    .join(
-                        identifier_doi, alt_identifiers.canonical_id == identifier_doi.identifier
-                    )
-                    .filter(identifier_doi.doi == doi)
+                bibcodesFromDoi = session.execute(CLASSIC_BY_DOI, {"doi": doi}).all()
+            if bibcode:
+                bibcodesFromBib = session.execute(CLASSIC_BY_BIBCODE, {"bibcode": bibcode}).all()
+            return bibcodesFromDoi, bibcodesFromBib
+        except Exception as err:
+            raise DBQueryException(err)
+
+
+def query_master_hashes(app, dois):
+    """
+    Returns a dict of the content_hash of each of the given DOIs' rows in
+    master (None for rows written before content hashes were stored).
+    """
+    hashes = {}
+    with app.session_scope() as session:
+        try:
+            dois = list(dois)
+            for i in range(0, len(dois), 1000):
+                hashes.update(
+                    session.query(master.master_doi, master.content_hash)
+                    .filter(master.master_doi.in_(dois[i : i + 1000]))
                     .all()
                 )
-            if bibcode:
-                bibcodesFromBib = (
-                    session.query(
-                        alt_identifiers.identifier,
-                        alt_identifiers.canonical_id,
-                        alt_identifiers.idtype,
+            return hashes
+        except Exception as err:
+            raise DBQueryException("Unable to query master content hashes: %s" % err)
+
+
+def query_candidate_bibcodes(app, prefixes):
+    """
+    Returns the alt_identifiers (identifier, canonical_id, idtype) rows whose
+    identifiers start with any of prefixes.
+    """
+    with app.session_scope() as session:
+        try:
+            return session.execute(
+                select(*CLASSIC_COLUMNS).where(
+                    or_(
+                        *[
+                            alt_identifiers.identifier.startswith(p, autoescape=True)
+                            for p in prefixes
+                        ]
                     )
-                    .filter(alt_identifiers.identifier == bibcode)
-                    .all()
                 )
-            return bibcodesFromDoi, bibcodesFromBib
+            ).all()
         except Exception as err:
-            raise DBQueryException(err)
+            raise DBQueryException("Unable to query candidate bibcodes: %s" % err)
 
 
 def query_retry_files(app, rec_type):
@@ -151,22 +191,29 @@ def query_retry_files(app, rec_type):
             )
 
 
+def record_issns(record):
+    # the nonempty ISSNs of an ingest record, hyphenated as in issn_bibstem
+    issns = []
+    for issn in record.get("publication", {}).get("ISSN", []):
+        issnString = str(issn.get("issnString", ""))
+        if issnString:
+            if len(issnString) == 8:
+                issnString = issnString[0:4] + "-" + issnString[4:]
+            issns.append(issnString)
+    return issns
+
+
 def query_bibstem(app, record):
     try:
-        issn_list = record.get("publication", {}).get("ISSN", [])
         bibstem = ""
-        for issn in issn_list:
+        for issnString in record_issns(record):
             if not bibstem:
-                issnString = str(issn.get("issnString", ""))
-                if issnString:
-                    if len(issnString) == 8:
-                        issnString = issnString[0:4] + "-" + issnString[4:]
-                    try:
-                        bibstem_result = query_bibstem_by_issn(app, issnString)
-                        if bibstem_result:
-                            bibstem = bibstem_result[0]
-                    except Exception as err:
-                        logger.warning("Error from database call: %s" % err)
+                try:
+                    bibstem_result = query_bibstem_by_issn(app, issnString)
+                    if bibstem_result:
+                        bibstem = bibstem_result[0]
+                except Exception as err:
+                    logger.warning("Error from database call: %s" % err)
     except Exception as err:
         raise BibstemLookupException(err)
     else:
@@ -212,20 +259,6 @@ def query_summary_single_bibstem(app, bibstem):
             )
 
 
-def update_master_by_doi(app, update):
-    with app.session_scope() as session:
-        try:
-            doi = update.get("master_doi", None)
-            session.query(master).filter_by(master_doi=doi).update(update)
-            session.commit()
-        except Exception as err:
-            session.rollback()
-            session.flush()
-            raise DBWriteException(
-                "Error writing record to master: %s; row data: %s" % (err, update)
-            )
-
-
 def write_completeness_summary(app, summary_data):
     summary_rec = summary(
         bibstem=summary_data[0],
@@ -256,41 +289,242 @@ def write_block(app, table, datablock):
             raise DBWriteException("Failed to bulk write data block: %s" % err)
 
 
-def write_matched_record(app, result, record):
+def record_hash(record):
+    # hash of the master columns of a matched record tuple
+    data = json.dumps(list(record[0:10]), separators=(",", ":"))
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def master_columns(record):
+    # maps a matched record tuple from task_process_meta to master's columns
+    return {
+        "harvest_filepath": record[0],
+        "master_doi": record[1],
+        "issns": record[2],
+        "db_origin": "Crossref",
+        "master_bibdata": record[3],
+        "classic_match": record[4],
+        "status": record[5],
+        "matchtype": record[6],
+        "bibcode_meta": record[7],
+        "bibcode_classic": record[8],
+        "notes": record[9],
+        "content_hash": record_hash(record),
+    }
+
+
+def master_upsert(dialect_name, row):
+    """
+    Builds a single INSERT ... ON CONFLICT (master_doi) DO UPDATE of a master
+    row.  An existing row is only updated, along with its updated time, if
+    its content differs from the new row -- compared by content_hash when
+    the new row has one, otherwise column by column -- so unchanged rows
+    cost no writes.
+    """
+    insert = sqlite_insert if dialect_name == "sqlite" else pg_insert
+    stmt = insert(master).values(**row)
+    columns = [c for c in row if c != "master_doi"]
+    if "content_hash" in row:
+        changed = master.content_hash.is_distinct_from(stmt.excluded.content_hash)
+    else:
+        changed = or_(*[getattr(master, c).is_distinct_from(stmt.excluded[c]) for c in columns])
+    update = dict([(c, stmt.excluded[c]) for c in columns])
+    update["updated"] = get_date()
+    return stmt.on_conflict_do_update(
+        index_elements=[master.master_doi], set_=update, where=changed
+    )
+
+
+def write_matched_record(app, record):
+    # returns False if master already had an identical row for the record
     with app.session_scope() as session:
         try:
-            if result:
-                update = {
-                    "harvest_filepath": record[0],
-                    "master_doi": record[1],
-                    "issns": record[2],
-                    "db_origin": "Crossref",
-                    "master_bibdata": record[3],
-                    "classic_match": record[4],
-                    "status": record[5],
-                    "matchtype": record[6],
-                    "bibcode_meta": record[7],
-                    "bibcode_classic": record[8],
-                    "notes": record[9],
+            stmt = master_upsert(session.get_bind().dialect.name, master_columns(record))
+            result = session.execute(stmt)
+            session.commit()
+            return result.rowcount != 0
+        except Exception as err:
+            session.rollback()
+            session.flush()
+            raise DBWriteException("Failed to add/update row in master: %s" % err)
+
+
+def write_run_logfiles(app, run_id, logfiles):
+    # one row per logfile (batch -1), with expected counts filled in once
+    # the logfile has been read
+    rows = [
+        {"run_id": run_id, "logfile": logfile, "batch": -1, "dispatched": 0}
+        for logfile in logfiles
+    ]
+    write_block(app, run_status, rows)
+
+
+def write_run_batches(app, run_id, logfile, batch_sizes):
+    """
+    Records the batches that one logfile of a run was split into: updates
+    the logfile's row with its record count, and adds a row per batch.
+    """
+    total = sum(batch_sizes)
+    with app.session_scope() as session:
+        try:
+            updated = (
+                session.query(run_status)
+                .filter_by(run_id=run_id, logfile=logfile, batch=-1)
+                .update(
+                    {"expected": total, "dispatched": total, "updated": get_date()},
+                    synchronize_session=False,
+                )
+            )
+            rows = [
+                {
+                    "run_id": run_id,
+                    "logfile": logfile,
+                    "batch": i,
+                    "expected": n,
+                    "dispatched": n,
+                    "processed": 0,
+                    "failed": 0,
+                    "queued": 0,
                 }
-                update_master_by_doi(app, update)
-            else:
-                row = master(
-                    harvest_filepath=record[0],
-                    master_doi=record[1],
-                    issns=record[2],
-                    db_origin="Crossref",
-                    master_bibdata=record[3],
-                    classic_match=record[4],
-                    status=record[5],
-                    matchtype=record[6],
-                    bibcode_meta=record[7],
-                    bibcode_classic=record[8],
-                    notes=record[9],
+                for (i, n) in enumerate(batch_sizes)
+            ]
+            if not updated:
+                rows.append(
+                    {
+                        "run_id": run_id,
+                        "logfile": logfile,
+                        "batch": -1,
+                        "expected": total,
+                        "dispatched": total,
+                        "processed": 0,
+                        "failed": 0,
+                    }
                 )
-                session.add(row)
-                session.commit()
+            session.bulk_insert_mappings(run_status, rows)
+            session.commit()
         except Exception as err:
             session.rollback()
             session.flush()
-            raise DBWriteException("Failed to add/update row in master: %s" % err)
+            raise DBWriteException("Failed to write run batches for %s: %s" % (logfile, err))
+
+
+def update_run_batch(app, run_id, logfile, batch, processed, failed, queued=0):
+    # adds to a batch's counts, rather than setting them, since the batch's
+    # process-meta task and the write-db tasks of its records update them in
+    # whatever order they finish
+    with app.session_scope() as session:
+        try:
+            session.query(run_status).filter_by(
+                run_id=run_id, logfile=logfile, batch=batch
+            ).update(
+                {
+                    "processed": run_status.processed + processed,
+                    "failed": run_status.failed + failed,
+                    "queued": run_status.queued + queued,
+                    "updated": get_date(),
+                },
+                synchronize_session=False,
+            )
+            session.commit()
+        except Exception as err:
+            session.rollback()
+            session.flush()
+            raise DBWriteException(
+                "Failed to update run %s batch %s of %s: %s" % (run_id, batch, logfile, err)
+            )
+
+
+def fail_run_logfile(app, run_id, logfile):
+    # marks a logfile that couldn't be read or dispatched: nothing more is
+    # expected from it, and failed flags its row as a failed logfile
+    with app.session_scope() as session:
+        try:
+            session.query(run_status).filter_by(run_id=run_id, logfile=logfile, batch=-1).update(
+                {"expected": 0, "failed": 1, "updated": get_date()},
+                synchronize_session=False,
+            )
+            session.commit()
+        except Exception as err:
+            session.rollback()
+            session.flush()
+            raise DBWriteException(
+                "Failed to mark logfile %s of run %s as failed: %s" % (logfile, run_id, err)
+            )
+
+
+def query_latest_run_id(app):
+    with app.session_scope() as session:
+        try:
+            result = (
+                session.query(run_status.run_id)
+                .order_by(run_status.created.desc(), run_status.runstatusid.desc())
+                .first()
+            )
+            if result:
+                return result[0]
+        except Exception as err:
+            raise DBQueryException("Unable to get latest run id: %s" % err)
+
+
+def query_run_status(app, run_id):
+    """
+    Returns the totals of a run: its logfiles (and how many haven't been read
+    yet or have failed), its batches (and how many are finished), the
+    expected, dispatched, processed and failed record counts, how many
+    records are waiting to be written, and when it started and was last
+    updated.
+    """
+    with app.session_scope() as session:
+        try:
+            logfiles = (
+                session.query(
+                    func.count(run_status.runstatusid),
+                    func.sum(case([(run_status.expected.is_(None), 1)], else_=0)),
+                    func.sum(case([(run_status.failed > 0, 1)], else_=0)),
+                    func.coalesce(func.sum(run_status.expected), 0),
+                    func.min(run_status.created),
+                )
+                .filter(run_status.run_id == run_id, run_status.batch == -1)
+                .one()
+            )
+            batches = (
+                session.query(
+                    func.count(run_status.runstatusid),
+                    func.sum(
+                        case(
+                            [
+                                (
+                                    run_status.processed + run_status.failed
+                                    >= run_status.expected,
+                                    1,
+                                )
+                            ],
+                            else_=0,
+                        )
+                    ),
+                    func.coalesce(func.sum(run_status.dispatched), 0),
+                    func.coalesce(func.sum(run_status.processed), 0),
+                    func.coalesce(func.sum(run_status.failed), 0),
+                    func.coalesce(func.sum(run_status.queued), 0),
+                    func.max(run_status.updated),
+                )
+                .filter(run_status.run_id == run_id, run_status.batch >= 0)
+                .one()
+            )
+            return {
+                "run_id": run_id,
+                "logfiles": logfiles[0],
+                "logfiles_pending": logfiles[1] or 0,
+                "logfiles_failed": logfiles[2] or 0,
+                "expected": logfiles[3],
+                "started": logfiles[4],
+                "batches": batches[0],
+                "batches_done": batches[1] or 0,
+                "dispatched": batches[2],
+                "processed": batches[3],
+                "failed": batches[4],
+                "queued": batches[5],
+                "updated": batches[6],
+            }
+        except Exception as err:
+            raise DBQueryException("Unable to get status of run %s: %s" % (run_id, err))
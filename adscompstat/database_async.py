@@ -0,0 +1,156 @@
+import asyncio
+import os
+
+from adsputils import load_config, setup_logging
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from adscompstat.database import (
+    BIBSTEM_BY_ISSN,
+    CLASSIC_BY_BIBCODE,
+    CLASSIC_BY_DOI,
+    BibstemLookupException,
+    DBQueryException,
+    DBWriteException,
+    master_columns,
+    master_upsert,
+    record_issns,
+)
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(
+    __name__,
+    proj_home=proj_home,
+    level=config.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=config.get("LOG_STDOUT", False),
+)
+
+# asyncio drivers to use in place of the synchronous ones in SQLALCHEMY_URL
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+# One AsyncDatabase per worker process; its engine's connections belong to
+# the process (and event loop) that opened them, so it's replaced after fork
+_async_db_cache = {"db": None, "pid": None, "url": None}
+
+
+def async_url(url):
+    (scheme, rest) = url.split("://", 1)
+    return ASYNC_DRIVERS.get(scheme, scheme) + "://" + rest
+
+
+class AsyncDatabase(object):
+    """
+    asyncio versions of the database.py lookups and writes used by
+    task_process_meta, so that those of a whole batch of records can run
+    concurrently over a small connection pool.  Each batch method takes the
+    per-record arguments as a list, runs them on this object's event loop
+    with at most `concurrency` at once, and returns their results in the
+    same order, with an exception in place of the result of any that failed.
+    """
+
+    def __init__(self, url, pool_size=5, max_overflow=0, concurrency=None):
+        self.url = async_url(url)
+        self.concurrency = concurrency or (pool_size + max_overflow)
+        self.loop = asyncio.new_event_loop()
+        engine_args = {}
+        if not self.url.startswith("sqlite"):
+            engine_args = {"pool_size": pool_size, "max_overflow": max_overflow}
+        self.engine = create_async_engine(self.url, **engine_args)
+        self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self._semaphore = None
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        self.run(self.engine.dispose())
+        self.loop.close()
+
+    async def _gather(self, coros):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(coro):
+            async with self._semaphore:
+                return await coro
+
+        return await asyncio.gather(*[limited(c) for c in coros], return_exceptions=True)
+
+    async def query_bibstem(self, record):
+        try:
+            bibstem = ""
+            async with self.session() as session:
+                for issnString in record_issns(record):
+                    if not bibstem:
+                        try:
+                            result = await session.execute(BIBSTEM_BY_ISSN, {"issn": issnString})
+                            bibstem_result = result.first()
+                            if bibstem_result:
+                                bibstem = bibstem_result[0]
+                        except Exception as err:
+                            logger.warning("Error from database call: %s" % err)
+                            # a failed query aborts the transaction (in
+                            # Postgres), which would fail the next ISSN's too
+                            await session.rollback()
+        except Exception as err:
+            raise BibstemLookupException(err)
+        else:
+            return bibstem
+
+    async def query_classic_bibcodes(self, doi, bibcode):
+        bibcodesFromDoi = []
+        bibcodesFromBib = []
+        async with self.session() as session:
+            try:
+                if doi:
+                    result = await session.execute(CLASSIC_BY_DOI, {"doi": doi})
+                    bibcodesFromDoi = result.all()
+                if bibcode:
+                    result = await session.execute(CLASSIC_BY_BIBCODE, {"bibcode": bibcode})
+                    bibcodesFromBib = result.all()
+                return bibcodesFromDoi, bibcodesFromBib
+            except Exception as err:
+                raise DBQueryException(err)
+
+    async def write_matched_record(self, record):
+        stmt = master_upsert(self.engine.dialect.name, master_columns(record))
+        async with self.session() as session:
+            try:
+                result = await session.execute(stmt)
+                await session.commit()
+                return result.rowcount != 0
+            except Exception as err:
+                await session.rollback()
+                raise DBWriteException("Failed to add/update row in master: %s" % err)
+
+    def query_bibstems(self, records):
+        return self.run(self._gather([self.query_bibstem(r) for r in records]))
+
+    def query_classic_bibcodes_batch(self, lookups):
+        # lookups is a list of (doi, bibcode) pairs
+        return self.run(self._gather([self.query_classic_bibcodes(d, b) for (d, b) in lookups]))
+
+    def write_matched_records(self, records):
+        return self.run(self._gather([self.write_matched_record(r) for r in records]))
+
+
+def get_async_db(url, pool_size=5, max_overflow=0, concurrency=None):
+    pid = os.getpid()
+    if (
+        _async_db_cache["db"] is None
+        or _async_db_cache["pid"] != pid
+        or _async_db_cache["url"] != url
+    ):
+        _async_db_cache["db"] = AsyncDatabase(
+            url, pool_size=pool_size, max_overflow=max_overflow, concurrency=concurrency
+        )
+        _async_db_cache["pid"] = pid
+        _async_db_cache["url"] = url
+    return _async_db_cache["db"]
@@ -67,3 +67,31 @@ class MissingFilenameException(Exception):
 
 class JsonExportException(Exception):
     pass
+
+
+class BatchCostModelException(Exception):
+    pass
+
+
+class ClassicStoreException(Exception):
+    pass
+
+
+class BloomFilterException(Exception):
+    pass
+
+
+class FastParseException(Exception):
+    pass
+
+
+class XmlEncodingException(Exception):
+    pass
+
+
+class HarvestArchiveException(Exception):
+    pass
+
+
+class RecordCacheException(Exception):
+    pass
@@ -0,0 +1,333 @@
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from adsputils import load_config, setup_logging
+
+from adscompstat.exceptions import HarvestArchiveException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+# Harvested files can be stored compressed, as <file>.gz or <file>.zst, or
+# in bundles: zip (or uncompressed tar) files under HARVEST_BUNDLE_DIR, one
+# for each directory HARVEST_BUNDLE_DEPTH levels below HARVEST_BASE_DIR,
+# holding that directory's files by their path relative to it.  E.g. with a
+# depth of 2, <base>/doi/10.3847/00/67/metadata.xml is read from the member
+# 00/67/metadata.xml of <bundle dir>/doi/10.3847.zip.
+COMPRESSED_SUFFIXES = [".gz", ".zst"]
+BUNDLE_SUFFIXES = [".zip", ".tar"]
+
+_archive_config = {"base_dir": None, "bundle_dir": None, "depth": None}
+
+# Open bundles (or None, for directories without one) of this process, by
+# directory; bundles are kept open, up to MAX_OPEN_BUNDLES of them, and are
+# reopened if the file has been replaced since
+MAX_OPEN_BUNDLES = 64
+_bundle_cache = OrderedDict()
+_bundle_lock = threading.Lock()
+
+
+class ZipBundle(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._zip = zipfile.ZipFile(filename, "r")
+        self._lock = threading.Lock()
+
+    def __contains__(self, member):
+        try:
+            self._zip.getinfo(member)
+        except KeyError:
+            return False
+        return True
+
+    def read(self, member):
+        with self._lock:
+            return self._zip.read(member)
+
+    def size(self, member):
+        return self._zip.getinfo(member).file_size
+
+    def close(self):
+        self._zip.close()
+
+
+class TarBundle(object):
+    """
+    An uncompressed tar file, indexed once when opened; members are read
+    with pread, so that threads can read them concurrently.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with tarfile.open(filename, "r:") as tf:
+            self._index = dict(
+                [
+                    (os.path.normpath(m.name), (m.offset_data, m.size))
+                    for m in tf.getmembers()
+                    if m.isfile()
+                ]
+            )
+        self._fd = os.open(filename, os.O_RDONLY)
+
+    def __contains__(self, member):
+        return member in self._index
+
+    def read(self, member):
+        (offset, size) = self._index[member]
+        return os.pread(self._fd, size, offset)
+
+    def size(self, member):
+        return self._index[member][1]
+
+    def close(self):
+        os.close(self._fd)
+
+
+BUNDLE_CLASSES = {".zip": ZipBundle, ".tar": TarBundle}
+
+
+def configure(base_dir, bundle_dir=None, depth=None):
+    """
+    Sets the harvest directory and the bundle directory and depth used to
+    find harvested files.  Bundles that weren't there when last looked for
+    are looked for again after this is called.
+    """
+    new_config = {"base_dir": base_dir, "bundle_dir": bundle_dir, "depth": depth}
+    with _bundle_lock:
+        if new_config != _archive_config:
+            for bundle in _bundle_cache.values():
+                if bundle:
+                    bundle.close()
+            _bundle_cache.clear()
+            _archive_config.update(new_config)
+        else:
+            for key in [k for (k, v) in _bundle_cache.items() if v is None]:
+                del _bundle_cache[key]
+
+
+def bundle_path(path, base_dir, depth):
+    """
+    Returns the (bundle directory, member name) of a harvested file's path,
+    both relative to base_dir, or None if the file isn't deep enough below
+    base_dir to be in a bundle.
+    """
+    if not base_dir or not depth:
+        return None
+    rel = os.path.relpath(os.path.normpath(path), os.path.normpath(base_dir))
+    parts = rel.split(os.sep)
+    if parts[0] == ".." or len(parts) <= depth:
+        return None
+    return "/".join(parts[0:depth]), "/".join(parts[depth:])
+
+
+def _file_id(filename):
+    # identifies the file at filename, which pack_bundle replaces with a new one
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime)
+
+
+def _open_bundle(key):
+    for suffix in BUNDLE_SUFFIXES:
+        filename = os.path.join(_archive_config["bundle_dir"], key + suffix)
+        fileid = _file_id(filename)
+        if fileid:
+            try:
+                bundle = BUNDLE_CLASSES[suffix](filename)
+            except Exception as err:
+                logger.warning("Unable to open harvest bundle %s: %s" % (filename, err))
+            else:
+                bundle.fileid = fileid
+                return bundle
+    return None
+
+
+def _find_in_bundle(path):
+    # returns the (bundle, member) holding a harvested file, if any
+    if not _archive_config["bundle_dir"]:
+        return None, None
+    split = bundle_path(path, _archive_config["base_dir"], _archive_config["depth"])
+    if not split:
+        return None, None
+    (key, member) = split
+    with _bundle_lock:
+        bundle = _bundle_cache.get(key, None)
+        if bundle and _file_id(bundle.filename) != bundle.fileid:
+            # replaced (or removed) since it was opened
+            bundle.close()
+            del _bundle_cache[key]
+        if key in _bundle_cache:
+            _bundle_cache.move_to_end(key)
+        else:
+            bundle = _open_bundle(key)
+            _bundle_cache[key] = bundle
+            while len(_bundle_cache) > MAX_OPEN_BUNDLES:
+                (_, old) = _bundle_cache.popitem(last=False)
+                if old:
+                    old.close()
+    if bundle and member in bundle:
+        return bundle, member
+    return None, None
+
+
+def _open_compressed(path, suffix):
+    if suffix == ".gz":
+        return gzip.open(path, "rb")
+    if zstandard is None:
+        raise HarvestArchiveException("zstandard is not installed, can't read %s" % path)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+@contextmanager
+def open_harvest_file(path):
+    """
+    Opens a harvested file for reading in binary mode, from the file
+    itself, a compressed copy of it, or the bundle holding it.  Files read
+    from bundles are returned as BytesIO objects.
+    """
+    (bundle, member) = _find_in_bundle(path)
+    if bundle:
+        try:
+            fx = io.BytesIO(bundle.read(member))
+        except Exception as err:
+            raise HarvestArchiveException(
+                "Unable to read %s from %s: %s" % (member, bundle.filename, err)
+            )
+    else:
+        try:
+            fx = open(path, "rb")
+        except FileNotFoundError:
+            for suffix in COMPRESSED_SUFFIXES:
+                if os.path.exists(path + suffix):
+                    fx = _open_compressed(path + suffix, suffix)
+                    break
+            else:
+                raise
+    try:
+        yield fx
+    finally:
+        fx.close()
+
+
+def harvest_file_size(path):
+    """
+    Returns the size of a harvested file: its size in its bundle, if it's
+    in one, or else the size on disk of the file or its compressed copy.
+    """
+    (bundle, member) = _find_in_bundle(path)
+    if bundle:
+        return bundle.size(member)
+    for suffix in [""] + COMPRESSED_SUFFIXES:
+        try:
+            return os.path.getsize(path + suffix)
+        except FileNotFoundError:
+            pass
+    raise FileNotFoundError("No such file: %s" % path)
+
+
+def _bundle_dirs(base_dir, subdir, depth):
+    # yields the directories (relative to base_dir) that get a bundle each
+    start = os.path.normpath(subdir) if subdir else ""
+    level = len(start.split(os.sep)) if start else 0
+    if level >= depth:
+        yield "/".join(start.split(os.sep)[0:depth])
+        return
+    with os.scandir(os.path.join(base_dir, start)) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_dir(follow_symlinks=False):
+                child = os.path.join(start, entry.name) if start else entry.name
+                if level + 1 == depth:
+                    yield child.replace(os.sep, "/")
+                else:
+                    for key in _bundle_dirs(base_dir, child, depth):
+                        yield key
+
+
+def _member_data(filename):
+    # returns the member name and uncompressed contents of a file to pack
+    for suffix in COMPRESSED_SUFFIXES:
+        if filename.endswith(suffix):
+            with _open_compressed(filename, suffix) as fx:
+                return filename[0 : -len(suffix)], fx.read()
+    with open(filename, "rb") as fx:
+        return filename, fx.read()
+
+
+def pack_bundle(base_dir, bundle_dir, key, compress=True):
+    """
+    Writes the files under base_dir/key to the zip bundle bundle_dir/key.zip,
+    keeping any members of an existing bundle that are no longer on disk,
+    and replacing the bundle atomically.  Compressed files are stored
+    uncompressed, under their original names.  Returns the number of files
+    in the bundle.
+    """
+    bundle_file = os.path.join(bundle_dir, key + ".zip")
+    source_dir = os.path.join(base_dir, key)
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    try:
+        os.makedirs(os.path.dirname(bundle_file), exist_ok=True)
+        (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(bundle_file), suffix=".tmp")
+        os.close(fd)
+        try:
+            written = set()
+            with zipfile.ZipFile(tmpfile, "w", compression=compression) as zf:
+                for dirpath, dirnames, filenames in os.walk(source_dir):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        (name, data) = _member_data(os.path.join(dirpath, filename))
+                        member = os.path.relpath(name, source_dir).replace(os.sep, "/")
+                        if member not in written:
+                            zf.writestr(member, data)
+                            written.add(member)
+                if os.path.exists(bundle_file):
+                    with zipfile.ZipFile(bundle_file, "r") as old:
+                        for info in old.infolist():
+                            if info.filename not in written:
+                                zf.writestr(info.filename, old.read(info))
+                                written.add(info.filename)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, bundle_file)
+        except Exception:
+            os.unlink(tmpfile)
+            raise
+    except Exception as err:
+        raise HarvestArchiveException("Unable to write bundle %s: %s" % (bundle_file, err))
+    return len(written)
+
+
+def pack_harvest_tree(base_dir, bundle_dir, depth, subdir=None, compress=True):
+    """
+    Packs the harvested files under base_dir (or its subdirectory subdir)
+    into one zip bundle per directory depth levels below base_dir.  The
+    original files are left in place.  Returns the number of bundles and of
+    files written.
+    """
+    if not bundle_dir or not depth:
+        raise HarvestArchiveException("HARVEST_BUNDLE_DIR and HARVEST_BUNDLE_DEPTH must be set")
+    nbundles = 0
+    nfiles = 0
+    for key in _bundle_dirs(base_dir, subdir, depth):
+        nfiles += pack_bundle(base_dir, bundle_dir, key, compress=compress)
+        nbundles += 1
+        logger.debug("Packed harvest bundle %s" % key)
+    return nbundles, nfiles
@@ -13,9 +13,112 @@ logger = setup_logging(
 )
 
 
+def split_bibcode(bibcode):
+    """
+    Slices a bibcode into its year, bibstem, volume, qualifier, page, and
+    author initial, followed by the integer values of volume and page (or
+    None where they aren't numeric).  Returns None if the bibcode is too
+    short to slice.
+    """
+    if len(bibcode) < 19:
+        return None
+    vol = bibcode[9:13]
+    page = bibcode[14:18]
+    return (
+        bibcode[0:4],
+        bibcode[4:9],
+        vol,
+        bibcode[13],
+        page,
+        bibcode[18],
+        int(vol) if vol.isascii() and vol.isdigit() else None,
+        int(page) if page.isascii() and page.isdigit() else None,
+    )
+
+
+def _get_bibcode_fields(bibcode, fieldCache):
+    fields = fieldCache.get(bibcode, False)
+    if fields is False:
+        fields = fieldCache[bibcode] = split_bibcode(bibcode)
+    return fields
+
+
+def make_bibstem_index(related_bibstems):
+    """
+    Maps each bibstem in a list of related-bibstem groups to the set of
+    group ids it belongs to, so that two bibstems are related if their
+    group id sets intersect.
+    """
+    groups = {}
+    for group_id, relation in enumerate(related_bibstems):
+        for bibstem in relation:
+            groups.setdefault(bibstem, set()).add(group_id)
+    return {k: frozenset(v) for k, v in groups.items()}
+
+
+def candidate_prefixes(bibcode):
+    """
+    The year, bibstem and volume (the first 13 characters) of the classic
+    bibcodes that may be near misses of bibcode: those of its bibstem and
+    volume, in its year or the year either side.  Returns [] if bibcode is
+    too short to slice.
+    """
+    fields = split_bibcode(bibcode) if bibcode else None
+    if not fields:
+        return []
+    (year, bibstem, vol) = fields[0:3]
+    years = [year]
+    if year.isascii() and year.isdigit():
+        years = ["%04d" % y for y in range(int(year) - 1, int(year) + 2)]
+    return [y + bibstem + vol for y in years]
+
+
+class CandidateIndex(object):
+    """
+    Finds the classic (identifier, canonical_id, idtype) rows that may
+    differ from a generated bibcode only in their qualifier, author initial,
+    page or year (+/- 1).  lookup(prefixes) returns the rows whose
+    identifiers start with any of prefixes (see candidate_prefixes), e.g.
+    from the classic store or the database; the rows of each volume are
+    kept once looked up, so an index is meant to be used for one batch.
+    """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self._volumes = {}
+
+    def candidates(self, bibcode):
+        prefixes = candidate_prefixes(bibcode)
+        if not prefixes:
+            return []
+        key = tuple(prefixes)
+        if key not in self._volumes:
+            try:
+                rows = [tuple(row) for row in self.lookup(prefixes)]
+            except Exception as err:
+                logger.warning("Unable to look up near-miss candidates of %s: %s" % (bibcode, err))
+                rows = []
+            self._volumes[key] = rows
+        return self._volumes[key]
+
+
 class CrossrefMatcher(object):
-    def __init__(self, related_bibstems=[]):
+    # the only differences allowed between a generated bibcode and a
+    # classic bibcode found by candidate index lookup
+    candidate_errs = frozenset(["qual", "init", "year", "page"])
+
+    def __init__(self, related_bibstems=[], candidate_index=None):
         self.related_bibstems = related_bibstems
+        self.candidate_index = candidate_index
+
+    @property
+    def related_bibstems(self):
+        return self._related_bibstems
+
+    @related_bibstems.setter
+    def related_bibstems(self, related_bibstems):
+        self._related_bibstems = related_bibstems
+        self._bibstem_index = make_bibstem_index(related_bibstems)
 
     def _compare_bibstems(self, testBibstem, classicBibstem):
         status = None
@@ -23,117 +126,184 @@ class CrossrefMatcher(object):
             if testBibstem == classicBibstem:
                 status = "matched"
             else:
-                for relation in self.related_bibstems:
-                    if testBibstem in relation and classicBibstem in relation:
-                        status = "related"
-                        break
+                testGroups = self._bibstem_index.get(testBibstem, None)
+                if testGroups and not testGroups.isdisjoint(
+                    self._bibstem_index.get(classicBibstem, ())
+                ):
+                    status = "related"
         except Exception as err:
             logger.debug("Exception in compare_bibstems: %s" % err)
         return status
 
-    def _match_bibcode_permutations(self, testBibcode, classicBibcode):
-        returnDict = {}
+    def _compare_bibcode_fields(self, testFields, classicFields, classicBibcode):
+        (
+            testYear,
+            testBibstem,
+            testVol,
+            testQual,
+            testPage,
+            testInit,
+            testVolNum,
+            testPageNum,
+        ) = testFields
+        (
+            classicYear,
+            classicBibstem,
+            classicVol,
+            classicQual,
+            classicPage,
+            classicInit,
+            classicVolNum,
+            classicPageNum,
+        ) = classicFields
+        stem = self._compare_bibstems(testBibstem, classicBibstem)
+        if not stem:
+            return {"match": "mismatch", "bibcode": classicBibcode}
+        errs = {}
+        if stem == "related":
+            errs["bibstem"] = stem
+        if testYear != classicYear:
+            errs["year"] = classicYear
+        if testQual != classicQual:
+            errs["qual"] = classicQual
+        if testInit != classicInit:
+            errs["init"] = classicInit
+        # volume and page only differ if they differ numerically, or if
+        # either one isn't a number
+        if testVol != classicVol and (testVolNum is None or testVolNum != classicVolNum):
+            errs["vol"] = classicVol
+        if testPage != classicPage and (testPageNum is None or testPageNum != classicPageNum):
+            errs["page"] = classicPage
+        return {"match": "partial", "bibcode": classicBibcode, "errs": errs}
+
+    def _match_bibcode_permutations(self, testBibcode, classicBibcode, fieldCache=None):
+        if fieldCache is None:
+            fieldCache = {}
         if testBibcode and classicBibcode:
-            try:
-                # check the year
-                testYear = testBibcode[0:4]
-                classicYear = classicBibcode[0:4]
-                # check the bibstem
-                testBibstem = testBibcode[4:9]
-                classicBibstem = classicBibcode[4:9]
-                # check the base volume
-                testVol = testBibcode[9:13]
-                classicVol = classicBibcode[9:13]
-                # check the qualifier letter
-                testQual = testBibcode[13]
-                classicQual = classicBibcode[13]
-                # check the base page
-                testPage = testBibcode[14:18]
-                classicPage = classicBibcode[14:18]
-                # check the author init
-                testInit = testBibcode[18]
-                classicInit = classicBibcode[18]
-
-                stem = self._compare_bibstems(testBibstem, classicBibstem)
-                if stem:
-                    returnDict["match"] = "partial"
-                    errs = {}
-                    returnDict["bibcode"] = classicBibcode
-                    if stem == "related":
-                        errs["bibstem"] = stem
-                    if testYear != classicYear:
-                        errs["year"] = classicYear
-                    if testQual != classicQual:
-                        errs["qual"] = classicQual
-                    if testInit != classicInit:
-                        errs["init"] = classicInit
-                    if testVol != classicVol:
-                        try:
-                            if int(testVol) != int(classicVol):
-                                errs["vol"] = classicVol
-                        except Exception as err:
-                            logger.debug("errs[vol]: %s" % err)
-                            errs["vol"] = classicVol
-                    if testPage != classicPage:
-                        try:
-                            if int(testPage) != int(classicPage):
-                                errs["page"] = classicPage
-                        except Exception as err:
-                            logger.debug("errs[page]: %s" % err)
-                            errs["page"] = classicPage
-                    returnDict["errs"] = errs
-                else:
-                    returnDict["match"] = "mismatch"
-                    returnDict["bibcode"] = classicBibcode
-            except Exception as err:
-                logger.debug("Problem checking bibcode permutations: %s" % err)
-                return {"match": "mismatch", "bibcode": classicBibcode}
+            testFields = _get_bibcode_fields(testBibcode, fieldCache)
+            classicFields = _get_bibcode_fields(classicBibcode, fieldCache)
+            if testFields and classicFields:
+                return self._compare_bibcode_fields(testFields, classicFields, classicBibcode)
+            logger.debug(
+                "Problem checking bibcode permutations: %s, %s" % (testBibcode, classicBibcode)
+            )
+            return {"match": "mismatch", "bibcode": classicBibcode}
         elif testBibcode:
             return {"match": "unmatched", "bibcode": None}
         elif classicBibcode:
             return {"match": "failed", "bibcode": classicBibcode}
-        return returnDict
+        return {}
 
-    def match(self, xrefBibcode, classicDoiMatches, classicBibMatches):
+    def _match_candidates(self, xrefBibcode, fieldCache):
+        # look for a classic bibcode that is a near miss of xrefBibcode,
+        # preferring the fewest differences and then canonical bibcodes
+        best = {}
+        bestRank = None
+        testFields = _get_bibcode_fields(xrefBibcode, fieldCache)
+        for row in self.candidate_index.candidates(xrefBibcode):
+            if row[0] == xrefBibcode:
+                continue
+            classicFields = _get_bibcode_fields(row[0], fieldCache)
+            result = self._compare_bibcode_fields(testFields, classicFields, row[0])
+            errs = result.get("errs", {})
+            if result["match"] != "partial" or not self.candidate_errs.issuperset(errs):
+                continue
+            if "year" in errs:
+                if not (testFields[0].isdigit() and errs["year"].isdigit()):
+                    continue
+                if abs(int(testFields[0]) - int(errs["year"])) > 1:
+                    continue
+            rank = (len(errs), row[2] != "canonical")
+            if bestRank is None or rank < bestRank:
+                best = result
+                bestRank = rank
+        return best
+
+    def _match_one(self, xrefBibcode, classicDoiMatches, classicBibMatches, fieldCache):
         result = {}
-        try:
-            # first, see if the generated bibcode is in classic
-            resultBib = {}
-            for match in classicBibMatches:
-                if xrefBibcode == match[0]:
-                    resultBib["match"] = match[2]
-                    resultBib["bibcode"] = match[1]
-                    resultBib["errs"] = {}
-            resultDoi = {}
-            if classicDoiMatches:
-                for match in classicDoiMatches:
-                    if not resultDoi.get("bibcode", None):
-                        if xrefBibcode == match[0]:
-                            resultDoi["match"] = match[2]
-                            resultDoi["bibcode"] = match[1]
-                            resultDoi["errs"] = {}
-                        else:
-                            resultDoi = self._match_bibcode_permutations(xrefBibcode, match[0])
-            if resultDoi:
-                if resultBib:
-                    if resultBib["bibcode"] == resultDoi["bibcode"]:
-                        resultDoi["match"] = resultBib["match"]
-                        result = resultDoi
+        # first, see if the generated bibcode is in classic
+        resultBib = {}
+        for match in classicBibMatches:
+            if xrefBibcode == match[0]:
+                resultBib["match"] = match[2]
+                resultBib["bibcode"] = match[1]
+                resultBib["errs"] = {}
+        resultDoi = {}
+        if classicDoiMatches:
+            for match in classicDoiMatches:
+                if not resultDoi.get("bibcode", None):
+                    if xrefBibcode == match[0]:
+                        resultDoi["match"] = match[2]
+                        resultDoi["bibcode"] = match[1]
+                        resultDoi["errs"] = {}
                     else:
-                        result = {
-                            "match": "mismatch",
-                            "bibcode": resultDoi["bibcode"],
-                            "errs": {"DOI": "DOI mismatched", "bibcode": resultBib["bibcode"]},
-                        }
-                else:
+                        resultDoi = self._match_bibcode_permutations(
+                            xrefBibcode, match[0], fieldCache
+                        )
+        if resultDoi:
+            if resultBib:
+                if resultBib["bibcode"] == resultDoi["bibcode"]:
+                    resultDoi["match"] = resultBib["match"]
                     result = resultDoi
-            elif resultBib:
-                result = resultBib
+                else:
+                    result = {
+                        "match": "mismatch",
+                        "bibcode": resultDoi["bibcode"],
+                        "errs": {"DOI": "DOI mismatched", "bibcode": resultBib["bibcode"]},
+                    }
+            else:
+                result = resultDoi
+        elif resultBib:
+            result = resultBib
+            result["errs"]["DOI"] = "DOI not in classic"
+        else:
+            if self.candidate_index and xrefBibcode:
+                result = self._match_candidates(xrefBibcode, fieldCache)
+            if result:
                 result["errs"]["DOI"] = "DOI not in classic"
             else:
                 result["match"] = "unmatched"
                 result["bibcode"] = None
                 result["errs"] = {"DOI": "DOI not in classic"}
+        return result
+
+    def match(self, xrefBibcode, classicDoiMatches, classicBibMatches):
+        result = {}
+        try:
+            result = self._match_one(xrefBibcode, classicDoiMatches, classicBibMatches, {})
         except Exception as err:
             logger.warning("Error matching Crossref-generated bibcode %s: %s" % (xrefBibcode, err))
         return result
+
+    def match_batch(self, xrefBibcodes, classicDoiMatchesList, classicBibMatchesList):
+        """
+        Matches a batch of Crossref-generated bibcodes, given parallel lists
+        of the classic (identifier, canonical_id, idtype) rows found for each
+        record's DOI and bibcode.  Returns a list of results in the same
+        order, each identical to what match() returns for that record.
+        Bibcodes are sliced into their fields once per batch, however many
+        records they're compared against.
+        """
+        fieldCache = {}
+        results = []
+        try:
+            for xrefBibcode, classicDoiMatches, classicBibMatches in zip(
+                xrefBibcodes, classicDoiMatchesList, classicBibMatchesList
+            ):
+                results.append(
+                    self._match_one(xrefBibcode, classicDoiMatches, classicBibMatches, fieldCache)
+                )
+        except Exception as err:
+            # fall back to matching the rest of the batch one at a time so
+            # that only the bad record gets an empty result
+            logger.debug("Batch matching failed, matching records singly: %s" % err)
+            n = len(results)
+            results.extend(
+                [
+                    self.match(xrefBibcode, classicDoiMatches, classicBibMatches)
+                    for xrefBibcode, classicDoiMatches, classicBibMatches in list(
+                        zip(xrefBibcodes, classicDoiMatchesList, classicBibMatchesList)
+                    )[n:]
+                ]
+            )
+        return results
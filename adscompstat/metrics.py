@@ -0,0 +1,373 @@
+import json
+import os
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
+
+from adsputils import load_config, setup_logging
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+# Stages of task_process_meta, in pipeline order; "read" is the time spent
+# waiting for files being read ahead
+STAGES = ["read", "parse", "bibstem", "bibcode", "classic", "match", "dispatch"]
+DB_STAGES = ["bibstem", "classic"]
+
+# Totals for this worker process, written out in Prometheus text format
+_totals = {
+    "batches": 0,
+    "records": 0,
+    "unchanged": 0,
+    "batch_seconds": 0.0,
+    "last_records_per_second": 0.0,
+    "stage_seconds": {},
+    "failures": {},
+    "pool": {},
+    "bloom": {"checks": 0, "doi_skips": 0, "bibcode_skips": 0},
+    "bloom_fpr": None,
+    "prefetch": {"files": 0, "bytes": 0, "read_seconds": 0.0, "misses": 0},
+    "record_cache": {"hits": 0, "misses": 0},
+    "bibcode_memo": {"hits": 0, "misses": 0},
+}
+
+# Connection pool counters and gauges from ADSCompStatCelery.pool_stats()
+POOL_COUNTERS = ["checkouts", "connects", "waits", "wait_seconds"]
+POOL_GAUGES = ["max_wait", "avg_wait", "size", "checked_out", "overflow"]
+
+
+def failure_reason(status):
+    """
+    Reduces a processedRecord status (e.g. "error: <message>") or exception
+    name to a short label usable as a metric label value.
+    """
+    return str(status).split(":")[0].strip().lower().replace(" ", "_") or "unknown"
+
+
+class BatchMetrics(object):
+    """
+    Collects per-stage timings and failure counts for the records of one
+    task_process_meta batch.
+    """
+
+    def __init__(self, log_records=False):
+        self.log_records = log_records
+        self.start = time.time()
+        self.stage_seconds = dict([(s, 0.0) for s in STAGES])
+        self.records = 0
+        self.unchanged = 0
+        self.bloom = {"checks": 0, "doi_skips": 0, "bibcode_skips": 0}
+        self.bloom_fpr = None
+        self.prefetch = None
+        self.record_cache = None
+        self.bibcode_memo = None
+        self.failures = {}
+        self._current = None
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+            if self._current is not None:
+                stages = self._current["stage_ms"]
+                stages[name] = stages.get(name, 0.0) + elapsed * 1000.0
+
+    def start_record(self, infile):
+        self.records += 1
+        self._current = {"file": infile, "stage_ms": {}, "failure": None}
+
+    def failure(self, stage, reason):
+        key = (stage, failure_reason(reason))
+        self.failures[key] = self.failures.get(key, 0) + 1
+        if self._current is not None:
+            self._current["failure"] = "%s:%s" % key
+
+    def end_record(self):
+        if self._current is not None and self.log_records:
+            record = self._current
+            record["stage_ms"] = dict([(k, round(v, 3)) for (k, v) in record["stage_ms"].items()])
+            logger.info("process-meta record metrics: %s" % json.dumps(record, sort_keys=True))
+        self._current = None
+
+    def bloom_check(self, skip_doi, skip_bibcode):
+        self.bloom["checks"] += 1
+        self.bloom["doi_skips"] += int(skip_doi)
+        self.bloom["bibcode_skips"] += int(skip_bibcode)
+
+    def record_cache_lookup(self, hit):
+        if self.record_cache is None:
+            self.record_cache = {"hits": 0, "misses": 0}
+        self.record_cache["hits" if hit else "misses"] += 1
+
+    def bibcode_memo_lookup(self, hit):
+        if self.bibcode_memo is None:
+            self.bibcode_memo = {"hits": 0, "misses": 0}
+        self.bibcode_memo["hits" if hit else "misses"] += 1
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        nfailed = sum(self.failures.values())
+        summary = {
+            "records": self.records,
+            "failed": nfailed,
+            "unchanged": self.unchanged,
+            "elapsed_ms": round(elapsed * 1000.0, 3),
+            "records_per_sec": round(self.records / elapsed, 3) if elapsed > 0 else 0.0,
+            "stage_ms": dict([(k, round(v * 1000.0, 3)) for (k, v) in self.stage_seconds.items()]),
+            "db_ms": round(sum([self.stage_seconds.get(s, 0.0) for s in DB_STAGES]) * 1000.0, 3),
+            "failures": dict([("%s:%s" % k, v) for (k, v) in self.failures.items()]),
+        }
+        if self.prefetch is not None:
+            summary["prefetch"] = dict(self.prefetch)
+        if self.record_cache is not None:
+            summary["record_cache"] = dict(self.record_cache)
+        if self.bibcode_memo is not None:
+            lookups = self.bibcode_memo["hits"] + self.bibcode_memo["misses"]
+            summary["bibcode_memo"] = dict(
+                self.bibcode_memo, hit_rate=round(self.bibcode_memo["hits"] / float(lookups), 4)
+            )
+        if self.bloom_fpr is not None:
+            summary["bloom"] = dict(self.bloom, false_positive_rate=self.bloom_fpr)
+        return summary
+
+    def finish(self, metrics_dir=None, pool_stats=None):
+        """
+        Logs the batch summary (with the worker's connection pool stats, if
+        given) as a structured log line, adds the batch to this process's
+        totals, and if metrics_dir is given, rewrites the process's
+        Prometheus metrics file there.
+        """
+        summary = self.summary()
+        if pool_stats:
+            summary["db_pool"] = pool_stats
+            _totals["pool"] = dict(pool_stats)
+        logger.info("process-meta batch metrics: %s" % json.dumps(summary, sort_keys=True))
+        _totals["batches"] += 1
+        _totals["records"] += self.records
+        _totals["unchanged"] += self.unchanged
+        for key, count in self.bloom.items():
+            _totals["bloom"][key] += count
+        if self.bloom_fpr is not None:
+            _totals["bloom_fpr"] = self.bloom_fpr
+        if self.prefetch is not None:
+            for key in _totals["prefetch"]:
+                _totals["prefetch"][key] += self.prefetch.get(key, 0)
+        if self.record_cache is not None:
+            for key, count in self.record_cache.items():
+                _totals["record_cache"][key] += count
+        if self.bibcode_memo is not None:
+            for key, count in self.bibcode_memo.items():
+                _totals["bibcode_memo"][key] += count
+        _totals["batch_seconds"] += summary["elapsed_ms"] / 1000.0
+        _totals["last_records_per_second"] = summary["records_per_sec"]
+        for stage, seconds in self.stage_seconds.items():
+            _totals["stage_seconds"][stage] = _totals["stage_seconds"].get(stage, 0.0) + seconds
+        for key, count in self.failures.items():
+            _totals["failures"][key] = _totals["failures"].get(key, 0) + count
+        if metrics_dir:
+            try:
+                write_prometheus_file(metrics_dir)
+            except Exception as err:
+                logger.warning("Unable to write metrics file to %s: %s" % (metrics_dir, err))
+        return summary
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus():
+    """Returns this process's totals in Prometheus text exposition format."""
+    pid = os.getpid()
+    lines = [
+        "# HELP adscompstat_batches_total Batches processed by task_process_meta.",
+        "# TYPE adscompstat_batches_total counter",
+        'adscompstat_batches_total{pid="%s"} %s' % (pid, _totals["batches"]),
+        "# HELP adscompstat_records_total Records processed by task_process_meta.",
+        "# TYPE adscompstat_records_total counter",
+        'adscompstat_records_total{pid="%s"} %s' % (pid, _totals["records"]),
+        "# HELP adscompstat_unchanged_records_total Records whose master row was already up to date.",
+        "# TYPE adscompstat_unchanged_records_total counter",
+        'adscompstat_unchanged_records_total{pid="%s"} %s' % (pid, _totals["unchanged"]),
+        "# HELP adscompstat_batch_seconds_total Wall time spent in task_process_meta.",
+        "# TYPE adscompstat_batch_seconds_total counter",
+        'adscompstat_batch_seconds_total{pid="%s"} %.6f' % (pid, _totals["batch_seconds"]),
+        "# HELP adscompstat_records_per_second Throughput of the most recent batch.",
+        "# TYPE adscompstat_records_per_second gauge",
+        'adscompstat_records_per_second{pid="%s"} %s' % (pid, _totals["last_records_per_second"]),
+        "# HELP adscompstat_stage_seconds_total Time spent in each process-meta stage.",
+        "# TYPE adscompstat_stage_seconds_total counter",
+    ]
+    for stage in sorted(_totals["stage_seconds"]):
+        lines.append(
+            'adscompstat_stage_seconds_total{pid="%s",stage="%s"} %.6f'
+            % (pid, _label(stage), _totals["stage_seconds"][stage])
+        )
+    lines.extend(
+        [
+            "# HELP adscompstat_record_failures_total Failed records by stage and reason.",
+            "# TYPE adscompstat_record_failures_total counter",
+        ]
+    )
+    for stage, reason in sorted(_totals["failures"]):
+        lines.append(
+            'adscompstat_record_failures_total{pid="%s",stage="%s",reason="%s"} %s'
+            % (pid, _label(stage), _label(reason), _totals["failures"][(stage, reason)])
+        )
+    prefetch = _totals["prefetch"]
+    lines.extend(
+        [
+            "# HELP adscompstat_prefetch_files_total Files read ahead of parsing.",
+            "# TYPE adscompstat_prefetch_files_total counter",
+            'adscompstat_prefetch_files_total{pid="%s"} %s' % (pid, prefetch["files"]),
+            "# HELP adscompstat_prefetch_bytes_total Bytes read ahead of parsing.",
+            "# TYPE adscompstat_prefetch_bytes_total counter",
+            'adscompstat_prefetch_bytes_total{pid="%s"} %s' % (pid, prefetch["bytes"]),
+            "# HELP adscompstat_prefetch_read_seconds_total Time the read-ahead threads spent reading.",
+            "# TYPE adscompstat_prefetch_read_seconds_total counter",
+            'adscompstat_prefetch_read_seconds_total{pid="%s"} %.6f'
+            % (pid, prefetch["read_seconds"]),
+            "# HELP adscompstat_prefetch_misses_total Files not read ahead, and read when parsed.",
+            "# TYPE adscompstat_prefetch_misses_total counter",
+            'adscompstat_prefetch_misses_total{pid="%s"} %s' % (pid, prefetch["misses"]),
+        ]
+    )
+    record_cache = _totals["record_cache"]
+    lines.extend(
+        [
+            "# HELP adscompstat_record_cache_lookups_total Parsed record cache lookups by result.",
+            "# TYPE adscompstat_record_cache_lookups_total counter",
+            'adscompstat_record_cache_lookups_total{pid="%s",result="hit"} %s'
+            % (pid, record_cache["hits"]),
+            'adscompstat_record_cache_lookups_total{pid="%s",result="miss"} %s'
+            % (pid, record_cache["misses"]),
+        ]
+    )
+    bibcode_memo = _totals["bibcode_memo"]
+    lines.extend(
+        [
+            "# HELP adscompstat_bibcode_memo_lookups_total Memoized bibcode lookups by result.",
+            "# TYPE adscompstat_bibcode_memo_lookups_total counter",
+            'adscompstat_bibcode_memo_lookups_total{pid="%s",result="hit"} %s'
+            % (pid, bibcode_memo["hits"]),
+            'adscompstat_bibcode_memo_lookups_total{pid="%s",result="miss"} %s'
+            % (pid, bibcode_memo["misses"]),
+        ]
+    )
+    bloom = _totals["bloom"]
+    lines.extend(
+        [
+            "# HELP adscompstat_bloom_checks_total Records checked against the classic bloom filter.",
+            "# TYPE adscompstat_bloom_checks_total counter",
+            'adscompstat_bloom_checks_total{pid="%s"} %s' % (pid, bloom["checks"]),
+            "# HELP adscompstat_bloom_skips_total Classic lookups skipped by the bloom filter.",
+            "# TYPE adscompstat_bloom_skips_total counter",
+            'adscompstat_bloom_skips_total{pid="%s",lookup="doi"} %s' % (pid, bloom["doi_skips"]),
+            'adscompstat_bloom_skips_total{pid="%s",lookup="bibcode"} %s'
+            % (pid, bloom["bibcode_skips"]),
+        ]
+    )
+    if _totals["bloom_fpr"] is not None:
+        lines.extend(
+            [
+                "# HELP adscompstat_bloom_false_positive_rate Expected false positive rate of"
+                " the classic bloom filter.",
+                "# TYPE adscompstat_bloom_false_positive_rate gauge",
+                'adscompstat_bloom_false_positive_rate{pid="%s"} %.6f'
+                % (pid, _totals["bloom_fpr"]),
+            ]
+        )
+    pool = _totals["pool"]
+    for name in POOL_COUNTERS + POOL_GAUGES:
+        if name in pool:
+            kind = "counter" if name in POOL_COUNTERS else "gauge"
+            metric = "adscompstat_db_pool_%s%s" % (name, "_total" if kind == "counter" else "")
+            lines.extend(
+                [
+                    "# HELP %s Database connection pool %s." % (metric, name.replace("_", " ")),
+                    "# TYPE %s %s" % (metric, kind),
+                    '%s{pid="%s"} %s' % (metric, pid, pool[name]),
+                ]
+            )
+    return "\n".join(lines) + "\n"
+
+
+def _prometheus_prefix():
+    # files are named for the host as well as the pid, since METRICS_DIR may
+    # be shared by the workers of several hosts
+    return "adscompstat_%s_" % socket.gethostname()
+
+
+def _prometheus_filename(metrics_dir, pid):
+    return os.path.join(metrics_dir, "%s%s.prom" % (_prometheus_prefix(), pid))
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def prune_prometheus_files(metrics_dir):
+    """
+    Removes the metrics files of this host's worker processes that are no
+    longer running (e.g. that were killed), so that their totals aren't
+    exported forever.  Returns the number removed.
+    """
+    prefix = _prometheus_prefix()
+    removed = 0
+    for name in os.listdir(metrics_dir):
+        pid = name[len(prefix) : -len(".prom")]
+        if not (name.startswith(prefix) and name.endswith(".prom") and pid.isdigit()):
+            continue
+        if not _pid_running(int(pid)):
+            try:
+                os.unlink(os.path.join(metrics_dir, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def remove_prometheus_file(metrics_dir):
+    """Removes this process's metrics file, e.g. when the worker exits."""
+    try:
+        os.unlink(_prometheus_filename(metrics_dir, os.getpid()))
+    except FileNotFoundError:
+        pass
+
+
+def write_prometheus_file(metrics_dir):
+    """
+    Atomically (re)writes this process's metrics to
+    metrics_dir/adscompstat_<host>_<pid>.prom, e.g. for node_exporter's
+    textfile collector, and removes those of this host's processes that have
+    exited.
+    """
+    filename = _prometheus_filename(metrics_dir, os.getpid())
+    (fd, tmpfile) = tempfile.mkstemp(dir=metrics_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as fw:
+            fw.write(format_prometheus())
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, filename)
+    except Exception:
+        os.unlink(tmpfile)
+        raise
+    prune_prometheus_files(metrics_dir)
+    return filename
@@ -1,15 +1,23 @@
 try:
-    from adsputils import UTCDateTime, get_date
+    from adsputils import UTCDateTime as _UTCDateTime
+    from adsputils import get_date
 except ImportError:
-    from adsmutils import get_date, UTCDateTime
+    from adsmutils import get_date
+    from adsmutils import UTCDateTime as _UTCDateTime
 
-from sqlalchemy import Column, Float, Integer, String, Text
+from sqlalchemy import Column, Float, Integer, String, Text, UniqueConstraint
 from sqlalchemy.dialects.postgresql import ENUM
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
 
+class UTCDateTime(_UTCDateTime):
+    # the upstream type has no per-instance state, so statements using it
+    # can go in SQLAlchemy's compiled cache (which it otherwise opts out of)
+    cache_ok = True
+
+
 class CompStatMaster(Base):
     __tablename__ = "master"
 
@@ -38,6 +46,7 @@ class CompStatMaster(Base):
     bibcode_meta = Column(String, nullable=True)
     bibcode_classic = Column(String, nullable=True)
     notes = Column(String, nullable=True)
+    content_hash = Column(String, nullable=True)
     created = Column(UTCDateTime, default=get_date)
     updated = Column(UTCDateTime, onupdate=get_date)
 
@@ -125,3 +134,42 @@ class CompStatAltIdents(Base):
 
     def __repr__(self):
         return "alt_identifiers.identifier='{self.identifier}', alt_identifiers.canonical_id='{self.canonical_id}', alt_identifiers.idtype='{self.idtype}'"
+
+
+class CompStatRunStatus(Base):
+    __tablename__ = "run_status"
+    __table_args__ = (UniqueConstraint("run_id", "logfile", "batch"),)
+
+    runstatusid = Column(Integer, primary_key=True, unique=True)
+    run_id = Column(String, nullable=False, index=True)
+    logfile = Column(String, nullable=False)
+    # batch number within the logfile, or -1 for the row of the logfile itself
+    batch = Column(Integer, nullable=False)
+    expected = Column(Integer, nullable=True)
+    dispatched = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    # records sent to the write-db queue but not yet written
+    queued = Column(Integer, nullable=False, default=0)
+    created = Column(UTCDateTime, default=get_date)
+    updated = Column(UTCDateTime, onupdate=get_date)
+
+    def __repr__(self):
+        return "run_status.run_id='{self.run_id}', run_status.logfile='{self.logfile}', run_status.batch='{self.batch}'".format(
+            self=self
+        )
+
+    def toJSON(self):
+        return {
+            "runstatusid": self.runstatusid,
+            "run_id": self.run_id,
+            "logfile": self.logfile,
+            "batch": self.batch,
+            "expected": self.expected,
+            "dispatched": self.dispatched,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queued": self.queued,
+            "created": self.created,
+            "updated": self.updated,
+        }
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from adsputils import load_config, setup_logging
+
+from adscompstat import harvest_archive
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+
+def read_harvest_file(infile):
+    with harvest_archive.open_harvest_file(infile) as fx:
+        return fx.read()
+
+
+class ReadAhead(object):
+    """
+    Reads the files of a batch ahead of their use on a small thread pool,
+    so that reading the next files overlaps with parsing the current one.
+    At most `depth` files past the one last taken are read ahead, and no
+    more are started while `max_bytes` of them are waiting to be taken.
+    get(i) returns the contents of file i, or None if it wasn't read ahead
+    (or couldn't be read), in which case the caller should read it itself.
+    """
+
+    def __init__(self, infiles, depth=4, max_bytes=67108864, threads=None, read=None):
+        self.infiles = list(infiles)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._read = read or read_harvest_file
+        self._executor = ThreadPoolExecutor(max_workers=threads or depth)
+        self._futures = {}
+        self._next = 0
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self.stats = {"files": 0, "bytes": 0, "read_seconds": 0.0, "max_buffered": 0, "misses": 0}
+
+    def __enter__(self):
+        self._fill(0)
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_one(self, infile):
+        t0 = time.perf_counter()
+        data = self._read(infile)
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            self._buffered += len(data)
+            self.stats["files"] += 1
+            self.stats["bytes"] += len(data)
+            self.stats["read_seconds"] += elapsed
+            self.stats["max_buffered"] = max(self.stats["max_buffered"], self._buffered)
+        return data
+
+    def _fill(self, current):
+        while self._next < len(self.infiles) and self._next <= current + self.depth:
+            with self._lock:
+                if self._buffered >= self.max_bytes:
+                    break
+            self._futures[self._next] = self._executor.submit(
+                self._read_one, self.infiles[self._next]
+            )
+            self._next += 1
+
+    def get(self, i):
+        self._fill(i)
+        future = self._futures.pop(i, None)
+        data = None
+        if future is None:
+            # held back by max_bytes
+            self._next = max(self._next, i + 1)
+        else:
+            try:
+                data = future.result()
+            except Exception as err:
+                logger.debug("Unable to read ahead %s: %s" % (self.infiles[i], err))
+            else:
+                with self._lock:
+                    self._buffered -= len(data)
+        if data is None:
+            self.stats["misses"] += 1
+        self._fill(i + 1)
+        return data
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._executor.shutdown(wait=True)
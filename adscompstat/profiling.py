@@ -0,0 +1,139 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from adsputils import load_config, setup_logging
+from celery import current_task
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+
+def _task_id():
+    try:
+        if current_task and current_task.request.id:
+            return current_task.request.id
+    except Exception as err:
+        logger.debug("Unable to get current task id: %s" % err)
+    return "local"
+
+
+def _batch_size(args):
+    if args and isinstance(args[0], (list, tuple)):
+        return len(args[0])
+    return len(args)
+
+
+def write_profile_report(outdir, tag, profiler, snapshot, top_stats=50, top_allocations=25):
+    """
+    Writes the cProfile stats of a profiled call to outdir/tag.prof (for
+    pstats or snakeviz), and a text report of its slowest functions and, if
+    a tracemalloc snapshot is given, its largest allocations to
+    outdir/tag.txt.  Returns the path of the text report.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    profiler.dump_stats(os.path.join(outdir, tag + ".prof"))
+    report = io.StringIO()
+    report.write("Profile of %s\n\n" % tag)
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats("cumulative").print_stats(top_stats)
+    if snapshot:
+        report.write("Top %s allocations by line:\n" % top_allocations)
+        for stat in snapshot.statistics("lineno")[:top_allocations]:
+            report.write("%s\n" % stat)
+    reportfile = os.path.join(outdir, tag + ".txt")
+    with open(reportfile, "w") as fr:
+        fr.write(report.getvalue())
+    return reportfile
+
+
+def profile_task(config):
+    """
+    Decorator that runs a randomly sampled fraction (PROFILE_SAMPLE_RATE in
+    config) of calls to the decorated task under cProfile and tracemalloc,
+    and writes their reports to PROFILE_OUTPUT_DIR, tagged with the task
+    name, celery task id and batch size.  Unsampled calls, and all calls
+    when either setting is unset, run the task unchanged.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rate = config.get("PROFILE_SAMPLE_RATE", 0.0)
+            outdir = config.get("PROFILE_OUTPUT_DIR", None)
+            if not rate or not outdir or random.random() >= rate:
+                return func(*args, **kwargs)
+
+            tag = "%s_%s_n%s_%s" % (
+                func.__name__,
+                _task_id(),
+                _batch_size(args),
+                time.strftime("%Y%m%d%H%M%S"),
+            )
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                snapshot = None
+                try:
+                    snapshot = tracemalloc.take_snapshot()
+                except Exception as err:
+                    logger.debug("Unable to take tracemalloc snapshot: %s" % err)
+                if started_tracemalloc:
+                    tracemalloc.stop()
+                try:
+                    reportfile = write_profile_report(
+                        outdir,
+                        tag,
+                        profiler,
+                        snapshot,
+                        top_allocations=config.get("PROFILE_TOP_ALLOCATIONS", 25),
+                    )
+                except Exception as err:
+                    logger.warning("Unable to write profile for %s: %s" % (tag, err))
+                else:
+                    logger.info("Wrote profile of %s to %s" % (tag, reportfile))
+
+        return wrapper
+
+    return decorator
+
+
+def import_times(statement):
+    """
+    Runs statement in a new interpreter with -X importtime, and returns the
+    cumulative import time in seconds of each module imported, by name.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=proj_home,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            (self_us, cumulative_us, name) = line[len("import time:") :].split("|")
+            if cumulative_us.strip().isdigit():
+                times[name.strip()] = int(cumulative_us) / 1.0e6
+    return times
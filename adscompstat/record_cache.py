@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+from adsputils import load_config, setup_logging
+
+from adscompstat.exceptions import RecordCacheException
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+conf = load_config(proj_home=proj_home)
+logger = setup_logging(
+    "completeness-statistics-pipeline",
+    proj_home=proj_home,
+    level=conf.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=conf.get("LOG_STDOUT", False),
+)
+
+# On-disk cache of parsed records (processedRecords), shared by the workers
+# on a host.  Each entry is a file named for the hash of the record's file
+# path, the hash of the file's contents, and the parser used, so that an
+# entry is only ever used for an unchanged file; it holds a one-byte format
+# tag and the record, as msgpack or (without msgpack) zlib-compressed json.
+# Entries are evicted least recently used first, by mtime, which is updated
+# whenever an entry is used.
+FORMAT_VERSION = 1
+ENTRY_SUFFIX = ".rec"
+MSGPACK = b"M"
+ZJSON = b"J"
+
+# after eviction, the cache is this fraction of its maximum size
+EVICT_TO = 0.9
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def dumps(record):
+    if msgpack is not None:
+        return MSGPACK + msgpack.packb(record, use_bin_type=True)
+    return ZJSON + zlib.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+
+
+def loads(blob):
+    tag = blob[0:1]
+    if tag == MSGPACK and msgpack is not None:
+        return msgpack.unpackb(blob[1:], raw=False)
+    if tag == ZJSON:
+        return json.loads(zlib.decompress(blob[1:]).decode("utf-8"))
+    raise RecordCacheException("Unreadable cache entry (format %r)" % tag)
+
+
+class RecordCache(object):
+    """
+    Size-bounded on-disk cache of parsed records, keyed by file path and
+    contents.  max_bytes is approximate: other processes' writes are only
+    counted when this one next scans the cache.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1073741824):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except Exception as err:
+            raise RecordCacheException("Unable to create record cache %s: %s" % (cache_dir, err))
+
+    def key(self, namespace, path, data):
+        """The cache key of the file at path with contents data."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(("%s\0%s\0%s\0" % (FORMAT_VERSION, namespace, path)).encode("utf-8"))
+        digest.update(content_hash(data).encode("ascii"))
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """Returns the cached record for key, or None."""
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as fc:
+                record = loads(fc.read())
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logger.warning("Discarding unreadable record cache entry %s: %s" % (entry, err))
+            self._remove(entry)
+            return None
+        try:
+            os.utime(entry)
+        except Exception:
+            pass
+        return record
+
+    def put(self, key, record):
+        entry = self._entry(key)
+        blob = dumps(record)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(entry), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fc:
+                    fc.write(blob)
+                os.replace(tmpfile, entry)
+            except Exception:
+                os.unlink(tmpfile)
+                raise
+        except Exception as err:
+            raise RecordCacheException("Unable to write record cache entry %s: %s" % (entry, err))
+        if self._total is None:
+            self.evict()
+        else:
+            self._total += len(blob)
+            if self._total > self.max_bytes:
+                self.evict()
+
+    def _remove(self, entry):
+        try:
+            os.unlink(entry)
+        except Exception:
+            pass
+
+    def evict(self):
+        """
+        Scans the cache, and if it's larger than max_bytes, removes the
+        least recently used entries until it's no more than EVICT_TO of it.
+        Returns the number of entries removed.
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(ENTRY_SUFFIX):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum([e[1] for e in entries])
+        removed = 0
+        if total > self.max_bytes:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                self._remove(path)
+                total -= size
+                removed += 1
+            logger.info("Evicted %s entries from record cache %s" % (removed, self.cache_dir))
+        self._total = total
+        return removed
+
+
+_record_cache = {"cache": None, "dir": None}
+
+
+def get_record_cache(cache_dir, max_bytes=1073741824):
+    """
+    Returns this process's RecordCache for cache_dir, or None if it can't
+    be used.
+    """
+    cache = _record_cache["cache"]
+    if cache is None or _record_cache["dir"] != cache_dir:
+        try:
+            cache = RecordCache(cache_dir, max_bytes=max_bytes)
+        except Exception as err:
+            logger.warning("Unable to use record cache: %s" % err)
+            return None
+        _record_cache["cache"] = cache
+        _record_cache["dir"] = cache_dir
+    cache.max_bytes = max_bytes
+    return cache
@@ -0,0 +1,92 @@
+import copy
+import os
+import threading
+
+# Objects that are costly to set up (parsers, bibcode generators) are made
+# once per worker process and thread, and reused for every record.  Before
+# an instance is reused, its attributes are put back as they were just
+# after it was made -- attributes added since are removed, and list, dict
+# and set attributes are replaced by fresh copies, however deeply they're
+# nested -- so that nothing left on it by one record (e.g. the metadata of
+# the last record parsed) leaks into the next.  Other objects held in them
+# are shared rather than copied.
+RESET_COPIED_TYPES = (dict, list, set)
+
+
+def _copy_containers(value, memo=None):
+    # copies value if it's a dict, list or set, along with any of these
+    # nested in it; other objects are shared
+    if not isinstance(value, RESET_COPIED_TYPES):
+        return value
+    if memo is None:
+        memo = {}
+    if id(value) in memo:
+        return memo[id(value)]
+    copied = memo[id(value)] = copy.copy(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            copied[k] = _copy_containers(v, memo)
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            copied[i] = _copy_containers(v, memo)
+    return copied
+
+
+class ReusableInstances(object):
+    """
+    One instance of each class per process and thread, made the first time
+    it's asked for, and reset to its initial state each time after that.
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _held(self):
+        if self._pid != os.getpid():
+            # in a child process, don't reuse what the parent made
+            self.reset()
+        held = getattr(self._local, "held", None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def get(self, cls, *args):
+        """
+        Returns this thread's instance of cls (made with args, which are
+        part of the key), reset to its initial state.
+        """
+        held = self._held()
+        key = (cls,) + args
+        if key not in held:
+            instance = cls(*args)
+            self.created += 1
+            if hasattr(instance, "__dict__"):
+                saved = dict([(k, _copy_containers(v)) for (k, v) in vars(instance).items()])
+                containers = frozenset(
+                    [k for (k, v) in saved.items() if isinstance(v, RESET_COPIED_TYPES)]
+                )
+                held[key] = (instance, saved, containers)
+            # else it can't be reset, so a new one is made every time
+            return instance
+        (instance, saved, containers) = held[key]
+        state = vars(instance)
+        for k in [k for k in state if k not in saved]:
+            del state[k]
+        for k, v in saved.items():
+            if k in containers:
+                state[k] = _copy_containers(v)
+            elif k not in state or state[k] is not v:
+                state[k] = v
+        self.reused += 1
+        return instance
+
+    def reset(self):
+        """Drops every instance made so far."""
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+
+instances = ReusableInstances()
@@ -0,0 +1,344 @@
+import json
+import os
+import random
+from xml.sax.saxutils import escape
+
+# Journals the synthetic Crossref records are published in:
+# (bibstem, print ISSN, electronic ISSN, title, related bibstem)
+JOURNALS = [
+    ("ApJ", "0004-637X", "1538-4357", "The Astrophysical Journal", "ApJL"),
+    (
+        "MNRAS",
+        "0035-8711",
+        "1365-2966",
+        "Monthly Notices of the Royal Astronomical Society",
+        "MNRAL",
+    ),
+    ("A&A", "0004-6361", "1432-0746", "Astronomy and Astrophysics", "A&AS"),
+    ("AJ", "0004-6256", "1538-3881", "The Astronomical Journal", "AJS"),
+    ("PhRvD", "2470-0010", "2470-0029", "Physical Review D", "PhRvL"),
+]
+# bibstem used for the classic side of mismatched records; it is not related
+# to any of JOURNALS, and no Crossref record generates it
+MISMATCH_BIBSTEM = "SYNTH"
+SURNAMES = ["Smith", "Zhang", "Garcia", "Muller", "Ito", "Okafor", "Rossi", "Novak", "Silva"]
+DOI_PREFIX = "10.5555"
+HARVEST_DATE = "2023-08-25"
+RECORDS_PER_LOG = 10000
+
+# The match type CrossrefMatcher should give each record, and what is put in
+# classic to make it do so:
+#   canonical: the record's bibcode, with its DOI
+#   alternate: a canonical bibcode with the record's DOI, and the record's
+#              bibcode as its alternate
+#   deleted:   as alternate, with the record's bibcode as a deleted bibcode
+#   partial:   a canonical bibcode with the record's DOI, differing from the
+#              record's bibcode in author initial, qualifier or (related)
+#              bibstem
+#   mismatch:  a bibcode in an unrelated journal with the record's DOI
+#   unmatched: nothing
+#   failed:    nothing, and the record's xml has no DOI
+MATCHTYPES = ["canonical", "alternate", "deleted", "partial", "mismatch", "unmatched", "failed"]
+DEFAULT_RATES = {
+    "canonical": 0.6,
+    "alternate": 0.1,
+    "deleted": 0.05,
+    "partial": 0.1,
+    "mismatch": 0.05,
+    "unmatched": 0.1,
+    "failed": 0.0,
+}
+
+CROSSREF_TEMPLATE = (
+    "<record> <header> <identifier>info:doi/%(doi)s</identifier> "
+    "<datestamp>%(date)s</datestamp> </header> <metadata> "
+    '<crossref xmlns="http://www.crossref.org/xschema/1.1"> <journal><journal_metadata>'
+    "<full_title>%(journal)s</full_title>"
+    '<issn media_type="print">%(issn_print)s</issn>'
+    '<issn media_type="electronic">%(issn_elec)s</issn></journal_metadata><journal_issue>'
+    '<publication_date media_type="online"><year>%(year)s</year></publication_date>'
+    "<journal_volume><volume>%(volume)s</volume></journal_volume></journal_issue>"
+    '<journal_article publication_type="full_text"><titles><title>%(title)s</title>'
+    "</titles><contributors>"
+    '<person_name sequence="first" contributor_role="author"><given_name>%(given)s'
+    "</given_name><surname>%(surname)s</surname></person_name></contributors>"
+    '<publication_date media_type="online"><year>%(year)s</year></publication_date>'
+    "<pages><first_page>%(page)s</first_page></pages>%(doi_data)s"
+    "</journal_article></journal> </crossref> </metadata> </record>"
+)
+
+
+def make_bibcode(year, bibstem, volume, page, initial, qualifier="."):
+    return "%s%s%s%s%s%s" % (
+        year,
+        bibstem.ljust(5, "."),
+        str(volume).rjust(4, "."),
+        qualifier,
+        str(page).rjust(4, "."),
+        initial,
+    )
+
+
+def normalize_rates(rates=None):
+    """
+    Returns a full set of match type rates summing to 1, from a dict giving
+    the relative rates of some or all of MATCHTYPES.
+    """
+    if rates is None:
+        rates = DEFAULT_RATES
+    for k in rates:
+        if k not in MATCHTYPES:
+            raise ValueError("Unknown match type %s" % k)
+    total = float(sum([rates.get(k, 0.0) for k in MATCHTYPES]))
+    if total <= 0:
+        raise ValueError("Match type rates must add up to more than zero")
+    return dict([(k, rates.get(k, 0.0) / total) for k in MATCHTYPES])
+
+
+class SyntheticCorpus(object):
+    """
+    A reproducible set of synthetic Crossref records and the classic data to
+    match them against, with each record assigned one of MATCHTYPES at the
+    given rates.  Records are generated on demand from their index and the
+    seed, so that corpora of millions of records can be written out without
+    holding them in memory.
+    """
+
+    def __init__(self, nrecords, rates=None, seed=42):
+        self.nrecords = nrecords
+        self.rates = normalize_rates(rates)
+        self.seed = seed
+        self._thresholds = []
+        cumulative = 0.0
+        for k in MATCHTYPES:
+            cumulative += self.rates[k]
+            self._thresholds.append((cumulative, k))
+
+    def matchtype(self, i):
+        # a low-discrepancy sequence keeps the counts of each match type
+        # within one or two of their expected values at any corpus size
+        u = (i * 0.6180339887498949 + self.seed * 0.7548776662466927) % 1.0
+        for threshold, k in self._thresholds:
+            if u < threshold:
+                return k
+        return self._thresholds[-1][1]
+
+    def record(self, i):
+        """
+        Returns record i as a dict with its intended matchtype, its doi,
+        the bibcode generated from its metadata (bibcode), the classic
+        bibcode its DOI maps to (classic_bibcode, or None), and the classic
+        alt_identifiers rows created for it (classic_rows).
+        """
+        rng = random.Random(self.seed * 1000003 + i)
+        (bibstem, issn_print, issn_elec, journal, related) = JOURNALS[i % len(JOURNALS)]
+        serial = i // len(JOURNALS)
+        volume = 100 + serial // 5000
+        page = 1 + serial % 5000
+        year = 1980 + (volume - 100) % 45
+        surname = rng.choice(SURNAMES)
+        bibcode = make_bibcode(year, bibstem, volume, page, surname[0])
+        matchtype = self.matchtype(i)
+        rec = {
+            "index": i,
+            "matchtype": matchtype,
+            "doi": "%s/synth.%s" % (DOI_PREFIX, i),
+            "bibcode": bibcode,
+            "bibstem": bibstem,
+            "issn_print": issn_print,
+            "issn_elec": issn_elec,
+            "journal": journal,
+            "year": year,
+            "volume": volume,
+            "page": page,
+            "surname": surname,
+            "classic_bibcode": None,
+            "classic_rows": [],
+        }
+        if matchtype == "canonical":
+            rec["classic_bibcode"] = bibcode
+            rec["classic_rows"] = [(bibcode, bibcode, "canonical")]
+        elif matchtype in ["alternate", "deleted"]:
+            canonical = make_bibcode(year, bibstem, volume, page, surname[0], qualifier="L")
+            rec["classic_bibcode"] = canonical
+            rec["classic_rows"] = [
+                (canonical, canonical, "canonical"),
+                (bibcode, canonical, matchtype),
+            ]
+        elif matchtype == "partial":
+            variant = i % 3
+            if variant == 0:
+                initial = chr(ord("A") + (ord(surname[0]) - ord("A") + 1) % 26)
+                canonical = make_bibcode(year, bibstem, volume, page, initial)
+            elif variant == 1:
+                canonical = make_bibcode(year, bibstem, volume, page, surname[0], qualifier="E")
+            else:
+                canonical = make_bibcode(year, related, volume, page, surname[0])
+            rec["classic_bibcode"] = canonical
+            rec["classic_rows"] = [(canonical, canonical, "canonical")]
+        elif matchtype == "mismatch":
+            # the qualifier keeps the journals' mismatches apart
+            canonical = make_bibcode(
+                year,
+                MISMATCH_BIBSTEM,
+                volume,
+                page,
+                surname[0],
+                qualifier="ABCDEFGHIJ"[i % len(JOURNALS)],
+            )
+            rec["classic_bibcode"] = canonical
+            rec["classic_rows"] = [(canonical, canonical, "canonical")]
+        return rec
+
+    def records(self):
+        for i in range(self.nrecords):
+            yield self.record(i)
+
+    def harvest_path(self, rec):
+        # path of the record's xml relative to HARVEST_BASE_DIR
+        i = rec["index"]
+        return "doi/%s/synth/%s/%s/metadata.xml" % (DOI_PREFIX, i // 1000, i)
+
+    def crossref_xml(self, rec):
+        if rec["matchtype"] == "failed":
+            doi_data = ""
+        else:
+            doi_data = (
+                "<doi_data><doi>%s</doi><resource>https://example.org/%s</resource></doi_data>"
+                % (
+                    escape(rec["doi"]),
+                    escape(rec["doi"]),
+                )
+            )
+        values = dict([(k, escape(str(v))) for (k, v) in rec.items() if k != "classic_rows"])
+        values.update(
+            {
+                "date": HARVEST_DATE,
+                "title": "Synthetic paper %s" % rec["index"],
+                "given": "A.",
+                "doi_data": doi_data,
+            }
+        )
+        return CROSSREF_TEMPLATE % values
+
+    def match_cases(self):
+        """
+        Yields (xrefBibcode, classicDoiMatches, classicBibMatches) for each
+        record, as task_process_meta would find them in classic.
+        """
+        for rec in self.records():
+            doiRows = []
+            if rec["classic_bibcode"]:
+                doiRows = [r for r in rec["classic_rows"] if r[1] == rec["classic_bibcode"]]
+            bibRows = [r for r in rec["classic_rows"] if r[0] == rec["bibcode"]]
+            yield rec["bibcode"], doiRows, bibRows
+
+    def master_rows(self):
+        """Yields a master table mapping for each record's expected result."""
+        for rec in self.records():
+            matchtype = rec["matchtype"]
+            if matchtype == "failed":
+                status = "Failed"
+            elif matchtype in ["mismatch", "unmatched"]:
+                status = "Unmatched"
+            else:
+                status = "Matched"
+            yield {
+                "harvest_filepath": self.harvest_path(rec),
+                "master_doi": rec["doi"],
+                "issns": json.dumps({"electronic": rec["issn_elec"]}),
+                "db_origin": "Crossref",
+                "master_bibdata": "{}",
+                "classic_match": "{}",
+                "status": status,
+                "matchtype": matchtype,
+                "bibcode_meta": rec["bibcode"],
+                "bibcode_classic": rec["classic_bibcode"] or "",
+                "notes": "",
+            }
+
+    def write_classic_files(self, outdir):
+        """
+        Writes all.links, bibcodes.list.{can,alt,del,all}, the ISSN-bibstem
+        map and the related bibstems file to outdir, and returns their paths
+        keyed by their config variable names.
+        """
+        os.makedirs(outdir, exist_ok=True)
+        files = {
+            "CLASSIC_DOI_FILE": os.path.join(outdir, "all.links"),
+            "CLASSIC_CANONICAL": os.path.join(outdir, "bibcodes.list.can"),
+            "CLASSIC_ALTBIBS": os.path.join(outdir, "bibcodes.list.alt"),
+            "CLASSIC_DELBIBS": os.path.join(outdir, "bibcodes.list.del"),
+            "CLASSIC_ALLBIBS": os.path.join(outdir, "bibcodes.list.all"),
+            "JOURNALSDB_ISSN_BIBSTEM": os.path.join(outdir, "issn_identifiers"),
+            "JOURNALSDB_RELATED_BIBSTEMS": os.path.join(outdir, "related_bibstems.json"),
+        }
+        fl = open(files["CLASSIC_DOI_FILE"], "w")
+        fc = open(files["CLASSIC_CANONICAL"], "w")
+        fa = open(files["CLASSIC_ALTBIBS"], "w")
+        fd = open(files["CLASSIC_DELBIBS"], "w")
+        fall = open(files["CLASSIC_ALLBIBS"], "w")
+        try:
+            for rec in self.records():
+                if rec["classic_bibcode"]:
+                    fl.write("%s\t%s\n" % (rec["classic_bibcode"], rec["doi"]))
+                for identifier, canonical, idtype in rec["classic_rows"]:
+                    fall.write("%s\t%s\n" % (identifier, canonical))
+                    if idtype == "canonical":
+                        fc.write("%s\n" % identifier)
+                    elif idtype == "alternate":
+                        fa.write("%s\t%s\n" % (identifier, canonical))
+                    elif idtype == "deleted":
+                        fd.write("%s\t%s\n" % (identifier, canonical))
+        finally:
+            for f in [fl, fc, fa, fd, fall]:
+                f.close()
+        with open(files["JOURNALSDB_ISSN_BIBSTEM"], "w") as fi:
+            for bibstem, issn_print, issn_elec, journal, related in JOURNALS:
+                fi.write("%s\tISSN_print\t%s\n" % (bibstem, issn_print))
+                fi.write("%s\tISSN_electronic\t%s\n" % (bibstem, issn_elec))
+        with open(files["JOURNALSDB_RELATED_BIBSTEMS"], "w") as fj:
+            related = [[j[0].ljust(5, "."), j[4].ljust(5, ".")] for j in JOURNALS]
+            json.dump({"related_bibstems": related}, fj)
+        return files
+
+    def write_harvest(self, harvest_dir, limit=None):
+        """
+        Writes the Crossref xml files of the first limit records (or all of
+        them) under harvest_dir, as the OAIPMH harvester would, with
+        UpdateAgent logs listing them in harvest_dir/UpdateAgent/.  Returns
+        the HARVEST_BASE_DIR and HARVEST_LOG_DIR config values to use.
+        """
+        harvest_dir = os.path.join(harvest_dir, "")
+        log_dir = os.path.join(harvest_dir, "UpdateAgent", "")
+        os.makedirs(log_dir, exist_ok=True)
+        nrecords = self.nrecords if limit is None else min(limit, self.nrecords)
+        flog = None
+        try:
+            for i in range(nrecords):
+                rec = self.record(i)
+                if i % RECORDS_PER_LOG == 0:
+                    if flog:
+                        flog.close()
+                    logname = "%s:%s.out.%s" % (DOI_PREFIX, i // RECORDS_PER_LOG, HARVEST_DATE)
+                    flog = open(os.path.join(log_dir, logname), "w")
+                relpath = self.harvest_path(rec)
+                xmlfile = os.path.join(harvest_dir, relpath)
+                if i % 1000 == 0 or not os.path.isdir(os.path.dirname(xmlfile)):
+                    os.makedirs(os.path.dirname(xmlfile), exist_ok=True)
+                with open(xmlfile, "w") as fx:
+                    fx.write(self.crossref_xml(rec))
+                flog.write("%s\t%sT05:06:42\n" % (relpath, HARVEST_DATE))
+        finally:
+            if flog:
+                flog.close()
+        return {"HARVEST_BASE_DIR": harvest_dir, "HARVEST_LOG_DIR": log_dir}
+
+    def write_all(self, outdir, xml_limit=None):
+        """
+        Writes the classic files and the Crossref harvest under outdir, and
+        returns the config values pointing the pipeline at them.
+        """
+        files = self.write_classic_files(os.path.join(outdir, "classic"))
+        files.update(self.write_harvest(os.path.join(outdir, "Crossref"), limit=xml_limit))
+        return files
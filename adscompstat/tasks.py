@@ -1,14 +1,28 @@
 import json
 import math
 import os
+import time
+import uuid
+from contextlib import contextmanager
 
-from adsenrich.bibcodes import BibcodeGenerator
+from celery.signals import worker_process_init, worker_process_shutdown
 from kombu import Queue
 
 from adscompstat import app as app_module
+from adscompstat import bibcode_memo
+from adscompstat import bloom as classic_bloom
+from adscompstat import classic_store
 from adscompstat import database as db
-from adscompstat import utils
-from adscompstat.match import CrossrefMatcher
+from adscompstat import (
+    harvest_archive,
+    prefetch,
+    profiling,
+    record_cache,
+    reusable,
+    utils,
+)
+from adscompstat.match import CandidateIndex, CrossrefMatcher
+from adscompstat.metrics import BatchMetrics, remove_prometheus_file
 
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
 app = app_module.ADSCompStatCelery(
@@ -26,17 +40,343 @@ app.conf.CELERY_QUEUES = (
     Queue("compute-stats", app.exchange, routing_key="compute-stats"),
 )
 
-related_bibstems = []
-related_bibs_file = app.conf.get("JOURNALSDB_RELATED_BIBSTEMS", None)
-if related_bibs_file:
+# CrossrefMatcher is reused across records and batches by each worker
+# process, and is rebuilt only if the related bibstems file changes on disk
+_matcher_cache = {"matcher": None, "filename": None, "mtime": None}
+_parser_version_cache = {"version": None}
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """
+    Makes the objects each worker process reuses across tasks -- the bibcode
+    generator, the xml parser and the matcher -- when the process starts,
+    rather than during its first batch.
+    """
+    reusable.instances.reset()
+    try:
+        _get_bibcode_generator()
+        utils.get_crossref_parser()
+        _get_matcher()
+    except Exception as err:
+        logger.warning("Unable to set up worker process: %s" % err)
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """
+    Removes the process's Prometheus metrics file as it exits, so that its
+    totals stop being exported.
+    """
+    metrics_dir = app.conf.get("METRICS_DIR", None)
+    if metrics_dir:
+        try:
+            remove_prometheus_file(metrics_dir)
+        except Exception as err:
+            logger.warning("Unable to remove metrics file: %s" % err)
+
+
+def _get_bibcode_generator():
+    # adsenrich is imported on first use, as it's slow to import and only
+    # process-meta workers need it
+    from adsenrich.bibcodes import BibcodeGenerator
+
+    return reusable.instances.get(BibcodeGenerator)
+
+
+def _load_related_bibstems(related_bibs_file):
+    related_bibstems = []
     try:
         with open(related_bibs_file, "r") as fj:
             data = json.load(fj)
             related_bibstems = data.get("related_bibstems", [])
     except Exception as err:
         logger.warning("Unable to load related bibstems list: %s" % err)
-else:
-    logger.warning("Related bibstems filename not set.")
+    return related_bibstems
+
+
+def _get_matcher():
+    related_bibs_file = app.conf.get("JOURNALSDB_RELATED_BIBSTEMS", None)
+    mtime = None
+    if related_bibs_file:
+        try:
+            mtime = os.path.getmtime(related_bibs_file)
+        except Exception as err:
+            logger.debug("Unable to stat related bibstems file: %s" % err)
+    if (
+        _matcher_cache["matcher"] is None
+        or _matcher_cache["filename"] != related_bibs_file
+        or _matcher_cache["mtime"] != mtime
+    ):
+        if related_bibs_file:
+            related_bibstems = _load_related_bibstems(related_bibs_file)
+        else:
+            logger.warning("Related bibstems filename not set.")
+            related_bibstems = []
+        _matcher_cache["matcher"] = CrossrefMatcher(related_bibstems=related_bibstems)
+        _matcher_cache["filename"] = related_bibs_file
+        _matcher_cache["mtime"] = mtime
+    return _matcher_cache["matcher"]
+
+
+def _get_candidate_index(store=None):
+    # near-miss candidates are looked up a volume at a time as needed, in the
+    # classic store if there is one and otherwise in the database
+    if not app.conf.get("FUZZY_MATCH_UNMATCHED", False):
+        return None
+    if store:
+        return CandidateIndex(store.lookup_prefixes)
+    return CandidateIndex(lambda prefixes: db.query_candidate_bibcodes(app, prefixes))
+
+
+def _get_classic_store():
+    store_file = app.conf.get("CLASSIC_STORE_FILE", None)
+    if store_file:
+        return classic_store.get_classic_store(store_file)
+    return None
+
+
+def _get_bloom_filter():
+    bloom_file = app.conf.get("CLASSIC_BLOOM_FILE", None)
+    if bloom_file:
+        return classic_bloom.get_bloom_filter(bloom_file)
+    return None
+
+
+def _bloom_lookup(bloom, doi, bibcode, metrics):
+    """
+    Blanks out the DOI and/or bibcode of a classic lookup if the bloom
+    filter shows that classic doesn't have them, so they aren't queried.
+    """
+    skip_doi = bool(doi) and not bloom.may_contain_doi(doi)
+    skip_bibcode = bool(bibcode) and not bloom.may_contain_bibcode(bibcode)
+    metrics.bloom_check(skip_doi, skip_bibcode)
+    return ("" if skip_doi else doi), ("" if skip_bibcode else bibcode)
+
+
+def _query_classic_bibcodes(store, doi, bibcode, bloom=None, metrics=None):
+    if store:
+        return store.query_classic_bibcodes(doi, bibcode)
+    if bloom:
+        (doi, bibcode) = _bloom_lookup(bloom, doi, bibcode, metrics)
+        if not doi and not bibcode:
+            return [], []
+    return db.query_classic_bibcodes(app, doi, bibcode)
+
+
+def _configure_harvest_archive():
+    # where to look for harvested files that are bundled (by default, nowhere)
+    harvest_archive.configure(
+        app.conf.get("HARVEST_BASE_DIR", "/"),
+        bundle_dir=app.conf.get("HARVEST_BUNDLE_DIR", None),
+        depth=app.conf.get("HARVEST_BUNDLE_DEPTH", None),
+    )
+
+
+def _get_record_cache():
+    cache_dir = app.conf.get("PARSED_RECORD_CACHE_DIR", None)
+    if cache_dir:
+        return record_cache.get_record_cache(
+            cache_dir, max_bytes=app.conf.get("PARSED_RECORD_CACHE_MAX_BYTES", 1073741824)
+        )
+    return None
+
+
+def _parser_version():
+    # the installed parser's version, so that cached records aren't reused
+    # after it's upgraded
+    if _parser_version_cache["version"] is None:
+        from importlib import metadata
+
+        try:
+            _parser_version_cache["version"] = metadata.version("adsingestp")
+        except Exception as err:
+            logger.debug("Unable to get the parser version: %s" % err)
+            _parser_version_cache["version"] = "unknown"
+    return _parser_version_cache["version"]
+
+
+def _get_bibcode_memo():
+    maxsize = app.conf.get("BIBCODE_MEMO_SIZE", None)
+    if maxsize:
+        return bibcode_memo.get_bibcode_memo(
+            maxsize,
+            issn_file=app.conf.get("JOURNALSDB_ISSN_BIBSTEM", None),
+            max_age=app.conf.get("BIBCODE_MEMO_MAX_AGE", None),
+        )
+    return None
+
+
+def _bibcode_from_memo(memo, ingestRecord, metrics):
+    # returns the memo key of a record and its memoized (bibstem, bibcode),
+    # or None; the key is None if there's no memo
+    if memo is None or not ingestRecord:
+        return None, None
+    key = bibcode_memo.memo_key(ingestRecord)
+    memoized = memo.get(key)
+    metrics.bibcode_memo_lookup(memoized is not None)
+    return key, memoized
+
+
+def _memoize_bibcode(memo, key, bibstem, bibcode):
+    # a bibstem lookup that failed gives an empty bibstem, so only complete
+    # results are kept
+    if key is not None and bibstem and bibcode:
+        memo.put(key, bibstem, bibcode)
+
+
+def _get_async_db():
+    if not app.conf.get("ASYNC_DB", False):
+        return None
+    try:
+        # imported here, so that workers that don't use it (and the CLI)
+        # don't load SQLAlchemy's asyncio extension
+        from adscompstat import database_async
+
+        return database_async.get_async_db(
+            app.conf.get("SQLALCHEMY_URL"),
+            pool_size=app.conf.get("ASYNC_DB_POOL_SIZE", 5),
+            max_overflow=app.conf.get("ASYNC_DB_MAX_OVERFLOW", 0),
+            concurrency=app.conf.get("ASYNC_DB_CONCURRENCY", None),
+        )
+    except Exception as err:
+        logger.warning("Unable to use async database access, using sync: %s" % err)
+        return None
+
+
+def _pool_stats():
+    try:
+        return dict(app.pool_stats())
+    except Exception as err:
+        logger.debug("Unable to get connection pool stats: %s" % err)
+
+
+def _make_batches(infiles):
+    """
+    Splits a list of xml files into batches for task_process_meta, and
+    yields each with the total size of its files (or None if batch timings
+    aren't being recorded, when the files aren't sized).  Batches never
+    hold more than RECORDS_PER_BATCH files; if BATCH_TARGET_SECONDS is set
+    and a cost model has been fitted from previous batches, each batch is
+    closed once its estimated processing time reaches the target, otherwise
+    if BATCH_TARGET_BYTES is set, once its files reach that size.
+    """
+    batch_count = app.conf.get("RECORDS_PER_BATCH", 100)
+    target = None
+    per_record = 0.0
+    per_byte = 1.0
+    target_seconds = app.conf.get("BATCH_TARGET_SECONDS", None)
+    if target_seconds:
+        model = utils.load_batch_cost_model(app.conf.get("BATCH_COST_MODEL_FILE", None))
+        if model:
+            target = target_seconds
+            per_record = model.get("per_record", 0.0)
+            per_byte = model.get("per_byte", 0.0)
+    if target is None:
+        target = app.conf.get("BATCH_TARGET_BYTES", None)
+    # the sizes are passed on to the batches' tasks for _record_batch_timing
+    sized = bool(target or target_seconds)
+
+    batch = []
+    batch_cost = 0.0
+    batch_bytes = 0
+    for infile in infiles:
+        batch.append(infile)
+        if sized:
+            size = utils.get_file_size(infile)
+            batch_bytes += size
+            batch_cost += per_record + per_byte * size
+        if len(batch) == batch_count or (target and batch_cost >= target):
+            yield batch, batch_bytes if sized else None
+            batch = []
+            batch_cost = 0.0
+            batch_bytes = 0
+    if len(batch):
+        yield batch, batch_bytes if sized else None
+
+
+def _record_batch_timing(infile_batch, elapsed, nbytes=None):
+    # nbytes, the batch's size from _make_batches, saves sizing its files again
+    statefile = app.conf.get("BATCH_COST_MODEL_FILE", None)
+    if statefile and (
+        app.conf.get("BATCH_TARGET_SECONDS", None) or app.conf.get("BATCH_TARGET_BYTES", None)
+    ):
+        try:
+            if nbytes is None:
+                nbytes = sum([utils.get_file_size(f) for f in infile_batch])
+            utils.update_batch_cost_model(
+                statefile,
+                len(infile_batch),
+                nbytes,
+                elapsed,
+                decay=app.conf.get("BATCH_COST_MODEL_DECAY", 0.95),
+            )
+        except Exception as err:
+            logger.warning("Unable to record batch timing: %s" % err)
+
+
+def _dispatch_batches(batches, run_id, logfile, fast_parse=None):
+    # sends (batch, size) pairs from _make_batches to task_process_meta,
+    # first recording them in run_status if they're part of a tracked run.
+    # The batches are all published with one producer from the app's pool,
+    # so over one broker connection and channel, instead of each delay()
+    # acquiring its own.
+    options = {"fast_parse": fast_parse} if fast_parse is not None else {}
+    if run_id:
+        try:
+            db.write_run_batches(app, run_id, logfile, [len(b) for (b, nbytes) in batches])
+        except Exception as err:
+            logger.warning("Unable to record batches of run %s: %s" % (run_id, err))
+    if not batches:
+        return
+    start = time.perf_counter()
+    max_publish = 0.0
+    with app.producer_or_acquire() as producer:
+        for i, (batch, nbytes) in enumerate(batches):
+            logger.debug("Calling task_process_meta with batch '%s'" % batch)
+            args = (batch, run_id, logfile, i) if run_id else (batch,)
+            kwargs = dict(options, batch_bytes=nbytes) if nbytes is not None else options
+            t0 = time.perf_counter()
+            task_process_meta.apply_async(args=args, kwargs=kwargs, producer=producer)
+            max_publish = max(max_publish, time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    dispatch = {
+        "logfile": logfile,
+        "batches": len(batches),
+        "records": sum([len(b) for (b, nbytes) in batches]),
+        "elapsed_ms": round(elapsed * 1000.0, 3),
+        "batches_per_sec": round(len(batches) / elapsed, 1) if elapsed > 0 else 0.0,
+        "max_publish_ms": round(max_publish * 1000.0, 3),
+    }
+    logger.info("process-meta dispatch metrics: %s" % json.dumps(dispatch, sort_keys=True))
+
+
+def retry_label(rec_type):
+    # the run_status logfile name used for retried records
+    return "retry:%s" % rec_type
+
+
+def task_start_run(logfiles):
+    """
+    Starts tracking a run over the given logfiles (or other labels for the
+    work being dispatched) in run_status, and returns its run id.
+    """
+    run_id = "%s-%s" % (time.strftime("%Y%m%dT%H%M%S", time.gmtime()), uuid.uuid4().hex[0:8])
+    try:
+        db.write_run_logfiles(app, run_id, logfiles)
+    except Exception as err:
+        logger.warning("Unable to start tracking run %s: %s" % (run_id, err))
+    return run_id
+
+
+def task_get_run_status(run_id=None):
+    try:
+        if not run_id:
+            run_id = db.query_latest_run_id(app)
+        if run_id:
+            return db.query_run_status(app, run_id)
+    except Exception as err:
+        logger.warning("Unable to get run status: %s" % err)
 
 
 def task_clear_classic_data():
@@ -54,20 +394,27 @@ def task_write_block(table, datablock):
 
 
 @app.task(queue="write-db")
-def task_write_matched_record_to_db(record):
+def task_write_matched_record_to_db(record, run_id=None, logfile=None, batch=None):
+    # if the record's batch is part of a tracked run, the record is moved
+    # from the batch's queued count to its processed or failed count
     if record:
-        doi = record[1]
+        failed = 0
         try:
-            result = db.query_master_by_doi(app, doi)
-            db.write_matched_record(app, result, record)
+            db.write_matched_record(app, record)
         except Exception as err:
             logger.error("write_matched_record failed: %s" % err)
+            failed = 1
+        if run_id:
+            try:
+                db.update_run_batch(app, run_id, logfile, batch, 1 - failed, failed, queued=-1)
+            except Exception as err:
+                logger.warning("Unable to update run %s batch %s: %s" % (run_id, batch, err))
     else:
         logger.warning("Null record passed to write_matched_record")
 
 
 @app.task(queue="get-logfiles")
-def task_process_logfile(infile):
+def task_process_logfile(infile, run_id=None, fast_parse=None):
     """
     Parse one oaipmh harvesting logfile to retrieve newly downloaded records,
     and forward batches of those records to task_process_meta().  The filename
@@ -76,173 +423,441 @@ def task_process_logfile(infile):
 
     Parameters:
     infile (string): path to one logfile
+    run_id (string): optional id of the run_status run tracking this logfile
+    fast_parse (bool): optionally overrides FAST_PARSE for these records
     """
 
-    batch_count = app.conf.get("RECORDS_PER_BATCH", 100)
     try:
+        _configure_harvest_archive()
         files_to_process = utils.read_updateagent_log(infile)
-        batch = []
-        for xmlFile in files_to_process:
-            xmlFilePath = app.conf.get("HARVEST_BASE_DIR", "/") + xmlFile
-            batch.append(xmlFilePath)
-            if len(batch) == batch_count:
-                logger.debug("Calling task_process_meta with batch '%s'" % batch)
-                task_process_meta.delay(batch)
-                batch = []
-        if len(batch):
-            logger.debug("Calling task_process_meta with batch '%s'" % batch)
-            task_process_meta.delay(batch)
+        harvest_dir = app.conf.get("HARVEST_BASE_DIR", "/")
+        files_to_process = [harvest_dir + xmlFile for xmlFile in files_to_process]
+        _dispatch_batches(
+            list(_make_batches(files_to_process)), run_id, infile, fast_parse=fast_parse
+        )
     except Exception as err:
         logger.warning("Error processing logfile %s: %s" % (infile, err))
+        if run_id:
+            try:
+                db.fail_run_logfile(app, run_id, infile)
+            except Exception as err:
+                logger.warning(
+                    "Unable to mark logfile %s of run %s as failed: %s" % (infile, run_id, err)
+                )
+
+
+def _failed_record(infile, processedRecord, notes):
+    # placeholder master record for a file that couldn't be parsed or matched
+    return (
+        infile,
+        processedRecord.get("master_doi", ""),
+        json.dumps(processedRecord.get("issns", {})),
+        json.dumps(processedRecord.get("master_bibdata", {})),
+        json.dumps({}),
+        "Failed",
+        "failed",
+        "",
+        "",
+        notes,
+    )
+
+
+def _matched_record(infile, processedRecord, bibcode, xmatchResult):
+    # create a postgres-ready record with matching result for the record in infile
+    if xmatchResult:
+        matchtype = xmatchResult.get("match", "")
+        if matchtype in [
+            "canonical",
+            "deleted",
+            "alternate",
+            "partial",
+            "other",
+            "mismatch",
+        ]:
+            status = "Matched"
+        else:
+            status = "Unmatched"
+        if matchtype == "Classic Canonical Bibcode":
+            matchtype = "other"
+        classic_match = xmatchResult.get("errs", {})
+        classic_bibcode = xmatchResult.get("bibcode", "")
+    else:
+        status = "NoIndex"
+        matchtype = "other"
+        classic_match = {}
+        classic_bibcode = ""
+    return (
+        infile,
+        processedRecord.get("master_doi", ""),
+        json.dumps(processedRecord.get("issns", {})),
+        json.dumps(processedRecord.get("master_bibdata", {})),
+        json.dumps(classic_match),
+        status,
+        matchtype,
+        bibcode,
+        classic_bibcode,
+        "",
+    )
+
+
+def _changed_records(records, metrics):
+    # drops the records whose master rows are already up to date, counting
+    # them as unchanged; if the stored hashes can't be read, keeps them all
+    try:
+        hashes = db.query_master_hashes(app, [r[1] for r in records])
+    except Exception as err:
+        logger.warning("Unable to check for unchanged records: %s" % err)
+        return records
+    changed = [r for r in records if hashes.get(r[1]) != db.record_hash(r)]
+    metrics.unchanged += len(records) - len(changed)
+    return changed
+
+
+@contextmanager
+def _read_ahead(infile_batch, metrics):
+    """
+    Yields a function that returns the contents of the i'th file of the
+    batch if it has been read ahead, or else None.  Files are read ahead
+    only if PREFETCH_DEPTH is set; the time spent waiting for them is the
+    batch's "read" stage.
+    """
+    depth = app.conf.get("PREFETCH_DEPTH", None)
+    if not depth:
+        yield lambda i: None
+        return
+    reader = prefetch.ReadAhead(
+        infile_batch,
+        depth=depth,
+        max_bytes=app.conf.get("PREFETCH_MAX_BYTES", 67108864),
+        threads=app.conf.get("PREFETCH_THREADS", None),
+    )
+
+    def read(i):
+        with metrics.stage("read"):
+            return reader.get(i)
+
+    try:
+        with reader:
+            yield read
+    finally:
+        metrics.prefetch = reader.stats
+
+
+def _parse_record(infile, metrics, fast_parse=False, data=None):
+    # returns (processedRecord, None) for a parsed xml file, or (None, a
+    # placeholder master record) if it couldn't be parsed
+    parse = utils.process_one_meta_xml_fast if fast_parse else utils.process_one_meta_xml
+    cache = _get_record_cache()
+    cache_key = None
+    try:
+        with metrics.stage("parse"):
+            if cache:
+                (cache_key, data, processedRecord) = _cached_record(
+                    cache, infile, fast_parse, data
+                )
+                metrics.record_cache_lookup(processedRecord is not None)
+                if processedRecord is not None:
+                    return processedRecord, None
+            if data is not None:
+                processedRecord = parse(infile, data=data)
+            else:
+                processedRecord = parse(infile)
+    except Exception as err:
+        logger.warning("Parsing failed for %s: %s" % (infile, err))
+        metrics.failure("parse", type(err).__name__)
+        return None, _failed_record(infile, {}, str(err))
+    parsestatus = processedRecord.get("status", "")
+    # If there's a status field, it means processing failed and
+    # you need to write a placeholder record for the file.
+    if parsestatus:
+        metrics.failure("parse", parsestatus)
+        return None, _failed_record(infile, processedRecord, parsestatus)
+    if cache_key:
+        try:
+            cache.put(cache_key, processedRecord)
+        except Exception as err:
+            logger.warning("Unable to cache parsed record for %s: %s" % (infile, err))
+    return processedRecord, None
+
+
+def _cached_record(cache, infile, fast_parse, data):
+    """
+    Looks up a file's parsed record in the record cache, reading the file
+    to hash it if it hasn't been read ahead.  Returns the cache key (or None
+    if the file couldn't be read), the file's contents, and the cached
+    processedRecord or None.
+    """
+    if data is None:
+        try:
+            data = prefetch.read_harvest_file(infile)
+        except Exception as err:
+            # left for the parser to report
+            logger.debug("Unable to read %s for the record cache: %s" % (infile, err))
+            return None, None, None
+    namespace = "%s:%s:%s" % (
+        "fast" if fast_parse else "full",
+        utils.PROCESSED_RECORD_VERSION,
+        _parser_version(),
+    )
+    cache_key = cache.key(namespace, infile, data)
+    return cache_key, data, cache.get(cache_key)
+
+
+def _prepare_batch(infile_batch, bibgen, store, metrics, bloom=None, fast_parse=False, memo=None):
+    """
+    Parses each file of a batch, makes its bibcode and looks up its classic
+    candidates, one record at a time.  Returns the batch's master records
+    (None for those still to be matched), the (index, infile,
+    processedRecord, bibcode) of the records to match, and their classic
+    candidates by DOI and by bibcode.  Classic lookups that the bloom filter
+    shows would find nothing are skipped, as are the bibstem lookup and
+    bibcode generation of records whose bibliographic fields are in memo.
+    """
+    matchedRecords = []
+    toMatch = []
+    bibcodesFromDoiList = []
+    bibcodesFromBibList = []
+    with _read_ahead(infile_batch, metrics) as read_ahead:
+        for i, infile in enumerate(infile_batch):
+            metrics.start_record(infile)
+            (processedRecord, failedRecord) = _parse_record(
+                infile, metrics, fast_parse=fast_parse, data=read_ahead(i)
+            )
+            if failedRecord:
+                metrics.end_record()
+                matchedRecords.append(failedRecord)
+                continue
+            try:
+                ingestRecord = processedRecord.get("record", "")
+                with metrics.stage("bibcode"):
+                    (memoKey, memoized) = _bibcode_from_memo(memo, ingestRecord, metrics)
+                if memoized:
+                    bibcode = memoized[1]
+                else:
+                    with metrics.stage("bibstem"):
+                        bibstem = db.query_bibstem(app, ingestRecord)
+                    with metrics.stage("bibcode"):
+                        bibcode = bibgen.make_bibcode(ingestRecord, bibstem=bibstem)
+                        _memoize_bibcode(memo, memoKey, bibstem, bibcode)
+                doi = processedRecord.get("master_doi", "")
+                with metrics.stage("classic"):
+                    (bibcodesFromDoi, bibcodesFromBib) = _query_classic_bibcodes(
+                        store, doi, bibcode, bloom=bloom, metrics=metrics
+                    )
+            except Exception as err:
+                logger.warning("Crossref matching failed for %s: %s" % (infile, err))
+                metrics.failure("lookup", type(err).__name__)
+                matchedRecords.append(_failed_record(infile, processedRecord, str(err)))
+            else:
+                toMatch.append((len(matchedRecords), infile, processedRecord, bibcode))
+                bibcodesFromDoiList.append(bibcodesFromDoi)
+                bibcodesFromBibList.append(bibcodesFromBib)
+                matchedRecords.append(None)
+            metrics.end_record()
+    return matchedRecords, toMatch, bibcodesFromDoiList, bibcodesFromBibList
+
+
+def _prepare_batch_async(
+    adb, infile_batch, bibgen, store, metrics, bloom=None, fast_parse=False, memo=None
+):
+    """
+    Does the same as _prepare_batch, but one stage at a time for the whole
+    batch, so that the bibstem and classic lookups of all of its records
+    run concurrently through the AsyncDatabase adb.
+    """
+    matchedRecords = []
+    parsed = []
+    with _read_ahead(infile_batch, metrics) as read_ahead:
+        for i, infile in enumerate(infile_batch):
+            metrics.start_record(infile)
+            (processedRecord, failedRecord) = _parse_record(
+                infile, metrics, fast_parse=fast_parse, data=read_ahead(i)
+            )
+            metrics.end_record()
+            if failedRecord:
+                matchedRecords.append(failedRecord)
+            else:
+                parsed.append((len(matchedRecords), infile, processedRecord))
+                matchedRecords.append(None)
+
+    def lookup_failed(i, infile, processedRecord, err):
+        logger.warning("Crossref matching failed for %s: %s" % (infile, err))
+        metrics.failure("lookup", type(err).__name__)
+        matchedRecords[i] = _failed_record(infile, processedRecord, str(err))
+
+    with metrics.stage("bibcode"):
+        memoized = [_bibcode_from_memo(memo, p[2].get("record", ""), metrics) for p in parsed]
+    with metrics.stage("bibstem"):
+        bibstems = adb.query_bibstems(
+            [p[2].get("record", "") for (p, m) in zip(parsed, memoized) if not m[1]]
+        )
+    bibstems = iter(bibstems)
+    withBibcodes = []
+    for (i, infile, processedRecord), (memoKey, memoValue) in zip(parsed, memoized):
+        if memoValue:
+            withBibcodes.append((i, infile, processedRecord, memoValue[1]))
+            continue
+        bibstem = next(bibstems)
+        try:
+            if isinstance(bibstem, Exception):
+                raise bibstem
+            with metrics.stage("bibcode"):
+                bibcode = bibgen.make_bibcode(processedRecord.get("record", ""), bibstem=bibstem)
+                _memoize_bibcode(memo, memoKey, bibstem, bibcode)
+        except Exception as err:
+            lookup_failed(i, infile, processedRecord, err)
+        else:
+            withBibcodes.append((i, infile, processedRecord, bibcode))
+
+    lookups = [(p[2].get("master_doi", ""), p[3]) for p in withBibcodes]
+    with metrics.stage("classic"):
+        if store:
+            candidates = []
+            for doi, bibcode in lookups:
+                try:
+                    candidates.append(store.query_classic_bibcodes(doi, bibcode))
+                except Exception as err:
+                    candidates.append(err)
+        else:
+            if bloom:
+                lookups = [_bloom_lookup(bloom, d, b, metrics) for (d, b) in lookups]
+            candidates = adb.query_classic_bibcodes_batch(lookups)
+    toMatch = []
+    bibcodesFromDoiList = []
+    bibcodesFromBibList = []
+    for (i, infile, processedRecord, bibcode), result in zip(withBibcodes, candidates):
+        if isinstance(result, Exception):
+            lookup_failed(i, infile, processedRecord, result)
+        else:
+            toMatch.append((i, infile, processedRecord, bibcode))
+            bibcodesFromDoiList.append(result[0])
+            bibcodesFromBibList.append(result[1])
+    return matchedRecords, toMatch, bibcodesFromDoiList, bibcodesFromBibList
 
 
 @app.task(queue="process-meta")
-def task_process_meta(infile_batch):
+@profiling.profile_task(app.conf)
+def task_process_meta(
+    infile_batch, run_id=None, logfile=None, batch=None, fast_parse=None, batch_bytes=None
+):
     """
     Parses a batch of crossref xml files from the OAIPMH harvester into an
     ingestDataModel object, and then extracts and reformats the records'
     metadata into a format the classic matcher can interpret and store.
-    Batched output and failures are sent for matching or special handling.
+    The records of the whole batch are then matched against classic at
+    once, and output and failures are sent for writing to master.  If the
+    batch is part of a tracked run, its counts are updated in run_status.
+    If fast_parse (by default, FAST_PARSE) is set, only the fields needed
+    for matching are extracted from the xml.  batch_bytes, the total size
+    of the batch's files if the dispatcher sized them, is used in recording
+    the batch's timing.
     """
 
+    batch_start = time.time()
+    metrics = BatchMetrics(log_records=app.conf.get("METRICS_LOG_RECORDS", False))
+    if fast_parse is None:
+        fast_parse = app.conf.get("FAST_PARSE", False)
+    # records sent to write-db (which count them once they're written), and
+    # records whose write failed here
+    nqueued = 0
+    nwritefailed = 0
     try:
-        bibgen = BibcodeGenerator()
-        for infile in infile_batch:
-            matchedRecord = ""
-            # For each metadata.xml file: parse it, try to make a bibcode,
-            # and prep the result for task_classic_match
-            try:
-                processedRecord = utils.process_one_meta_xml(infile)
-            except Exception as err:
-                logger.warning("Parsing failed for %s: %s" % (infile, err))
-                doi = ""
-                issns = json.dumps({})
-                bibdata = json.dumps({})
-                match = json.dumps({})
-                status = "Failed"
-                matchtype = "failed"
-                bibcode = ""
-                classic_bibcode = ""
-                matchedRecord = (
-                    infile,
-                    doi,
-                    issns,
-                    bibdata,
-                    match,
-                    status,
-                    matchtype,
-                    bibcode,
-                    classic_bibcode,
-                    str(err),
+        _configure_harvest_archive()
+        bibgen = _get_bibcode_generator()
+        xmatch = _get_matcher()
+        store = _get_classic_store()
+        xmatch.candidate_index = _get_candidate_index(store)
+        bloom = None if store else _get_bloom_filter()
+        if bloom:
+            metrics.bloom_fpr = bloom.false_positive_rate()
+        memo = _get_bibcode_memo()
+        adb = _get_async_db()
+        if adb:
+            (
+                matchedRecords,
+                toMatch,
+                bibcodesFromDoiList,
+                bibcodesFromBibList,
+            ) = _prepare_batch_async(
+                adb,
+                infile_batch,
+                bibgen,
+                store,
+                metrics,
+                bloom=bloom,
+                fast_parse=fast_parse,
+                memo=memo,
+            )
+        else:
+            with app.task_session():
+                (
+                    matchedRecords,
+                    toMatch,
+                    bibcodesFromDoiList,
+                    bibcodesFromBibList,
+                ) = _prepare_batch(
+                    infile_batch,
+                    bibgen,
+                    store,
+                    metrics,
+                    bloom=bloom,
+                    fast_parse=fast_parse,
+                    memo=memo,
                 )
-            else:
-                parsestatus = processedRecord.get("status", "")
-                # If there's a status field, it means processing failed and
-                # you need to write a placeholder record for the file.
-                if parsestatus:
-                    doi = processedRecord.get("master_doi", "")
-                    issns = json.dumps(processedRecord.get("issns", {}))
-                    bibdata = json.dumps(processedRecord.get("master_bibdata", {}))
-                    match = json.dumps({})
-                    status = "Failed"
-                    matchtype = "failed"
-                    bibcode = ""
-                    classic_bibcode = ""
-                    matchedRecord = (
-                        infile,
-                        doi,
-                        issns,
-                        bibdata,
-                        match,
-                        status,
-                        matchtype,
-                        bibcode,
-                        classic_bibcode,
-                        parsestatus,
+
+        with metrics.stage("match"):
+            xmatchResults = xmatch.match_batch(
+                [x[3] for x in toMatch], bibcodesFromDoiList, bibcodesFromBibList
+            )
+            for (i, infile, processedRecord, bibcode), xmatchResult in zip(toMatch, xmatchResults):
+                try:
+                    matchedRecords[i] = _matched_record(
+                        infile, processedRecord, bibcode, xmatchResult
                     )
-                else:
-                    try:
-                        ingestRecord = processedRecord.get("record", "")
-                        bibstem = db.query_bibstem(app, ingestRecord)
-                        bibcode = bibgen.make_bibcode(ingestRecord, bibstem=bibstem)
-                        doi = processedRecord.get("master_doi", "")
-                        (bibcodesFromDoi, bibcodesFromBib) = db.query_classic_bibcodes(
-                            app, doi, bibcode
-                        )
-                        xmatch = CrossrefMatcher(related_bibstems=related_bibstems)
-                        xmatchResult = xmatch.match(bibcode, bibcodesFromDoi, bibcodesFromBib)
-                        if xmatchResult:
-                            matchtype = xmatchResult.get("match", "")
-                            if matchtype in [
-                                "canonical",
-                                "deleted",
-                                "alternate",
-                                "partial",
-                                "other",
-                                "mismatch",
-                            ]:
-                                status = "Matched"
-                            else:
-                                status = "Unmatched"
-                            if matchtype == "Classic Canonical Bibcode":
-                                matchtype = "other"
-                            classic_match = xmatchResult.get("errs", {})
-                            classic_bibcode = xmatchResult.get("bibcode", "")
-                        else:
-                            status = "NoIndex"
-                            matchtype = "other"
-                            classic_match = {}
-                            classic_bibcode = ""
-
-                        # create a postgres-ready record with matching result
-                        # for the record in infile
-                        issns = json.dumps(processedRecord.get("issns", {}))
-                        bibdata = json.dumps(processedRecord.get("master_bibdata", {}))
-                        match = json.dumps(classic_match)
-
-                        matchedRecord = (
-                            infile,
-                            doi,
-                            issns,
-                            bibdata,
-                            match,
-                            status,
-                            matchtype,
-                            bibcode,
-                            classic_bibcode,
-                            "",
-                        )
-                    except Exception as err:
-                        logger.warning("Crossref matching failed for %s: %s" % (infile, err))
-                        doi = processedRecord.get("master_doi", "")
-                        issns = json.dumps(processedRecord.get("issns", {}))
-                        bibdata = json.dumps(processedRecord.get("master_bibdata", {}))
-                        match = json.dumps({})
-                        status = "Failed"
-                        matchtype = "failed"
-                        bibcode = ""
-                        classic_bibcode = ""
-                        matchedRecord = (
-                            infile,
-                            doi,
-                            issns,
-                            bibdata,
-                            match,
-                            status,
-                            matchtype,
-                            bibcode,
-                            classic_bibcode,
-                            str(err),
-                        )
-            if matchedRecord:
-                task_write_matched_record_to_db.delay(matchedRecord)
+                except Exception as err:
+                    logger.warning("Crossref matching failed for %s: %s" % (infile, err))
+                    metrics.failure("match", type(err).__name__)
+                    matchedRecords[i] = _failed_record(infile, processedRecord, str(err))
+
+        with metrics.stage("dispatch"):
+            if None in matchedRecords:
+                logger.warning("No matchedRecord generated in batch %s!" % infile_batch)
+            records = _changed_records([r for r in matchedRecords if r], metrics)
+            if adb:
+                # written here rather than sent to the write-db queue
+                for matchedRecord, result in zip(records, adb.write_matched_records(records)):
+                    if isinstance(result, Exception):
+                        logger.error("write_matched_record failed: %s" % result)
+                        if matchedRecord[5] != "Failed":
+                            nwritefailed += 1
             else:
-                logger.warning("No matchedRecord generated for %s!" % infile)
+                for matchedRecord in records:
+                    if run_id and matchedRecord[5] != "Failed":
+                        task_write_matched_record_to_db.delay(
+                            matchedRecord, run_id, logfile, batch
+                        )
+                        nqueued += 1
+                    else:
+                        task_write_matched_record_to_db.delay(matchedRecord)
     except Exception as err:
         logger.error("Record batch failed for %s: %s" % (infile_batch, err))
+        nprocessed = 0
+        nfailed = len(infile_batch or []) - nqueued
+    else:
+        nfailed = len([r for r in matchedRecords if r and r[5] == "Failed"]) + nwritefailed
+        nprocessed = len(matchedRecords) - nfailed - nqueued
+        _record_batch_timing(infile_batch, time.time() - batch_start, nbytes=batch_bytes)
+    finally:
+        metrics.finish(metrics_dir=app.conf.get("METRICS_DIR", None), pool_stats=_pool_stats())
+    if run_id:
+        try:
+            db.update_run_batch(app, run_id, logfile, batch, nprocessed, nfailed, queued=nqueued)
+        except Exception as err:
+            logger.warning("Unable to update run %s batch %s: %s" % (run_id, batch, err))
 
 
 @app.task(queue="compute-stats")
+@profiling.profile_task(app.conf)
 def task_completeness_per_bibstem(bibstem):
     try:
         bibstem = bibstem.ljust(5, ".")
@@ -308,6 +923,7 @@ def task_do_all_completeness():
         logger.error("Failed to compute summary: %s" % err)
 
 
+@profiling.profile_task(app.conf)
 def task_export_completeness_to_json():
     try:
         allData = []
@@ -378,19 +994,20 @@ def task_export_completeness_to_json():
 
 
 @app.task(queue="get-logfiles")
-def task_retry_records(rec_type):
-    batch_count = app.conf.get("RECORDS_PER_BATCH", 100)
+def task_retry_records(rec_type, run_id=None, fast_parse=None):
     try:
+        _configure_harvest_archive()
         result = db.query_retry_files(app, rec_type)
-        batch = []
-        for r in result:
-            batch.append(r[0])
-            if len(batch) == batch_count:
-                logger.debug("Calling task_process_meta with batch '%s'" % batch)
-                task_process_meta.delay(batch)
-                batch = []
-        if len(batch):
-            logger.debug("Calling task_process_meta with batch '%s'" % batch)
-            task_process_meta.delay(batch)
+        _dispatch_batches(
+            list(_make_batches([r[0] for r in result])),
+            run_id,
+            retry_label(rec_type),
+            fast_parse=fast_parse,
+        )
     except Exception as err:
         logger.warning('Error reprocessing records of matchtype "%s": %s' % (rec_type, err))
+        if run_id:
+            try:
+                db.fail_run_logfile(app, run_id, retry_label(rec_type))
+            except Exception as err:
+                logger.warning("Unable to mark retry of %s as failed: %s" % (rec_type, err))
@@ -1,14 +1,21 @@
+import codecs
+import fcntl
+import io
 import json
 import os
 import re
+import tempfile
+from contextlib import contextmanager, nullcontext
 from glob import glob
 
-from adsingestp.parsers.crossref import CrossrefParser
 from adsputils import load_config, setup_logging
 
+from adscompstat import harvest_archive, reusable
 from adscompstat.exceptions import (
+    BatchCostModelException,
     CompletenessFractionException,
     CrossRefParseException,
+    FastParseException,
     JsonExportException,
     LoadClassicDataException,
     LoadIssnDataException,
@@ -17,6 +24,7 @@ from adscompstat.exceptions import (
     NoHarvestLogsException,
     ParseLogsException,
     ReadLogException,
+    XmlEncodingException,
 )
 
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
@@ -29,6 +37,13 @@ logger = setup_logging(
 )
 
 re_issn = re.compile(r"^\d{4}-?\d{3}[0-9X]$")
+re_xml_encoding = re.compile(rb"""^\s*<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+
+# Version of the processedRecords made by process_one_meta_xml and
+# process_one_meta_xml_fast, used in the parsed record cache's keys; bump it
+# whenever _processed_record or extract_matching_fields change what they
+# extract, so that records cached by older code aren't reused
+PROCESSED_RECORD_VERSION = 1
 
 
 def get_updateagent_logs(logdir):
@@ -70,71 +85,374 @@ def read_updateagent_log(logfile):
         return xmlfiles
 
 
-def process_one_meta_xml(infile):
+def get_file_size(infile):
+    try:
+        return harvest_archive.harvest_file_size(infile)
+    except Exception as err:
+        logger.debug("Unable to get size of %s: %s" % (infile, err))
+        return 0
+
+
+def _solve_batch_cost_model(sums):
+    # Least-squares fit of seconds = per_record * nrecords + per_byte * nbytes
+    # from the decayed sums of previous batches.  If the two terms can't be
+    # separated (e.g. every batch had the same bytes per record), fall back
+    # to a single per-byte (or per-record) cost.
+    snn = sums.get("nn", 0.0)
+    snb = sums.get("nb", 0.0)
+    sbb = sums.get("bb", 0.0)
+    snt = sums.get("nt", 0.0)
+    sbt = sums.get("bt", 0.0)
+    det = snn * sbb - snb * snb
+    if det > 1.0e-9 * snn * sbb:
+        per_record = (snt * sbb - sbt * snb) / det
+        per_byte = (sbt * snn - snt * snb) / det
+        if per_record >= 0.0 and per_byte >= 0.0:
+            return {"per_record": per_record, "per_byte": per_byte}
+    if sbb > 0.0:
+        return {"per_record": 0.0, "per_byte": sbt / sbb}
+    if snn > 0.0:
+        return {"per_record": snt / snn, "per_byte": 0.0}
+    return None
+
+
+def load_batch_cost_model(statefile):
+    """
+    Returns the per-record and per-byte processing cost (in seconds) fitted
+    from the timings of previous task_process_meta batches, or None if no
+    timings have been recorded yet.
+    """
+    if not statefile:
+        return None
+    try:
+        with open(statefile, "r") as fs:
+            sums = json.load(fs)
+    except Exception as err:
+        logger.debug("No batch cost model available from %s: %s" % (statefile, err))
+        return None
+    return _solve_batch_cost_model(sums)
+
+
+def update_batch_cost_model(statefile, nrecords, nbytes, seconds, decay=0.95):
+    """
+    Adds the timing of one processed batch to the cost model in statefile.
+    Older batches are down-weighted by decay so that the model follows
+    changes in worker and database load.  Workers (on any host sharing the
+    file) take turns through a lock on statefile.lock, so that no update is
+    lost, and the file is replaced atomically, so that readers always see a
+    complete model.
+    """
+    try:
+        with open(statefile + ".lock", "a") as fl:
+            fcntl.lockf(fl, fcntl.LOCK_EX)
+            try:
+                with open(statefile, "r") as fs:
+                    sums = json.load(fs)
+            except Exception:
+                sums = {}
+            update = {
+                "nn": nrecords * nrecords,
+                "nb": nrecords * nbytes,
+                "bb": nbytes * nbytes,
+                "nt": nrecords * seconds,
+                "bt": nbytes * seconds,
+            }
+            for k, v in update.items():
+                sums[k] = decay * sums.get(k, 0.0) + v
+            sums["batches"] = sums.get("batches", 0) + 1
+            (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(statefile) or ".")
+            with os.fdopen(fd, "w") as fs:
+                fs.write(json.dumps(sums))
+            os.replace(tmpfile, statefile)
+    except Exception as err:
+        raise BatchCostModelException("Unable to update batch cost model: %s" % err)
+
+
+def _processed_record(infile, record):
+    # extracts and reformats the metadata of a parsed record (as returned by
+    # CrossrefParser or extract_matching_fields) into a processedRecord
+    if record:
+        publication = record.get("publication", None)
+        first_author = record.get("authors", [])[0]
+        title = record.get("title", None)
+        pagination = record.get("pagination", None)
+        pids = record.get("persistentIDs", None)
+        if pids:
+            doi = None
+            for pid in pids:
+                if pid.get("DOI", None):
+                    doi = pid.get("DOI", None)
+        if not doi:
+            processedRecord = {"file": infile, "status": "No DOI found"}
+        else:
+            if publication:
+                issns = publication.get("ISSN", None)
+            else:
+                issns = None
+            issn_dict = {}
+            if issns:
+                for item in issns:
+                    k = item["pubtype"]
+                    v = item["issnString"]
+                    if len(v) == 8:
+                        v = v[0:4] + "-" + v[4:]
+                    issn_dict[k] = v
+            bib_data = {
+                "publication": publication,
+                "pagination": pagination,
+                "persistentIDs": pids,
+                "first_author": first_author,
+                "title": title,
+            }
+            processedRecord = {
+                "record": record,
+                "harvest_filepath": infile,
+                "master_doi": doi,
+                "issns": issn_dict,
+                "master_bibcode": None,
+                "master_bibdata": bib_data,
+            }
+    else:
+        processedRecord = {"harvest_filepath": infile, "status": "parser failed"}
+    return processedRecord
+
+
+@contextmanager
+def open_xml(infile, data=None):
+    """
+    Yields the undecoded contents of a harvested xml file, as bytes.  If the
+    file's contents have already been read, as data, they're used instead.
+    """
+    if data is not None:
+        yield data
+        return
+    with harvest_archive.open_harvest_file(infile) as fx:
+        yield fx.read()
+
+
+def xml_encoding(data):
+    """
+    Returns the encoding of undecoded xml, from its byte order mark or
+    its xml declaration, or utf-8 if it has neither.
+    """
+    head = data[0:256]
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    match = re_xml_encoding.match(head)
+    if match:
+        return match.group(1).decode("ascii")
+    return "utf-8"
+
+
+def decode_xml(data):
+    """
+    Decodes undecoded xml bytes in its declared encoding, so
+    that the parser is handed text and doesn't have to detect and decode it
+    again.  Raises XmlEncodingException with the encoding and byte offset of
+    the first invalid sequence.
+    """
+    encoding = xml_encoding(data)
+    try:
+        return str(data, encoding)
+    except LookupError:
+        raise XmlEncodingException("unknown encoding %s" % encoding)
+    except UnicodeDecodeError as err:
+        raise XmlEncodingException("invalid %s at byte %s: %s" % (encoding, err.start, err.reason))
+
+
+def get_crossref_parser():
+    """
+    Returns this thread's CrossrefParser.  adsingestp is imported on first
+    use rather than with this module, since it's slow to import and most
+    commands never parse a file.
+    """
+    from adsingestp.parsers.crossref import CrossrefParser
+
+    return reusable.instances.get(CrossrefParser)
+
+
+def process_one_meta_xml(infile, data=None):
     """
     Parses a crossref xml file from the OAIPMH harvester into an
     ingestDataModel object, and then extracts and reformats the record
     metadata into a format the classic matcher can interpret and store.
+    The file is decoded once, as declared in the xml, and the parser is
+    handed the text; files that aren't valid in their declared encoding
+    fail with an "encoding error" status.  data, if given, is the file's
+    contents, already read.
     """
     processedRecord = {}
     try:
         record = dict()
-        with open(infile, "r") as fx:
-            data = fx.read()
+        with open_xml(infile, data=data) as xml:
+            text = decode_xml(xml)
             try:
-                parser = CrossrefParser()
-                record = parser.parse(data)
+                record = get_crossref_parser().parse(text)
             except Exception as err:
                 raise CrossRefParseException(err)
             else:
-                if record:
-                    publication = record.get("publication", None)
-                    first_author = record.get("authors", [])[0]
-                    title = record.get("title", None)
-                    pagination = record.get("pagination", None)
-                    pids = record.get("persistentIDs", None)
-                    if pids:
-                        doi = None
-                        for pid in pids:
-                            if pid.get("DOI", None):
-                                doi = pid.get("DOI", None)
-                    if not doi:
-                        processedRecord = {"file": infile, "status": "No DOI found"}
-                    else:
-                        if publication:
-                            issns = publication.get("ISSN", None)
-                        else:
-                            issns = None
-                        issn_dict = {}
-                        if issns:
-                            for item in issns:
-                                k = item["pubtype"]
-                                v = item["issnString"]
-                                if len(v) == 8:
-                                    v = v[0:4] + "-" + v[4:]
-                                issn_dict[k] = v
-                        bib_data = {
-                            "publication": publication,
-                            "pagination": pagination,
-                            "persistentIDs": pids,
-                            "first_author": first_author,
-                            "title": title,
-                        }
-                        processedRecord = {
-                            "record": record,
-                            "harvest_filepath": infile,
-                            "master_doi": doi,
-                            "issns": issn_dict,
-                            "master_bibcode": None,
-                            "master_bibdata": bib_data,
-                        }
-                else:
-                    processedRecord = {"harvest_filepath": infile, "status": "parser failed"}
+                processedRecord = _processed_record(infile, record)
+    except XmlEncodingException as err:
+        processedRecord = {"harvest_filepath": infile, "status": "encoding error: %s" % err}
     except Exception as err:
         processedRecord = {"harvest_filepath": infile, "status": "error: %s" % err}
     return processedRecord
 
 
+def _localname(tag):
+    # element name without its namespace; comments and PIs have no name
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def _crossref_date(elem):
+    parts = dict([(_localname(c.tag), (c.text or "").strip()) for c in elem])
+    if not parts.get("year"):
+        return None
+    return "%s-%s-%s" % (
+        parts["year"],
+        parts.get("month", "").zfill(2) or "00",
+        parts.get("day", "").zfill(2) or "00",
+    )
+
+
+def extract_matching_fields(infile, data=None):
+    """
+    Streams a crossref journal article xml file from the OAIPMH harvester
+    and returns only the parts of the ingestDataModel record needed to
+    make its bibcode and match it: the publication name, ISSNs, volume,
+    issue and year, the first page, the first author, the title, and the
+    DOI.  Reading stops at the article's citation list.  Raises
+    FastParseException for anything it can't be sure of (e.g. non-journal
+    records, or a first author who isn't a person), which should then be
+    parsed in full with CrossrefParser.  data, if given, is the file's
+    contents, already read.
+    """
+    # imported here, as it's only needed when fast parsing
+    from lxml import etree
+
+    publication = {}
+    issns = []
+    pagination = {}
+    authors = []
+    title = None
+    doi = None
+    dates = {"journal_issue": {}, "journal_article": {}, "assertion": {}}
+    path = []
+    try:
+        if data is not None:
+            source = nullcontext(io.BytesIO(data))
+        else:
+            source = harvest_archive.open_harvest_file(infile)
+        with source as fx:
+            for event, elem in etree.iterparse(fx, events=("start", "end"), remove_comments=True):
+                name = _localname(elem.tag)
+                if event == "start":
+                    if name == "citation_list":
+                        break
+                    path.append(name)
+                    continue
+                path.pop()
+                parent = path[-1] if path else ""
+                text = (elem.text or "").strip()
+                if parent == "journal_metadata":
+                    if name == "full_title" and "pubName" not in publication:
+                        publication["pubName"] = text
+                    elif name == "issn" and text:
+                        issns.append(
+                            {"pubtype": elem.get("media_type", "print"), "issnString": text}
+                        )
+                elif name == "issue" and parent == "journal_issue":
+                    publication["issueNum"] = text
+                elif name == "volume" and parent == "journal_volume":
+                    publication["volumeNum"] = text
+                elif name == "publication_date" and parent in dates:
+                    date = _crossref_date(elem)
+                    if date:
+                        dates[parent].setdefault(elem.get("media_type", "print"), date)
+                elif name == "title" and parent == "titles" and "journal_article" in path:
+                    if title is None:
+                        title = "".join(elem.itertext()).strip()
+                elif parent == "contributors" and not authors:
+                    if elem.get("contributor_role", "author") == "author":
+                        if name != "person_name":
+                            raise FastParseException("first author is not a person")
+                        parts = dict([(_localname(c.tag), (c.text or "").strip()) for c in elem])
+                        if not parts.get("surname"):
+                            raise FastParseException("first author has no surname")
+                        author = {"surname": parts["surname"]}
+                        if parts.get("given_name"):
+                            author["given_name"] = parts["given_name"]
+                        authors.append({"name": author})
+                elif name == "first_page" and parent == "pages":
+                    pagination["firstPage"] = text
+                elif name == "item_number" and parent == "publisher_item":
+                    pagination.setdefault("electronicID", text)
+                elif name == "assertion" and elem.get("name") in ("date_epub", "date_ppub"):
+                    dates["assertion"][elem.get("name")] = text
+                elif name == "doi" and parent == "doi_data" and path[-2:-1] == ["journal_article"]:
+                    doi = text
+    except FastParseException:
+        raise
+    except Exception as err:
+        raise FastParseException(err)
+
+    if not doi:
+        raise FastParseException("no journal article DOI found")
+    if not authors:
+        raise FastParseException("no first author found")
+    # article dates are used in preference to those of its issue, and the
+    # crossmark online/print dates in preference to both
+    pubDate = {}
+    for media_type, key in [("print", "printDate"), ("online", "electrDate")]:
+        date = dates["journal_article"].get(media_type, dates["journal_issue"].get(media_type))
+        if date:
+            pubDate[key] = date
+    for assertion, key in [("date_ppub", "printDate"), ("date_epub", "electrDate")]:
+        if dates["assertion"].get(assertion):
+            pubDate[key] = dates["assertion"][assertion]
+    year = (pubDate.get("printDate") or pubDate.get("electrDate") or "")[0:4]
+    if not year:
+        raise FastParseException("no publication year found")
+    publication["pubYear"] = year
+    if issns:
+        publication["ISSN"] = issns
+    record = {
+        "pubDate": pubDate,
+        "publication": dict(
+            [
+                (k, publication[k])
+                for k in ["pubName", "issueNum", "volumeNum", "pubYear", "ISSN"]
+                if k in publication
+            ]
+        ),
+        "persistentIDs": [{"DOI": doi}],
+        "pagination": pagination,
+        "authors": authors,
+    }
+    if title:
+        record["title"] = {"textEnglish": title}
+    return record
+
+
+def process_one_meta_xml_fast(infile, data=None):
+    """
+    As process_one_meta_xml, but using extract_matching_fields in place of
+    CrossrefParser, so that its record holds only the fields needed for
+    matching.  Files it can't handle are parsed with CrossrefParser.
+    """
+    try:
+        record = extract_matching_fields(infile, data=data)
+    except Exception as err:
+        logger.debug("Fast parsing %s failed, using CrossrefParser: %s" % (infile, err))
+        return process_one_meta_xml(infile, data=data)
+    try:
+        return _processed_record(infile, record)
+    except Exception as err:
+        return {"harvest_filepath": infile, "status": "error: %s" % err}
+
+
 def load_classic_doi_bib_map(infile):
     records_bib_doi = list()
     found_doi = dict()
@@ -0,0 +1,27 @@
+"""Add prefix index to alt_identifiers
+Revision ID: 3e7b9d4c2a18
+Revises: 8c3f2a9d1e57
+Create Date: 2026-10-19 15:00:00.000000
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3e7b9d4c2a18"
+down_revision = "8c3f2a9d1e57"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # lets the near-miss candidate lookups (identifier LIKE 'prefix%') use an
+    # index whatever the database's collation
+    op.create_index(
+        "ix_alt_identifiers_identifier_prefix",
+        "alt_identifiers",
+        ["identifier"],
+        postgresql_ops={"identifier": "text_pattern_ops"},
+    )
+
+
+def downgrade():
+    op.drop_index("ix_alt_identifiers_identifier_prefix", table_name="alt_identifiers")
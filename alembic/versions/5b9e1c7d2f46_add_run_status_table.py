@@ -0,0 +1,41 @@
+"""Add run status table
+Revision ID: 5b9e1c7d2f46
+Revises: d2c43086a8ab
+Create Date: 2026-10-19 10:00:00.000000
+"""
+import sqlalchemy as sa
+from adsputils import UTCDateTime, get_date
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b9e1c7d2f46"
+down_revision = "d2c43086a8ab"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # progress of each logfile and batch of a run.py run
+    op.create_table(
+        "run_status",
+        sa.Column("runstatusid", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("run_id", sa.String(), nullable=False),
+        sa.Column("logfile", sa.String(), nullable=False),
+        sa.Column("batch", sa.Integer(), nullable=False),
+        sa.Column("expected", sa.Integer(), nullable=True),
+        sa.Column("dispatched", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("processed", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("failed", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("created", UTCDateTime, nullable=True, default=get_date),
+        sa.Column("updated", UTCDateTime, nullable=True, onupdate=get_date),
+        sa.PrimaryKeyConstraint("runstatusid"),
+        sa.UniqueConstraint("runstatusid"),
+        sa.UniqueConstraint("run_id", "logfile", "batch"),
+    )
+    op.create_index(op.f("ix_run_status_run_id"), "run_status", ["run_id"])
+
+
+def downgrade():
+    op.drop_index(op.f("ix_run_status_run_id"), table_name="run_status")
+    op.drop_table("run_status")
@@ -0,0 +1,24 @@
+"""Add content hash to master
+Revision ID: 8c3f2a9d1e57
+Revises: 5b9e1c7d2f46
+Create Date: 2026-10-19 12:00:00.000000
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8c3f2a9d1e57"
+down_revision = "5b9e1c7d2f46"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # hash of each row's matched record, to skip rewriting unchanged rows;
+    # existing rows get theirs the next time they're written
+    op.add_column("master", sa.Column("content_hash", sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("master", "content_hash")
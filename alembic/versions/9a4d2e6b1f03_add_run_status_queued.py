@@ -0,0 +1,26 @@
+"""Add queued count to run_status
+Revision ID: 9a4d2e6b1f03
+Revises: 3e7b9d4c2a18
+Create Date: 2026-10-19 16:00:00.000000
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9a4d2e6b1f03"
+down_revision = "3e7b9d4c2a18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # records of a batch sent to the write-db queue but not yet written
+    op.add_column(
+        "run_status",
+        sa.Column("queued", sa.Integer(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_column("run_status", "queued")
@@ -0,0 +1,38 @@
+"""
+Database helpers shared by the benchmarks that load synthetic data into a
+scratch database.
+"""
+from sqlalchemy import Index
+
+from adscompstat import database as db
+from adscompstat.models import Base
+from adscompstat.models import CompStatAltIdents as alt_identifiers
+from adscompstat.models import CompStatIdentDoi as identifier_doi
+from adscompstat.models import CompStatIssnBibstem as issn_bibstem
+from adscompstat.models import CompStatMaster as master
+from adscompstat.models import CompStatSummary as summary
+
+
+def create_tables(engine):
+    # the models don't declare the per-column indexes that the alembic
+    # migration creates, so add them for a database made with create_all
+    Base.metadata.create_all(engine)
+    for column in [
+        identifier_doi.identifier,
+        identifier_doi.doi,
+        issn_bibstem.bibstem,
+        issn_bibstem.issn,
+        alt_identifiers.identifier,
+        alt_identifiers.canonical_id,
+    ]:
+        name = "ix_%s_%s" % (column.table.name, column.name)
+        Index(name, column).create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        for table in [master, summary, identifier_doi, alt_identifiers, issn_bibstem]:
+            conn.execute(table.__table__.delete())
+
+
+def write_blocks(app, table, data):
+    blocksize = app.conf.get("CLASSIC_DATA_BLOCKSIZE", 10000)
+    for i in range(0, len(data), blocksize):
+        db.write_block(app, table, data[i : i + blocksize])
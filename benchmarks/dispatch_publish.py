@@ -0,0 +1,110 @@
+"""
+Publish throughput and latency of dispatching process-meta batches.
+
+Publishes the batches of a synthetic retry of --records records (in
+batches of --batch-size) to a stand-in task, once with delay() per batch,
+as the dispatchers used to, and once through one shared producer, as
+tasks._dispatch_batches does now, and prints the time, publish rate and
+per-publish latency of each.  Uses Celery's in-memory broker by default,
+which shows only the client side cost; pass --broker with a scratch
+RabbitMQ vhost to include the round trips.  From the repository root:
+
+    python -m benchmarks.dispatch_publish --records 1000000
+"""
+import argparse
+import json
+import time
+
+from celery import Celery
+from kombu import Queue
+
+QUEUE = "benchmark-process-meta"
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Benchmark publishing process-meta batches")
+    parser.add_argument("--records", type=int, default=1000000, help="Records to dispatch")
+    parser.add_argument("--batch-size", type=int, default=250, help="Records per batch")
+    parser.add_argument("--broker", default="memory://", help="Broker URL (a scratch vhost)")
+    parser.add_argument("-o", "--output", default=None, help="Write results as JSON here")
+    return parser.parse_args()
+
+
+def make_app(broker):
+    app = Celery("adscompstat-dispatch-benchmark", broker=broker)
+    app.conf.task_queues = (Queue(QUEUE, routing_key=QUEUE),)
+
+    @app.task(name="benchmark.process_meta", queue=QUEUE)
+    def process_meta(infile_batch, run_id=None, logfile=None, batch=None):
+        pass
+
+    return app, process_meta
+
+
+def _summary(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    result = {
+        "method": name,
+        "batches": len(latencies),
+        "seconds": round(elapsed, 3),
+        "batches_per_sec": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000.0, 4),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000.0, 4),
+        "max_ms": round(latencies[-1] * 1000.0, 4),
+    }
+    print(
+        "%-16s %8s batches %9.3f s %10.1f batches/s  p50 %.4f ms  p99 %.4f ms  max %.4f ms"
+        % (
+            name,
+            result["batches"],
+            result["seconds"],
+            result["batches_per_sec"],
+            result["p50_ms"],
+            result["p99_ms"],
+            result["max_ms"],
+        )
+    )
+    return result
+
+
+def publish_delay(task, batches):
+    latencies = []
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        t0 = time.perf_counter()
+        task.delay(batch, "run", "retry:unmatched", i)
+        latencies.append(time.perf_counter() - t0)
+    return _summary("delay", latencies, time.perf_counter() - start)
+
+
+def publish_shared(app, task, batches):
+    latencies = []
+    start = time.perf_counter()
+    with app.producer_or_acquire() as producer:
+        for i, batch in enumerate(batches):
+            t0 = time.perf_counter()
+            task.apply_async(args=(batch, "run", "retry:unmatched", i), producer=producer)
+            latencies.append(time.perf_counter() - t0)
+    return _summary("shared producer", latencies, time.perf_counter() - start)
+
+
+def main():
+    args = get_args()
+    files = ["/proj/ads/articles/sources/CrossRef/doi/%08d.xml" % i for i in range(args.records)]
+    batches = [files[i : i + args.batch_size] for i in range(0, len(files), args.batch_size)]
+    (app, task) = make_app(args.broker)
+    results = []
+    try:
+        results.append(publish_delay(task, batches))
+        app.control.purge()
+        results.append(publish_shared(app, task, batches))
+        app.control.purge()
+    finally:
+        app.close()
+    if args.output:
+        with open(args.output, "w") as fj:
+            json.dump({"records": args.records, "results": results}, fj, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Start-up cost of the CLI and workers.
+
+Times `python run.py --help` end to end, and lists the modules with the
+largest cumulative import times (from `python -X importtime`) when
+importing run.py and adscompstat.tasks, so that a slow import added to the
+start-up path shows up.  From the repository root:
+
+    python -m benchmarks.import_time --top 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from adscompstat.profiling import import_times
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+STATEMENTS = ["import run", "import adscompstat.tasks"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Benchmark CLI and worker start-up time")
+    parser.add_argument("--top", type=int, default=15, help="Slowest imports to list")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of run.py --help to time")
+    parser.add_argument("-o", "--output", default=None, help="Write results as JSON here")
+    return parser.parse_args()
+
+
+def time_cli(repeat):
+    # best wall-clock time of run.py --help, in seconds
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.join(proj_home, "run.py"), "--help"],
+            cwd=proj_home,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    args = get_args()
+    results = {"cli_help_seconds": round(time_cli(args.repeat), 3), "imports": {}}
+    print("run.py --help: %.3f s" % results["cli_help_seconds"])
+    for statement in STATEMENTS:
+        times = import_times(statement)
+        slowest = sorted(times.items(), key=lambda t: t[1], reverse=True)[0 : args.top]
+        results["imports"][statement] = dict(slowest)
+        print("\n%s" % statement)
+        for name, seconds in slowest:
+            print("%10.3f s  %s" % (seconds, name))
+    if args.output:
+        with open(args.output, "w") as fj:
+            json.dump(results, fj, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Per-record setup overhead of the parser and bibcode generator.
+
+Times making a new CrossrefParser and BibcodeGenerator for every record,
+as process-meta workers used to, against reusing the worker's instances
+(adscompstat.reusable), which are only reset between records; then
+parses and makes bibcodes for a set of synthetic Crossref xml files both
+ways.  From the repository root:
+
+    python -m benchmarks.instance_reuse --records 20000
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from adsenrich.bibcodes import BibcodeGenerator
+from adsingestp.parsers.crossref import CrossrefParser
+
+from adscompstat import reusable, synthetic, utils
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Benchmark reusing the parser and bibcode generator")
+    parser.add_argument("--records", type=int, default=20000, help="Setups of each kind to time")
+    parser.add_argument("--xml-files", type=int, default=2000, help="Synthetic xml files to parse")
+    parser.add_argument("-o", "--output", default=None, help="Write results as JSON here")
+    return parser.parse_args()
+
+
+def time_per_call(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    return (time.perf_counter() - start) / count * 1.0e6
+
+
+def bench_setup(count):
+    instances = reusable.ReusableInstances()
+    results = {}
+    for name, cls in [("CrossrefParser", CrossrefParser), ("BibcodeGenerator", BibcodeGenerator)]:
+        results[name] = {
+            "new_us": round(time_per_call(cls, count), 3),
+            "reused_us": round(time_per_call(lambda: instances.get(cls), count), 3),
+        }
+    return results
+
+
+def _parse_files(xmlfiles, get_parser, get_bibgen):
+    start = time.perf_counter()
+    for infile in xmlfiles:
+        with utils.open_xml(infile) as xml:
+            record = get_parser().parse(utils.decode_xml(xml))
+        try:
+            get_bibgen().make_bibcode(record)
+        except Exception:
+            pass
+    return (time.perf_counter() - start) / len(xmlfiles) * 1.0e6
+
+
+def bench_records(xmlfiles):
+    instances = reusable.ReusableInstances()
+    return {
+        "new_us": round(_parse_files(xmlfiles, CrossrefParser, BibcodeGenerator), 3),
+        "reused_us": round(
+            _parse_files(
+                xmlfiles,
+                lambda: instances.get(CrossrefParser),
+                lambda: instances.get(BibcodeGenerator),
+            ),
+            3,
+        ),
+    }
+
+
+def main():
+    args = get_args()
+    results = {"setup": bench_setup(args.records)}
+    for name, result in results["setup"].items():
+        print(
+            "%-18s new %10.3f us   reused %10.3f us"
+            % (name, result["new_us"], result["reused_us"])
+        )
+    workdir = tempfile.mkdtemp(prefix="adscompstat-bench-")
+    try:
+        corpus = synthetic.SyntheticCorpus(args.xml_files)
+        harvest = corpus.write_harvest(workdir, limit=args.xml_files)
+        xmlfiles = []
+        for logfile in sorted(utils.get_updateagent_logs(harvest["HARVEST_LOG_DIR"])):
+            xmlfiles.extend(
+                [harvest["HARVEST_BASE_DIR"] + f for f in utils.read_updateagent_log(logfile)]
+            )
+        results["record"] = bench_records(xmlfiles)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(
+        "%-18s new %10.3f us   reused %10.3f us"
+        % ("per record", results["record"]["new_us"], results["record"]["reused_us"])
+    )
+    if args.output:
+        with open(args.output, "w") as fj:
+            json.dump(results, fj, indent=2)
+
+
+if __name__ == "__main__":
+    main()
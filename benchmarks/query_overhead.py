@@ -0,0 +1,129 @@
+"""
+Per-lookup overhead of the hot-path queries made for every record:
+query_bibstem_by_issn and query_classic_bibcodes.
+
+Times each lookup as issued by adscompstat.database (prebuilt statements
+reused from the compiled cache) against the same lookup built as a new ORM
+query on every call, as it was before, over one shared connection so that
+only the statement overhead differs.  Uses a small synthetic data set in
+SQLite by default, or --db-url for a scratch PostgreSQL database (whose
+tables are emptied).  From the repository root:
+
+    python -m benchmarks.query_overhead --lookups 20000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from adscompstat import database as db
+from adscompstat import synthetic
+from adscompstat.app import ADSCompStatCelery
+from adscompstat.models import CompStatAltIdents as alt_identifiers
+from adscompstat.models import CompStatIdentDoi as identifier_doi
+from adscompstat.models import CompStatIssnBibstem as issn_bibstem
+from adscompstat.models import CompStatMaster as master
+from benchmarks.common import create_tables, write_blocks
+from benchmarks.run_benchmarks import bench_classic_load
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Benchmark the per-lookup overhead of hot-path queries")
+    parser.add_argument("--records", type=int, default=10000, help="Synthetic records to load")
+    parser.add_argument("--lookups", type=int, default=10000, help="Lookups of each kind")
+    parser.add_argument("--db-url", default=None, help="SQLAlchemy URL of a scratch database")
+    parser.add_argument("-o", "--output", default=None, help="Write results as JSON here")
+    return parser.parse_args()
+
+
+def orm_bibstem_by_issn(session, issn):
+    return session.query(issn_bibstem.bibstem).filter(issn_bibstem.issn == issn).first()
+
+
+def orm_classic_bibcodes(session, doi, bibcode):
+    columns = (alt_identifiers.identifier, alt_identifiers.canonical_id, alt_identifiers.idtype)
+    fromDoi = (
+        session.query(*columns)
+        .join(identifier_doi, alt_identifiers.canonical_id == identifier_doi.identifier)
+        .filter(identifier_doi.doi == doi)
+        .all()
+    )
+    fromBib = session.query(*columns).filter(alt_identifiers.identifier == bibcode).all()
+    return fromDoi, fromBib
+
+
+def time_lookups(func, args_list):
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list) * 1.0e6
+
+
+def main():
+    args = get_args()
+    workdir = tempfile.mkdtemp(prefix="adscompstat-queries-")
+    db_url = args.db_url or "sqlite:///%s" % os.path.join(workdir, "bench.sqlite")
+    engine = create_engine(db_url)
+    create_tables(engine)
+    engine.dispose()
+    app = ADSCompStatCelery(
+        "completeness-statistics-benchmark",
+        proj_home=proj_home,
+        local_config={"SQLALCHEMY_URL": db_url, "SQLALCHEMY_ECHO": False},
+    )
+    results = []
+    try:
+        corpus = synthetic.SyntheticCorpus(args.records)
+        bench_classic_load(app, corpus.write_classic_files(os.path.join(workdir, "classic")))
+        write_blocks(app, master, list(corpus.master_rows()))
+        records = [corpus.record(i % args.records) for i in range(args.lookups)]
+        issns = [
+            (synthetic.JOURNALS[i % len(synthetic.JOURNALS)][1],) for i in range(args.lookups)
+        ]
+        pairs = [(r["doi"], r["bibcode"]) for r in records]
+
+        with app.task_session() as session:
+            lookups = [
+                (
+                    "bibstem_by_issn",
+                    lambda issn: orm_bibstem_by_issn(session, issn),
+                    lambda issn: db.query_bibstem_by_issn(app, issn),
+                    issns,
+                ),
+                (
+                    "classic_bibcodes",
+                    lambda doi, bib: orm_classic_bibcodes(session, doi, bib),
+                    lambda doi, bib: db.query_classic_bibcodes(app, doi, bib),
+                    pairs,
+                ),
+            ]
+            for name, before, after, args_list in lookups:
+                # warm both up so that neither pays for first compilation
+                time_lookups(before, args_list[0:100])
+                time_lookups(after, args_list[0:100])
+                result = {
+                    "lookup": name,
+                    "orm_us": round(time_lookups(before, args_list), 1),
+                    "cached_us": round(time_lookups(after, args_list), 1),
+                }
+                results.append(result)
+                print(
+                    "%-18s %8.1f us/lookup before %8.1f us/lookup after"
+                    % (name, result["orm_us"], result["cached_us"])
+                )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as fj:
+            json.dump({"db": db_url.split("://")[0], "results": results}, fj, indent=2)
+
+
+if __name__ == "__main__":
+    main()
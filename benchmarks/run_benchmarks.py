@@ -0,0 +1,227 @@
+"""
+Throughput and peak memory benchmarks for the ingest-and-match hot path.
+
+Generates a synthetic corpus (adscompstat.synthetic) of classic flat files,
+Crossref xml files and master rows at the requested scale, then times each
+stage against a database: by default a fresh SQLite file in the work
+directory, or any SQLAlchemy URL given with --db-url (e.g. a local
+PostgreSQL database, which must be a scratch database, since its tables are
+emptied).  Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --scale 100000
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from adscompstat import database as db
+from adscompstat import synthetic, utils
+from adscompstat.app import ADSCompStatCelery
+from adscompstat.match import CrossrefMatcher
+from adscompstat.models import CompStatAltIdents as alt_identifiers
+from adscompstat.models import CompStatIdentDoi as identifier_doi
+from adscompstat.models import CompStatIssnBibstem as issn_bibstem
+from adscompstat.models import CompStatMaster as master
+from benchmarks.common import create_tables, write_blocks
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+STAGES = ["classic_load", "classic_query", "parse", "match", "completeness"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Benchmark the ADSCompStat ingest-and-match stages")
+    parser.add_argument(
+        "-n", "--scale", type=int, default=10000, help="Number of synthetic Crossref records"
+    )
+    parser.add_argument(
+        "--xml-limit",
+        type=int,
+        default=10000,
+        help="Maximum number of Crossref xml files to write and parse",
+    )
+    parser.add_argument(
+        "--query-limit",
+        type=int,
+        default=10000,
+        help="Maximum number of classic bibcode queries to run",
+    )
+    parser.add_argument(
+        "-s", "--stages", default=",".join(STAGES), help="Comma-separated stages to run"
+    )
+    parser.add_argument("--db-url", default=None, help="SQLAlchemy URL of a scratch database")
+    parser.add_argument("--workdir", default=None, help="Directory for the generated data")
+    parser.add_argument(
+        "--rates",
+        default=None,
+        help='JSON object of relative match type rates, e.g. \'{"canonical": 0.8, "unmatched": 0.2}\'',
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("-o", "--output", default=None, help="Write results as JSON here")
+    return parser.parse_args()
+
+
+def _reset_peak_rss():
+    # Linux only: resets VmHWM so that each stage reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as fc:
+            fc.write("5")
+    except Exception:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as fs:
+            for line in fs:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except Exception:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024.0
+    return peak / 1024.0
+
+
+def run_stage(name, func, *args):
+    _reset_peak_rss()
+    start = time.perf_counter()
+    count = func(*args)
+    elapsed = time.perf_counter() - start
+    result = {
+        "stage": name,
+        "items": count,
+        "seconds": round(elapsed, 3),
+        "items_per_sec": round(count / elapsed, 1) if elapsed > 0 else 0.0,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+    print(
+        "%-14s %10s items %10.3f s %12.1f items/s %10.1f MB peak RSS"
+        % (name, count, elapsed, result["items_per_sec"], result["peak_rss_mb"])
+    )
+    return result
+
+
+def bench_classic_load(app, files):
+    issns = utils.load_journalsdb_issn_bibstem_list(files["JOURNALSDB_ISSN_BIBSTEM"])
+    dois = utils.load_classic_doi_bib_map(files["CLASSIC_DOI_FILE"])
+    bibs = utils.merge_bibcode_lists(
+        files["CLASSIC_CANONICAL"],
+        files["CLASSIC_ALTBIBS"],
+        files["CLASSIC_DELBIBS"],
+        files["CLASSIC_ALLBIBS"],
+    )
+    write_blocks(app, issn_bibstem, issns)
+    write_blocks(app, identifier_doi, dois)
+    write_blocks(app, alt_identifiers, bibs)
+    return len(dois) + len(bibs)
+
+
+def bench_classic_query(app, records):
+    for rec in records:
+        db.query_classic_bibcodes(app, rec["doi"], rec["bibcode"])
+    return len(records)
+
+
+def bench_parse(xmlfiles):
+    for infile in xmlfiles:
+        utils.process_one_meta_xml(infile)
+    return len(xmlfiles)
+
+
+def bench_match(cases, related_bibstems):
+    xmatch = CrossrefMatcher(related_bibstems=related_bibstems)
+    xmatch.match_batch(*cases)
+    return len(cases[0])
+
+
+def bench_completeness(app, rows):
+    write_blocks(app, master, rows)
+    for bibstem in [j[0] for j in synthetic.JOURNALS]:
+        volumeSummary = {}
+        for r in db.query_completeness_per_bibstem(app, bibstem.ljust(5, ".")):
+            vol = r[0]
+            if vol[-1] not in ["L", "P"]:
+                vol = vol[0:-1]
+            vol = vol.strip(".")
+            volumeSummary.setdefault(vol, []).append(
+                {"year": r[1], "status": r[2], "matchtype": r[3], "count": r[4]}
+            )
+        for v in volumeSummary.values():
+            utils.get_completeness_fraction(v)
+    return len(rows)
+
+
+def main():
+    args = get_args()
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    for s in stages:
+        if s not in STAGES:
+            raise SystemExit("Unknown stage %s; choose from %s" % (s, ", ".join(STAGES)))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="adscompstat-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    db_url = args.db_url or "sqlite:///%s" % os.path.join(workdir, "bench.sqlite")
+    engine = create_engine(db_url)
+    create_tables(engine)
+    engine.dispose()
+    app = ADSCompStatCelery(
+        "completeness-statistics-benchmark",
+        proj_home=proj_home,
+        local_config={"SQLALCHEMY_URL": db_url, "SQLALCHEMY_ECHO": False},
+    )
+
+    rates = json.loads(args.rates) if args.rates else None
+    corpus = synthetic.SyntheticCorpus(args.scale, rates=rates, seed=args.seed)
+    print("Generating %s synthetic records in %s" % (args.scale, workdir))
+    results = []
+    try:
+        files = corpus.write_classic_files(os.path.join(workdir, "classic"))
+        if "classic_load" in stages or "classic_query" in stages:
+            results.append(run_stage("classic_load", bench_classic_load, app, files))
+        if "classic_query" in stages:
+            records = [corpus.record(i) for i in range(min(args.query_limit, args.scale))]
+            results.append(run_stage("classic_query", bench_classic_query, app, records))
+        if "parse" in stages:
+            harvest = corpus.write_harvest(os.path.join(workdir, "Crossref"), limit=args.xml_limit)
+            xmlfiles = []
+            for logfile in sorted(utils.get_updateagent_logs(harvest["HARVEST_LOG_DIR"])):
+                xmlfiles.extend(
+                    [harvest["HARVEST_BASE_DIR"] + f for f in utils.read_updateagent_log(logfile)]
+                )
+            results.append(run_stage("parse", bench_parse, xmlfiles))
+        if "match" in stages:
+            cases = tuple(map(list, zip(*corpus.match_cases())))
+            with open(files["JOURNALSDB_RELATED_BIBSTEMS"], "r") as fj:
+                related_bibstems = json.load(fj).get("related_bibstems", [])
+            results.append(run_stage("match", bench_match, cases, related_bibstems))
+        if "completeness" in stages:
+            rows = list(corpus.master_rows())
+            results.append(run_stage("completeness", bench_completeness, app, rows))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as fj:
+            json.dump(
+                {
+                    "scale": args.scale,
+                    "seed": args.seed,
+                    "db": db_url.split("://")[0],
+                    "results": results,
+                },
+                fj,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
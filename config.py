@@ -1,6 +1,13 @@
 HARVEST_BASE_DIR = "/app/data/Crossref/"
 HARVEST_LOG_DIR = HARVEST_BASE_DIR + "/UpdateAgent/"
 
+# Harvested xml files may also be stored gzip- or zstd-compressed (as
+# <file>.gz or <file>.zst), or in zip bundles under HARVEST_BUNDLE_DIR, one
+# per directory HARVEST_BUNDLE_DEPTH levels below HARVEST_BASE_DIR (e.g.
+# doi/10.3847/00/67.zip, with a depth of 4), made with run.py --pack-harvest.
+HARVEST_BUNDLE_DIR = None
+HARVEST_BUNDLE_DEPTH = 4
+
 CLASSIC_DOI_FILE = "/app/data/all.links"
 CLASSIC_ALTBIBS = "/app/data/bibcodes.list.alt"
 CLASSIC_DELBIBS = "/app/data/bibcodes.list.del"
@@ -10,5 +17,107 @@ JOURNALSDB_ISSN_BIBSTEM = "/app/data/issn_identifiers"
 COMPLETENESS_EXPORT_FILE = "/app/data/completeness_export.json"
 JOURNALSDB_RELATED_BIBSTEMS = "/app/data/related_bibstems.json"
 
+# If set, loading classic data (run.py -c) also writes a memory-mapped lookup
+# file here, and process-meta workers that can read it look up classic
+# bibcodes in it instead of querying the identifier_doi and alt_identifiers
+# tables.
+CLASSIC_STORE_FILE = None
+
+# If set, loading classic data also writes a Bloom filter of every classic
+# DOI and bibcode here, which process-meta workers without a classic store
+# use to skip the database lookups of DOIs and bibcodes not in classic.
+# CLASSIC_BLOOM_ERROR_RATE is the filter's target false positive rate.
+CLASSIC_BLOOM_FILE = None
+CLASSIC_BLOOM_ERROR_RATE = 0.01
+
+# process-meta workers read up to PREFETCH_DEPTH files of a batch ahead of
+# the one being parsed, on PREFETCH_THREADS threads (default: one per file
+# read ahead), and stop reading ahead while PREFETCH_MAX_BYTES of files are
+# waiting to be parsed.  Set PREFETCH_DEPTH to 0 to read files as they're
+# parsed.
+PREFETCH_DEPTH = 8
+PREFETCH_THREADS = 4
+PREFETCH_MAX_BYTES = 67108864
+
+# If FAST_PARSE is set, process-meta workers stream only the fields needed
+# for matching (DOI, ISSNs, year, volume, issue, first page, first author
+# and title) from each xml file instead of running the full CrossrefParser,
+# which is still used for files the fast extractor can't handle.  It can
+# also be set for a single run with run.py -f.
+FAST_PARSE = False
+
+# If PARSED_RECORD_CACHE_DIR is set (to a local directory), process-meta
+# workers keep each file's parsed record there, keyed by its path and a hash
+# of its contents, so that unchanged files aren't parsed again on retries or
+# when a log is reprocessed.  The least recently used records are removed
+# once the cache is larger than PARSED_RECORD_CACHE_MAX_BYTES.
+PARSED_RECORD_CACHE_DIR = None
+PARSED_RECORD_CACHE_MAX_BYTES = 1073741824
+
+# process-meta workers remember the bibstem and bibcode made for the last
+# BIBCODE_MEMO_SIZE distinct sets of bibliographic fields (publication,
+# pagination and first author), so records repeating them skip the bibstem
+# lookup and bibcode generation.  The memo is cleared when the
+# JOURNALSDB_ISSN_BIBSTEM file changes, and every BIBCODE_MEMO_MAX_AGE
+# seconds in case the issn_bibstem table is reloaded from elsewhere.  Set
+# BIBCODE_MEMO_SIZE to 0 to turn it off.
+BIBCODE_MEMO_SIZE = 100000
+BIBCODE_MEMO_MAX_AGE = 3600
+
 CLASSIC_DATA_BLOCKSIZE = 10000
 RECORDS_PER_BATCH = 250
+
+# Adaptive batching: when BATCH_TARGET_SECONDS is set and a cost model has
+# been fitted from previous batches (stored in BATCH_COST_MODEL_FILE), batches
+# are sized to take roughly that long; otherwise when BATCH_TARGET_BYTES is
+# set, batches are closed once their files add up to that many bytes.
+# RECORDS_PER_BATCH is always the upper limit on files per batch.
+BATCH_TARGET_BYTES = None
+BATCH_TARGET_SECONDS = None
+BATCH_COST_MODEL_FILE = "/app/data/batch_cost_model.json"
+BATCH_COST_MODEL_DECAY = 0.95
+
+# When set, records whose DOI and bibcode are both missing from classic are
+# checked against the classic bibcodes of the same bibstem and volume (from
+# the classic store, or else the database), and are matched as "partial" if
+# a bibcode differing only in qualifier, author initial, page or year (+/- 1)
+# is found.
+FUZZY_MATCH_UNMATCHED = False
+
+# Each process-meta batch logs its per-stage timings (parse, bibstem, bibcode,
+# classic, match, dispatch), throughput and failures as a JSON log line; set
+# METRICS_LOG_RECORDS to also log them for every record.  If METRICS_DIR is
+# set, each worker process keeps its running totals there in Prometheus text
+# format (adscompstat_<host>_<pid>.prom), e.g. for node_exporter's textfile
+# collector; each host removes the files of its exited workers.
+METRICS_DIR = None
+METRICS_LOG_RECORDS = False
+
+# Fraction of task_process_meta, task_completeness_per_bibstem and
+# task_export_completeness_to_json calls to run under cProfile and
+# tracemalloc, writing their reports to PROFILE_OUTPUT_DIR.  Profiling is
+# off unless both are set.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_OUTPUT_DIR = None
+PROFILE_TOP_ALLOCATIONS = 25
+
+# If ASYNC_DB is set, process-meta workers look up the bibstems and classic
+# bibcodes of a whole batch concurrently, and write its records to master
+# themselves instead of through the write-db queue, using asyncio (asyncpg)
+# connections to SQLALCHEMY_URL.  Each worker process keeps a pool of
+# ASYNC_DB_POOL_SIZE (+ ASYNC_DB_MAX_OVERFLOW) connections, and runs up to
+# ASYNC_DB_CONCURRENCY queries at once (default: the pool's size).
+ASYNC_DB = False
+ASYNC_DB_POOL_SIZE = 5
+ASYNC_DB_MAX_OVERFLOW = 0
+ASYNC_DB_CONCURRENCY = None
+
+# Connection pool of each worker's (synchronous) database engine; statement
+# timeout is in milliseconds.  Each task reuses one pooled connection for all
+# of its queries, and the pool's checkouts and wait times are reported with
+# the process-meta batch metrics.
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_TIMEOUT = 30
+SQLALCHEMY_POOL_PRE_PING = True
+SQLALCHEMY_STATEMENT_TIMEOUT = None
@@ -4,7 +4,7 @@ import os
 
 from adsputils import load_config, setup_logging
 
-from adscompstat import tasks, utils
+from adscompstat import bloom, classic_store, harvest_archive, tasks, utils
 from adscompstat.exceptions import (
     DBClearException,
     DBWriteException,
@@ -78,6 +78,33 @@ def get_arguments():
         default=False,
         help="Retry all mismatched and unmatched records",
     )
+    parser.add_argument(
+        "-f",
+        "--fast-parse",
+        dest="fast_parse",
+        action="store_true",
+        default=None,
+        help="Extract only the fields needed for matching from the xml files",
+    )
+    parser.add_argument(
+        "--pack-harvest",
+        dest="pack_harvest",
+        action="store",
+        nargs="?",
+        const="",
+        default=None,
+        help="Pack the harvested xml files (or those in one subdirectory) into bundles",
+    )
+    parser.add_argument(
+        "-s",
+        "--status",
+        dest="run_status",
+        action="store",
+        nargs="?",
+        const="latest",
+        default=None,
+        help="Report progress of a run (default: the most recent one)",
+    )
 
     args = parser.parse_args()
     return args
@@ -131,6 +158,12 @@ def write_to_database(table_def, data):
 
 
 def load_classic_data():
+    # Remove the workers' classic store and bloom filter first, so that they
+    # can't outlive the data they were built from if a step below fails
+    if conf.get("CLASSIC_STORE_FILE", None):
+        classic_store.remove_classic_store(conf.get("CLASSIC_STORE_FILE"))
+    if conf.get("CLASSIC_BLOOM_FILE", None):
+        bloom.remove_bloom_filter(conf.get("CLASSIC_BLOOM_FILE"))
     try:
         # Delete existing classic data store
         tasks.task_clear_classic_data()
@@ -149,12 +182,13 @@ def load_classic_data():
         # load bibcode-DOI map
         infile = conf.get("CLASSIC_DOI_FILE", None)
         if infile:
-            records = utils.load_classic_doi_bib_map(infile)
+            doi_records = utils.load_classic_doi_bib_map(infile)
         else:
+            doi_records = []
             logger.warning("No CLASSIC_DOI_FILE name given.")
-        if records:
+        if doi_records:
             table_def = identifier_doi
-            write_to_database(table_def, records)
+            write_to_database(table_def, doi_records)
         else:
             raise LoadClassicDataException("No DOI-bibcode data found.")
 
@@ -170,6 +204,92 @@ def load_classic_data():
         else:
             raise LoadClassicDataException("No data from canonical/alt/deleted bibcode maps")
 
+        # write the same data to the workers' classic store file, if used
+        store_file = conf.get("CLASSIC_STORE_FILE", None)
+        if store_file:
+            try:
+                (nrecords, ndois) = classic_store.write_classic_store(
+                    store_file, doi_records, records
+                )
+            except Exception as err:
+                logger.error("Classic store not updated: %s" % err)
+            else:
+                logger.info(
+                    "Wrote %s bibcodes and %s DOIs to classic store %s"
+                    % (nrecords, ndois, store_file)
+                )
+
+        # and a bloom filter of its DOIs and bibcodes, if used
+        bloom_file = conf.get("CLASSIC_BLOOM_FILE", None)
+        if bloom_file:
+            try:
+                bloom_filter = bloom.write_bloom_filter(
+                    bloom_file,
+                    doi_records,
+                    records,
+                    error_rate=conf.get("CLASSIC_BLOOM_ERROR_RATE", 0.01),
+                )
+            except Exception as err:
+                logger.error("Classic bloom filter not updated: %s" % err)
+            else:
+                logger.info(
+                    "Wrote %s keys to bloom filter %s, expected false positive rate %.4f"
+                    % (bloom_filter.nitems, bloom_file, bloom_filter.false_positive_rate())
+                )
+
+
+def pack_harvest(subdir=None):
+    (nbundles, nfiles) = harvest_archive.pack_harvest_tree(
+        conf.get("HARVEST_BASE_DIR", "/"),
+        conf.get("HARVEST_BUNDLE_DIR", None),
+        conf.get("HARVEST_BUNDLE_DEPTH", None),
+        subdir=subdir,
+    )
+    logger.info(
+        "Packed %s files into %s bundles in %s"
+        % (nfiles, nbundles, conf.get("HARVEST_BUNDLE_DIR"))
+    )
+
+
+def format_run_status(status, now=None):
+    """
+    Formats the totals of a run from run_status as a progress report with
+    its throughput, estimated time remaining, and the backlog of each stage.
+    """
+    if not now:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    done = status["processed"] + status["failed"]
+    remaining = max(status["dispatched"] - done, 0)
+    rate = None
+    if status["started"] and status["updated"] and done:
+        elapsed = (status["updated"] - status["started"]).total_seconds()
+        if elapsed > 0:
+            rate = done / elapsed
+    if rate and remaining:
+        eta = "%s (at %s)" % (
+            datetime.timedelta(seconds=int(remaining / rate)),
+            (now + datetime.timedelta(seconds=remaining / rate)).strftime("%Y-%m-%d %H:%M:%S"),
+        )
+    elif status["logfiles_pending"] or remaining:
+        eta = "unknown"
+    else:
+        eta = "done"
+    lines = [
+        "Run %s, started %s, last updated %s"
+        % (status["run_id"], status["started"], status["updated"]),
+        "  records: %s expected, %s dispatched, %s processed, %s failed"
+        % (status["expected"], status["dispatched"], status["processed"], status["failed"]),
+        "  logfiles: %s of %s failed" % (status["logfiles_failed"], status["logfiles"]),
+        "  batches: %s of %s done" % (status["batches_done"], status["batches"]),
+        "  throughput: %s" % ("%.1f records/s" % rate if rate else "unknown"),
+        "  eta: %s" % eta,
+        "  backlog:",
+        "    get-logfiles: %s of %s logfiles" % (status["logfiles_pending"], status["logfiles"]),
+        "    process-meta: %s records" % max(remaining - status["queued"], 0),
+        "    write-db: %s records" % status["queued"],
+    ]
+    return "\n".join(lines)
+
 
 def main():
     try:
@@ -185,16 +305,32 @@ def main():
             tasks.task_do_all_completeness()
         elif args.do_json_export:
             tasks.task_export_completeness_to_json()
+        elif args.pack_harvest is not None:
+            try:
+                pack_harvest(args.pack_harvest or None)
+            except Exception as err:
+                logger.error("Failed to pack harvest files: %s" % err)
+        elif args.run_status:
+            run_id = args.run_status if args.run_status != "latest" else None
+            status = tasks.task_get_run_status(run_id)
+            if not status:
+                print("No run status found.")
+            else:
+                print(format_run_status(status))
         elif args.do_retry:
-            for result_type in ["mismatch", "unmatched", "failed"]:
-                tasks.task_retry_records.delay(result_type)
+            result_types = ["mismatch", "unmatched", "failed"]
+            run_id = tasks.task_start_run([tasks.retry_label(r) for r in result_types])
+            for result_type in result_types:
+                tasks.task_retry_records.delay(result_type, run_id, args.fast_parse)
         else:
             logfiles = get_logs(args)
             if not logfiles:
                 logger.warning("No logfiles found! Nothing to do -- stopping.")
             else:
+                run_id = tasks.task_start_run(logfiles)
+                logger.info("Started run %s" % run_id)
                 for logfile in logfiles:
-                    tasks.task_process_logfile.delay(logfile)
+                    tasks.task_process_logfile.delay(logfile, run_id, args.fast_parse)
     except Exception as err:
         logger.error("Process failed: %s" % err)
 
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, text
+
+from adscompstat import app as app_module
+
+
+class TestADSCompStatCelery(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        self.app = app_module.ADSCompStatCelery(
+            "test-app",
+            proj_home=self.tmpdir,
+            local_config={
+                "SQLALCHEMY_URL": self.url,
+                "SQLALCHEMY_POOL_SIZE": 2,
+                "SQLALCHEMY_MAX_OVERFLOW": 1,
+                "SQLALCHEMY_STATEMENT_TIMEOUT": 60000,
+            },
+        )
+
+    def tearDown(self):
+        self.app._engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _configure_pool(self, url):
+        sqlite_engine = create_engine(self.url, poolclass=app_module.TimedQueuePool)
+        with patch("adscompstat.app.create_engine", return_value=sqlite_engine) as mock_create:
+            self.app._configure_pool(url)
+        return mock_create.call_args[1]
+
+    def test_pool_configured(self):
+        kwargs = self._configure_pool("postgresql://user@host/db")
+        self.assertEqual(kwargs["pool_size"], 2)
+        self.assertEqual(kwargs["max_overflow"], 1)
+        self.assertTrue(kwargs["pool_pre_ping"])
+        self.assertEqual(kwargs["poolclass"], app_module.TimedQueuePool)
+        self.assertEqual(kwargs["connect_args"], {"options": "-c statement_timeout=60000"})
+
+    def test_pool_stats(self):
+        self._configure_pool("postgresql://user@host/db")
+        before = self.app.pool_stats()
+        with self.app.session_scope() as session:
+            session.execute(text("select 1"))
+        with self.app.session_scope() as session:
+            session.execute(text("select 1"))
+        stats = self.app.pool_stats()
+        self.assertEqual(stats["checkouts"] - before["checkouts"], 2)
+        self.assertEqual(stats["waits"] - before["waits"], 2)
+        self.assertEqual(stats["size"], 5)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertGreaterEqual(stats["max_wait"], stats["avg_wait"])
+
+    def test_task_session_reused(self):
+        self._configure_pool("postgresql://user@host/db")
+        before = self.app.pool_stats()["checkouts"]
+        with self.app.task_session() as outer:
+            for i in range(3):
+                with self.app.session_scope() as session:
+                    self.assertIs(session, outer)
+                    session.execute(text("select 1"))
+                    session.commit()
+            with self.app.task_session() as nested:
+                self.assertIs(nested, outer)
+        self.assertEqual(self.app.pool_stats()["checkouts"] - before, 1)
+        self.assertIsNone(self.app._task_session.session)
+
+    def test_task_session_cleared_on_exception(self):
+        with self.assertRaises(ValueError):
+            with self.app.task_session():
+                with self.app.session_scope():
+                    raise ValueError("bad query")
+        self.assertIsNone(self.app._task_session.session)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from benchmarks import run_benchmarks
+
+
+class TestRunBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_stage(self):
+        with patch("builtins.print"):
+            result = run_benchmarks.run_stage("match", lambda n: n, 50)
+        self.assertEqual(result["stage"], "match")
+        self.assertEqual(result["items"], 50)
+        self.assertGreater(result["items_per_sec"], 0)
+        self.assertGreater(result["peak_rss_mb"], 0)
+
+    def test_main_sqlite(self):
+        # the stages that don't need the xml parser, on a small corpus
+        output = os.path.join(self.tmpdir, "results.json")
+        argv = [
+            "run_benchmarks",
+            "--scale",
+            "200",
+            "--query-limit",
+            "50",
+            "--stages",
+            "classic_query,match,completeness",
+            "--workdir",
+            os.path.join(self.tmpdir, "work"),
+            "--output",
+            output,
+        ]
+        with patch("sys.argv", argv), patch("builtins.print"):
+            run_benchmarks.main()
+        with open(output, "r") as fj:
+            results = json.load(fj)
+        self.assertEqual((results["scale"], results["db"]), (200, "sqlite"))
+        stages = dict([(r["stage"], r["items"]) for r in results["results"]])
+        self.assertEqual(
+            sorted(stages), ["classic_load", "classic_query", "completeness", "match"]
+        )
+        self.assertGreater(stages["classic_load"], 200)
+        self.assertEqual(stages["classic_query"], 50)
+        self.assertEqual(stages["match"], 200)
+        self.assertEqual(stages["completeness"], 200)
+
+    def test_unknown_stage(self):
+        with patch("sys.argv", ["run_benchmarks", "--stages", "parse,bogus"]):
+            with self.assertRaises(SystemExit):
+                run_benchmarks.main()
+
+
+if __name__ == "__main__":
+    unittest.main()
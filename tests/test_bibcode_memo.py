@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from adscompstat import bibcode_memo
+
+RECORD = {
+    "publication": {
+        "pubName": "The Astrophysical Journal",
+        "ISSN": [{"pubtype": "print", "issnString": "0004-637X"}],
+        "pubYear": "2000",
+        "volumeNum": "999",
+    },
+    "pubDate": {"printDate": "2000-01-01"},
+    "persistentIDs": [{"DOI": "10.1086/999001"}],
+    "pagination": {"firstPage": "1"},
+    "authors": [{"name": {"surname": "Doe", "given_name": "J."}}, {"name": {"surname": "Roe"}}],
+    "title": {"textEnglish": "A title"},
+}
+
+
+class TestBibcodeMemo(unittest.TestCase):
+    def setUp(self):
+        bibcode_memo._memo_cache["memo"] = None
+
+    def tearDown(self):
+        bibcode_memo._memo_cache["memo"] = None
+
+    def test_memo_key(self):
+        key = bibcode_memo.memo_key(RECORD)
+        # only the fields the bibstem and bibcode are made from count
+        reordered = dict(reversed(list(RECORD.items())), title={"textEnglish": "Other"})
+        reordered["authors"] = RECORD["authors"][0:1]
+        self.assertEqual(bibcode_memo.memo_key(reordered), key)
+        for field, value in [
+            ("publication", dict(RECORD["publication"], volumeNum="998")),
+            ("pagination", {"firstPage": "2"}),
+            ("authors", [{"name": {"surname": "Roe"}}]),
+            ("authors", [{"name": {"surname": "Doe", "given_name": "K."}}]),
+            ("pubDate", {"printDate": "2001-01-01"}),
+            ("persistentIDs", [{"DOI": "10.1086/999002"}]),
+        ]:
+            self.assertNotEqual(bibcode_memo.memo_key(dict(RECORD, **{field: value})), key)
+        self.assertEqual(
+            bibcode_memo.memo_key({"publication": {}}),
+            bibcode_memo.memo_key({"publication": {}, "authors": []}),
+        )
+
+    def test_memo_key_pub_date(self):
+        # records differing only in pubDate can be given different years
+        other = dict(RECORD, pubDate={"electrDate": "1999-12-01"})
+        self.assertNotEqual(bibcode_memo.memo_key(other), bibcode_memo.memo_key(RECORD))
+        memo = bibcode_memo.BibcodeMemo()
+        memo.put(bibcode_memo.memo_key(RECORD), "ApJ..", "2000ApJ...999....1D")
+        self.assertIsNone(memo.get(bibcode_memo.memo_key(other)))
+
+    def test_lru_eviction(self):
+        memo = bibcode_memo.BibcodeMemo(maxsize=2)
+        memo.put(b"a", "ApJ..", "A")
+        memo.put(b"b", "ApJ..", "B")
+        self.assertEqual(memo.get(b"a"), ("ApJ..", "A"))
+        memo.put(b"c", "ApJ..", "C")
+        self.assertIsNone(memo.get(b"b"))
+        self.assertEqual(memo.get(b"a"), ("ApJ..", "A"))
+        self.assertEqual(memo.get(b"c"), ("ApJ..", "C"))
+        self.assertEqual(memo.evictions, 1)
+        self.assertEqual(len(memo), 2)
+
+    def test_validate(self):
+        memo = bibcode_memo.BibcodeMemo()
+        memo.validate((1.0, 10))
+        memo.put(b"a", "ApJ..", "A")
+        memo.validate((1.0, 10))
+        self.assertEqual(len(memo), 1)
+        memo.validate((2.0, 10))
+        self.assertEqual(len(memo), 0)
+        memo.put(b"a", "ApJ..", "A")
+        memo.validate((2.0, 10), max_age=60)
+        self.assertEqual(len(memo), 1)
+        with patch("adscompstat.bibcode_memo.time.time", return_value=memo.cleared + 61):
+            memo.validate((2.0, 10), max_age=60)
+        self.assertEqual(len(memo), 0)
+
+    def test_get_bibcode_memo_cleared_on_issn_file_change(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            issn_file = os.path.join(tmpdir, "issn2bibstem.txt")
+            with open(issn_file, "w") as fi:
+                fi.write("0004-637X\tApJ..\n")
+            memo = bibcode_memo.get_bibcode_memo(10, issn_file=issn_file)
+            memo.put(b"a", "ApJ..", "A")
+            self.assertIs(bibcode_memo.get_bibcode_memo(10, issn_file=issn_file), memo)
+            self.assertEqual(len(memo), 1)
+            with open(issn_file, "a") as fi:
+                fi.write("1538-4357\tApJ..\n")
+            self.assertEqual(len(bibcode_memo.get_bibcode_memo(10, issn_file=issn_file)), 0)
+        self.assertIsNone(bibcode_memo.issn_map_stamp(issn_file))
+        self.assertIsNone(bibcode_memo.issn_map_stamp(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from adscompstat import bloom
+from adscompstat.exceptions import BloomFilterException
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bloomfile = os.path.join(self.tmpdir, "classic_bloom.bin")
+        self.doi_records = [
+            {"doi": "10.1000/%s" % i, "identifier": "2020ApJ...%03d..100A" % i}
+            for i in range(2000)
+        ]
+        self.alt_records = [
+            {
+                "identifier": "2020ApJ...%03d..100A" % i,
+                "canonical_id": "2020ApJ...%03d..100A" % i,
+                "idtype": "canonical",
+            }
+            for i in range(1000)
+        ]
+        bloom._bloom_cache["bloom"] = None
+
+    def tearDown(self):
+        bloom._bloom_cache["bloom"] = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_filter_size(self):
+        (nbits, nhashes) = bloom.filter_size(1000, 0.01)
+        self.assertEqual(nbits % 8, 0)
+        self.assertTrue(9000 < nbits < 10000)
+        self.assertEqual(nhashes, 7)
+
+    def test_no_false_negatives(self):
+        bf = bloom.BloomFilter.for_capacity(3000, 0.01)
+        for rec in self.doi_records:
+            bf.add(bloom.DOI_PREFIX + rec["doi"])
+        for rec in self.doi_records:
+            self.assertTrue(bf.may_contain_doi(rec["doi"]))
+        # a DOI isn't taken for a bibcode of the same spelling
+        self.assertFalse(all([bf.may_contain_bibcode(r["doi"]) for r in self.doi_records]))
+
+    def test_false_positive_rate(self):
+        bf = bloom.write_bloom_filter(self.bloomfile, self.doi_records, self.alt_records)
+        self.assertAlmostEqual(bf.false_positive_rate(), 0.01, delta=0.005)
+        misses = [bf.may_contain_doi("10.9999/%s" % i) for i in range(20000)]
+        self.assertLess(sum(misses) / 20000.0, 0.02)
+
+    def test_write_and_read(self):
+        written = bloom.write_bloom_filter(self.bloomfile, self.doi_records, self.alt_records)
+        bf = bloom.read_bloom_filter(self.bloomfile)
+        self.assertEqual((bf.nbits, bf.nhashes, bf.nitems), (written.nbits, written.nhashes, 3000))
+        self.assertEqual(bytes(bf.bits), bytes(written.bits))
+        self.assertTrue(bf.may_contain_doi("10.1000/1999"))
+        self.assertTrue(bf.may_contain_bibcode("2020ApJ...999..100A"))
+
+    def test_read_bad_file(self):
+        with open(self.bloomfile, "wb") as fb:
+            fb.write(b"not a bloom filter at all")
+        with self.assertRaises(BloomFilterException):
+            bloom.read_bloom_filter(self.bloomfile)
+        with self.assertRaises(BloomFilterException):
+            bloom.read_bloom_filter(os.path.join(self.tmpdir, "missing.bin"))
+
+    def test_write_bad_path(self):
+        with self.assertRaises(BloomFilterException):
+            bloom.write_bloom_filter("/nonexistent_path/bloom.bin", self.doi_records, [])
+
+    def test_get_bloom_filter(self):
+        self.assertIsNone(bloom.get_bloom_filter(self.bloomfile))
+        bloom.write_bloom_filter(self.bloomfile, self.doi_records, self.alt_records)
+        bf = bloom.get_bloom_filter(self.bloomfile)
+        self.assertIs(bloom.get_bloom_filter(self.bloomfile), bf)
+        # reopened once the file is replaced
+        bloom.write_bloom_filter(self.bloomfile, self.doi_records[0:10], [])
+        os.utime(self.bloomfile, (0, 0))
+        reopened = bloom.get_bloom_filter(self.bloomfile)
+        self.assertIsNot(reopened, bf)
+        self.assertEqual(reopened.nitems, 10)
+
+    def test_failed_write_removes_old_filter(self):
+        bloom.write_bloom_filter(self.bloomfile, self.doi_records, self.alt_records)
+        self.assertIsNotNone(bloom.get_bloom_filter(self.bloomfile))
+        with patch("adscompstat.bloom.os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(BloomFilterException):
+                bloom.write_bloom_filter(self.bloomfile, self.doi_records, self.alt_records)
+        # so workers make every lookup rather than trust the old filter
+        self.assertFalse(os.path.exists(self.bloomfile))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertIsNone(bloom.get_bloom_filter(self.bloomfile))
+        bloom.remove_bloom_filter(self.bloomfile)
+
+
+if __name__ == "__main__":
+    unittest.main()
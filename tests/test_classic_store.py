@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from adscompstat import classic_store
+from adscompstat.exceptions import ClassicStoreException
+
+
+class TestClassicStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storefile = os.path.join(self.tmpdir, "classic_store.bin")
+        self.doi_records = [
+            {"doi": "10.1000/abc", "identifier": "2020ApJ...900..100A"},
+            {"doi": "10.1000/def", "identifier": "2021MNRAS.500.1234B"},
+            {"doi": "10.1000/nobib", "identifier": "2019AJ....158....1C"},
+        ]
+        self.alt_records = [
+            {
+                "identifier": "2020ApJ...900..100A",
+                "canonical_id": "2020ApJ...900..100A",
+                "idtype": "canonical",
+            },
+            {
+                "identifier": "2020arXiv200100001A",
+                "canonical_id": "2020ApJ...900..100A",
+                "idtype": "alternate",
+            },
+            {
+                "identifier": "2021MNRAS.500.1234B",
+                "canonical_id": "2021MNRAS.500.1234B",
+                "idtype": "canonical",
+            },
+            {
+                "identifier": "2021MNRAS.tmp..123B",
+                "canonical_id": "2021MNRAS.500.1234B",
+                "idtype": "deleted",
+            },
+        ]
+        classic_store._store_cache["store"] = None
+
+    def tearDown(self):
+        if classic_store._store_cache["store"]:
+            classic_store._store_cache["store"].close()
+        classic_store._store_cache["store"] = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_and_query(self):
+        (nrecords, ndois) = classic_store.write_classic_store(
+            self.storefile, self.doi_records, self.alt_records
+        )
+        self.assertEqual(nrecords, 4)
+        # the DOI whose bibcode has no alt_identifiers rows isn't stored
+        self.assertEqual(ndois, 2)
+
+        store = classic_store.ClassicStore(self.storefile)
+        (fromDoi, fromBib) = store.query_classic_bibcodes("10.1000/abc", "2020ApJ...900..100A")
+        self.assertEqual(
+            sorted(fromDoi),
+            [
+                ("2020ApJ...900..100A", "2020ApJ...900..100A", "canonical"),
+                ("2020arXiv200100001A", "2020ApJ...900..100A", "alternate"),
+            ],
+        )
+        self.assertEqual(fromBib, [("2020ApJ...900..100A", "2020ApJ...900..100A", "canonical")])
+
+        (fromDoi, fromBib) = store.query_classic_bibcodes("10.1000/def", "2021MNRAS.tmp..123B")
+        self.assertEqual(len(fromDoi), 2)
+        self.assertEqual(fromBib, [("2021MNRAS.tmp..123B", "2021MNRAS.500.1234B", "deleted")])
+
+        self.assertEqual(store.query_classic_bibcodes("10.1000/xyz", "2022ApJ...1..1Z"), ([], []))
+        self.assertEqual(store.query_classic_bibcodes("", None), ([], []))
+        store.close()
+
+    def test_matches_database_semantics(self):
+        # same rows as the DOI join and identifier filter in
+        # database.query_classic_bibcodes would return
+        classic_store.write_classic_store(self.storefile, self.doi_records, self.alt_records)
+        store = classic_store.ClassicStore(self.storefile)
+        for doi_rec in self.doi_records:
+            expected = [
+                (r["identifier"], r["canonical_id"], r["idtype"])
+                for r in self.alt_records
+                if r["canonical_id"] == doi_rec["identifier"]
+            ]
+            self.assertEqual(sorted(store.lookup_doi(doi_rec["doi"])), sorted(expected))
+        for alt_rec in self.alt_records:
+            self.assertEqual(
+                store.lookup_bibcode(alt_rec["identifier"]),
+                [(alt_rec["identifier"], alt_rec["canonical_id"], alt_rec["idtype"])],
+            )
+        store.close()
+
+    def test_lookup_prefixes(self):
+        classic_store.write_classic_store(self.storefile, self.doi_records, self.alt_records)
+        store = classic_store.ClassicStore(self.storefile)
+        self.assertEqual(
+            [r[0] for r in store.lookup_prefixes(["2019MNRAS.500", "2021MNRAS.500", "2020ApJ"])],
+            ["2021MNRAS.500.1234B", "2020ApJ...900..100A"],
+        )
+        self.assertEqual(store.lookup_prefixes(["2021MNRAS.501"]), [])
+        store.close()
+
+    def test_empty_store(self):
+        classic_store.write_classic_store(self.storefile, [], [])
+        store = classic_store.ClassicStore(self.storefile)
+        self.assertEqual(
+            store.query_classic_bibcodes("10.1000/abc", "2020ApJ...900..100A"), ([], [])
+        )
+        store.close()
+
+    def test_bad_file(self):
+        with open(self.storefile, "wb") as fs:
+            fs.write(b"not a classic store, but long enough to have a header........")
+        with self.assertRaises(ClassicStoreException):
+            classic_store.ClassicStore(self.storefile)
+        with self.assertRaises(ClassicStoreException):
+            classic_store.ClassicStore(os.path.join(self.tmpdir, "missing.bin"))
+
+    def test_write_failure(self):
+        with self.assertRaises(ClassicStoreException):
+            classic_store.write_classic_store(
+                os.path.join(self.tmpdir, "nodir", "store.bin"), [], []
+            )
+
+    def test_duplicate_doi_keeps_first_bibcode(self):
+        # as identifier_doi, whose dois are unique
+        doi_records = [
+            {"doi": "10.1000/abc", "identifier": "2021MNRAS.500.1234B"},
+            {"doi": "10.1000/abc", "identifier": "2020ApJ...900..100A"},
+        ]
+        (nrecords, ndois) = classic_store.write_classic_store(
+            self.storefile, doi_records, self.alt_records
+        )
+        self.assertEqual(ndois, 1)
+        store = classic_store.ClassicStore(self.storefile)
+        self.assertEqual(
+            sorted(store.lookup_doi("10.1000/abc")),
+            [
+                ("2021MNRAS.500.1234B", "2021MNRAS.500.1234B", "canonical"),
+                ("2021MNRAS.tmp..123B", "2021MNRAS.500.1234B", "deleted"),
+            ],
+        )
+        store.close()
+
+    def test_doi_hash_collision(self):
+        with patch("adscompstat.classic_store.doi_hash", return_value=1):
+            with self.assertRaises(ClassicStoreException):
+                classic_store.write_classic_store(
+                    self.storefile, self.doi_records, self.alt_records
+                )
+
+    def test_failed_write_removes_old_store(self):
+        classic_store.write_classic_store(self.storefile, self.doi_records, self.alt_records)
+        self.assertIsNotNone(classic_store.get_classic_store(self.storefile))
+        with patch("adscompstat.classic_store.os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(ClassicStoreException):
+                classic_store.write_classic_store(
+                    self.storefile, self.doi_records, self.alt_records
+                )
+        # so workers go back to the database rather than use the old data
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertIsNone(classic_store.get_classic_store(self.storefile))
+        classic_store.remove_classic_store(self.storefile)
+
+    def test_get_classic_store_reopens_replaced_file(self):
+        self.assertIsNone(classic_store.get_classic_store(self.storefile))
+        classic_store.write_classic_store(self.storefile, self.doi_records, self.alt_records)
+        store = classic_store.get_classic_store(self.storefile)
+        self.assertEqual(store.nrecords, 4)
+        self.assertIs(classic_store.get_classic_store(self.storefile), store)
+
+        classic_store.write_classic_store(self.storefile, [], self.alt_records[:1])
+        newstore = classic_store.get_classic_store(self.storefile)
+        self.assertIsNot(newstore, store)
+        self.assertEqual(newstore.nrecords, 1)
@@ -1,6 +1,9 @@
 import unittest
 from unittest.mock import MagicMock, patch
 
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import postgresql
+
 from adscompstat import database as db
 from adscompstat.database import (
     DBClearClassicException,
@@ -8,6 +11,8 @@ from adscompstat.database import (
     DBQueryException,
     DBWriteException,
 )
+from adscompstat.models import Base
+from adscompstat.models import CompStatMaster as master
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -172,30 +177,79 @@ class TestClearSummaryData(unittest.TestCase):
         mock_session.flush.assert_called()
 
 
+class TestContentHash(unittest.TestCase):
+    def test_record_hash(self):
+        record = _make_matched_record()
+        self.assertEqual(db.record_hash(record), db.record_hash(list(record)))
+        self.assertEqual(db.master_columns(record)["content_hash"], db.record_hash(record))
+        self.assertNotEqual(
+            db.record_hash(record), db.record_hash(_make_matched_record(notes="changed"))
+        )
+
+    def test_query_master_hashes(self):
+        mock_app, mock_session = make_mock_app()
+        query = mock_session.query.return_value.filter.return_value
+        query.all.side_effect = [
+            [("10.1/%s" % i, "h%s" % i) for i in range(1000)],
+            [("10.1/x", None)],
+        ]
+        hashes = db.query_master_hashes(mock_app, ["10.1/%s" % i for i in range(1001)])
+        self.assertEqual(len(hashes), 1001)
+        self.assertEqual(hashes["10.1/5"], "h5")
+        self.assertIsNone(hashes["10.1/x"])
+        self.assertEqual(query.all.call_count, 2)
+
+    def test_query_master_hashes_exception(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.side_effect = Exception("query failed")
+        with self.assertRaises(DBQueryException):
+            db.query_master_hashes(mock_app, ["10.1/a"])
+
+
+class TestHotPathStatements(unittest.TestCase):
+    def test_statements_cached(self):
+        # each call reuses the same statement, and so its compiled form
+        engine = create_engine("sqlite://", query_cache_size=100)
+        Base.metadata.create_all(engine)
+        with engine.connect() as conn:
+            for issn in ["0004-637X", "0035-8711", "0004-6256"]:
+                conn.execute(db.BIBSTEM_BY_ISSN, {"issn": issn}).first()
+                conn.execute(db.CLASSIC_BY_DOI, {"doi": issn}).all()
+                conn.execute(db.CLASSIC_BY_BIBCODE, {"bibcode": issn}).all()
+        self.assertEqual(len(engine._compiled_cache), 3)
+
+    def test_query_classic_bibcodes(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.execute.return_value.all.side_effect = [["a"], ["b"]]
+        result = db.query_classic_bibcodes(mock_app, "10.1234/abc", "2000ApJ...999..999Z")
+        self.assertEqual(result, (["a"], ["b"]))
+        self.assertEqual(
+            [c[0][0] for c in mock_session.execute.call_args_list],
+            [db.CLASSIC_BY_DOI, db.CLASSIC_BY_BIBCODE],
+        )
+
+
 # ---------------------------------------------------------------------------
-# query_master_by_doi
+# query_candidate_bibcodes
 # ---------------------------------------------------------------------------
 
 
-class TestQueryMasterByDoi(unittest.TestCase):
-    def test_returns_query_result(self):
-        mock_app, mock_session = make_mock_app()
-        expected = [("10.1234/abc",)]
-        mock_session.query.return_value.filter_by.return_value.all.return_value = expected
-        result = db.query_master_by_doi(mock_app, "10.1234/abc")
-        self.assertEqual(result, expected)
-
-    def test_empty_result(self):
+class TestQueryCandidateBibcodes(unittest.TestCase):
+    def test_returns_rows(self):
         mock_app, mock_session = make_mock_app()
-        mock_session.query.return_value.filter_by.return_value.all.return_value = []
-        result = db.query_master_by_doi(mock_app, "10.9999/zzz")
-        self.assertEqual(result, [])
+        expected = [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "canonical")]
+        mock_session.execute.return_value.all.return_value = expected
+        self.assertEqual(
+            db.query_candidate_bibcodes(mock_app, ["2000ApJ...999", "2001ApJ...999"]), expected
+        )
+        statement = str(mock_session.execute.call_args[0][0])
+        self.assertEqual(statement.count("LIKE"), 2)
 
-    def test_query_exception_raises_db_query_exception(self):
+    def test_exception_raises_db_query_exception(self):
         mock_app, mock_session = make_mock_app()
-        mock_session.query.side_effect = Exception("query error")
+        mock_session.execute.side_effect = Exception("query error")
         with self.assertRaises(DBQueryException):
-            db.query_master_by_doi(mock_app, "10.1234/abc")
+            db.query_candidate_bibcodes(mock_app, ["2000ApJ...999"])
 
 
 # ---------------------------------------------------------------------------
@@ -247,29 +301,59 @@ class TestWriteBlock(unittest.TestCase):
 
 
 class TestWriteMatchedRecord(unittest.TestCase):
-    def test_insert_new_record_when_result_empty(self):
-        # Empty result from query_master_by_doi → new row added
+    def _run(self, rowcount=1, dialect="postgresql"):
         mock_app, mock_session = make_mock_app()
-        db.write_matched_record(mock_app, [], _make_matched_record())
-        mock_session.add.assert_called_once()
+        mock_session.get_bind.return_value.dialect.name = dialect
+        mock_session.execute.return_value.rowcount = rowcount
+        written = db.write_matched_record(mock_app, _make_matched_record())
+        return written, mock_session
+
+    def test_single_upsert(self):
+        written, mock_session = self._run()
+        self.assertTrue(written)
+        mock_session.execute.assert_called_once()
+        mock_session.query.assert_not_called()
         mock_session.commit.assert_called_once()
+        sql = str(mock_session.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+        self.assertIn("ON CONFLICT (master_doi) DO UPDATE", sql)
+        self.assertIn("master.content_hash IS DISTINCT FROM excluded.content_hash", sql)
 
-    def test_update_existing_record_when_result_nonempty(self):
-        # Non-empty result → update_master_by_doi called, not session.add
-        mock_app, mock_session = make_mock_app()
-        with patch("adscompstat.database.update_master_by_doi") as mock_update:
-            db.write_matched_record(mock_app, [("existing_row",)], _make_matched_record())
-            mock_update.assert_called_once()
-        mock_session.add.assert_not_called()
+    def test_upsert_without_hash_compares_columns(self):
+        row = db.master_columns(_make_matched_record())
+        del row["content_hash"]
+        sql = str(db.master_upsert("postgresql", row).compile(dialect=postgresql.dialect()))
+        self.assertIn("master.master_bibdata IS DISTINCT FROM excluded.master_bibdata", sql)
+
+    def test_unchanged_row(self):
+        written, mock_session = self._run(rowcount=0)
+        self.assertFalse(written)
 
-    def test_exception_on_add_raises_db_write_exception(self):
+    def test_exception_raises_db_write_exception(self):
         mock_app, mock_session = make_mock_app()
-        mock_session.add.side_effect = Exception("write error")
+        mock_session.execute.side_effect = Exception("write error")
         with self.assertRaises(DBWriteException):
-            db.write_matched_record(mock_app, [], _make_matched_record())
+            db.write_matched_record(mock_app, _make_matched_record())
         mock_session.rollback.assert_called()
         mock_session.flush.assert_called()
 
+    def test_upsert_sqlite(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        record = _make_matched_record()
+        with engine.connect() as conn:
+            upsert = db.master_upsert("sqlite", db.master_columns(record))
+            self.assertEqual(conn.execute(upsert).rowcount, 1)
+            self.assertEqual(conn.execute(upsert).rowcount, 0)
+            (created, updated) = conn.execute(select(master.created, master.updated)).first()
+            self.assertIsNotNone(created)
+            self.assertIsNone(updated)
+            changed = db.master_columns(_make_matched_record(status="Unmatched"))
+            self.assertEqual(conn.execute(db.master_upsert("sqlite", changed)).rowcount, 1)
+            rows = conn.execute(select(master.status, master.updated)).all()
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0][0], "Unmatched")
+            self.assertIsNotNone(rows[0][1])
+
 
 # ---------------------------------------------------------------------------
 # write_completeness_summary
@@ -296,25 +380,102 @@ class TestWriteCompletenessSummary(unittest.TestCase):
 
 
 # ---------------------------------------------------------------------------
-# update_master_by_doi
+# run_status
 # ---------------------------------------------------------------------------
 
 
-class TestUpdateMasterByDoi(unittest.TestCase):
-    def test_success_calls_filter_update_commit(self):
+class TestRunStatus(unittest.TestCase):
+    def test_write_run_logfiles(self):
         mock_app, mock_session = make_mock_app()
-        update = {"master_doi": "10.1234/abc", "status": "Matched"}
-        db.update_master_by_doi(mock_app, update)
-        mock_session.query.assert_called_once()
+        db.write_run_logfiles(mock_app, "run1", ["a.out", "b.out"])
+        rows = mock_session.bulk_insert_mappings.call_args[0][1]
+        self.assertEqual(
+            [(r["logfile"], r["batch"]) for r in rows], [("a.out", -1), ("b.out", -1)]
+        )
+
+    def test_write_run_batches(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.return_value.filter_by.return_value.update.return_value = 1
+        db.write_run_batches(mock_app, "run1", "a.out", [100, 20])
+        update = mock_session.query.return_value.filter_by.return_value.update.call_args[0][0]
+        self.assertEqual(update["expected"], 120)
+        rows = mock_session.bulk_insert_mappings.call_args[0][1]
+        self.assertEqual([(r["batch"], r["expected"]) for r in rows], [(0, 100), (1, 20)])
         mock_session.commit.assert_called_once()
 
-    def test_exception_raises_db_write_exception(self):
+    def test_write_run_batches_adds_missing_logfile(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.return_value.filter_by.return_value.update.return_value = 0
+        db.write_run_batches(mock_app, "run1", "retry:failed", [5])
+        rows = mock_session.bulk_insert_mappings.call_args[0][1]
+        self.assertEqual([(r["batch"], r["expected"]) for r in rows], [(0, 5), (-1, 5)])
+
+    def test_write_run_batches_exception(self):
         mock_app, mock_session = make_mock_app()
-        mock_session.query.side_effect = Exception("update failed")
+        mock_session.query.side_effect = Exception("write failed")
         with self.assertRaises(DBWriteException):
-            db.update_master_by_doi(mock_app, {"master_doi": "10.1234/abc"})
+            db.write_run_batches(mock_app, "run1", "a.out", [1])
         mock_session.rollback.assert_called()
-        mock_session.flush.assert_called()
+
+    def test_update_run_batch(self):
+        mock_app, mock_session = make_mock_app()
+        db.update_run_batch(mock_app, "run1", "a.out", 3, 98, 2)
+        mock_session.query.return_value.filter_by.assert_called_once_with(
+            run_id="run1", logfile="a.out", batch=3
+        )
+        update = mock_session.query.return_value.filter_by.return_value.update.call_args[0][0]
+        # the counts are added to the row's, not set
+        self.assertEqual(
+            [str(update[k]) for k in ("processed", "failed", "queued")],
+            [
+                "run_status.processed + :processed_1",
+                "run_status.failed + :failed_1",
+                "run_status.queued + :queued_1",
+            ],
+        )
+        mock_session.commit.assert_called_once()
+
+    def test_fail_run_logfile(self):
+        mock_app, mock_session = make_mock_app()
+        db.fail_run_logfile(mock_app, "run1", "a.out")
+        mock_session.query.return_value.filter_by.assert_called_once_with(
+            run_id="run1", logfile="a.out", batch=-1
+        )
+        update = mock_session.query.return_value.filter_by.return_value.update.call_args[0][0]
+        self.assertEqual((update["expected"], update["failed"]), (0, 1))
+        mock_session.commit.assert_called_once()
+
+    def test_fail_run_logfile_exception(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.side_effect = Exception("write failed")
+        with self.assertRaises(DBWriteException):
+            db.fail_run_logfile(mock_app, "run1", "a.out")
+        mock_session.rollback.assert_called()
+
+    def test_query_latest_run_id(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.return_value.order_by.return_value.first.return_value = ("run2",)
+        self.assertEqual(db.query_latest_run_id(mock_app), "run2")
+        mock_session.query.return_value.order_by.return_value.first.return_value = None
+        self.assertIsNone(db.query_latest_run_id(mock_app))
+
+    def test_query_run_status(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.return_value.filter.return_value.one.side_effect = [
+            (3, 1, 1, 120, "t0"),
+            (3, None, 120, 40, 2, 5, "t1"),
+        ]
+        status = db.query_run_status(mock_app, "run1")
+        self.assertEqual((status["logfiles_pending"], status["logfiles_failed"]), (1, 1))
+        self.assertEqual(status["batches_done"], 0)
+        self.assertEqual((status["processed"], status["failed"], status["queued"]), (40, 2, 5))
+        self.assertEqual((status["started"], status["updated"]), ("t0", "t1"))
+
+    def test_query_run_status_exception(self):
+        mock_app, mock_session = make_mock_app()
+        mock_session.query.side_effect = Exception("query failed")
+        with self.assertRaises(DBQueryException):
+            db.query_run_status(mock_app, "run1")
 
 
 if __name__ == "__main__":
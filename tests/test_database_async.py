@@ -0,0 +1,147 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from adscompstat import database_async
+from adscompstat.database import DBWriteException
+from adscompstat.models import Base
+from adscompstat.models import CompStatAltIdents as alt_identifiers
+from adscompstat.models import CompStatIdentDoi as identifier_doi
+from adscompstat.models import CompStatIssnBibstem as issn_bibstem
+from adscompstat.models import CompStatMaster as master
+
+
+def _record(doi, status="Matched", notes=""):
+    return (
+        "/path/%s.xml" % doi,
+        doi,
+        "{}",
+        "{}",
+        "{}",
+        status,
+        "canonical",
+        "2000ApJ...999..999Z",
+        "2000ApJ...999..999Z",
+        notes,
+    )
+
+
+class TestAsyncUrl(unittest.TestCase):
+    def test_async_url(self):
+        self.assertEqual(
+            database_async.async_url("postgresql://u:p@host:5432/db"),
+            "postgresql+asyncpg://u:p@host:5432/db",
+        )
+        self.assertEqual(
+            database_async.async_url("postgresql+psycopg2://host/db"),
+            "postgresql+asyncpg://host/db",
+        )
+        self.assertEqual(
+            database_async.async_url("sqlite:////tmp/x.db"), "sqlite+aiosqlite:////tmp/x.db"
+        )
+        self.assertEqual(
+            database_async.async_url("postgresql+asyncpg://host/db"),
+            "postgresql+asyncpg://host/db",
+        )
+
+
+@unittest.skipIf(importlib.util.find_spec("aiosqlite") is None, "aiosqlite not installed")
+class TestAsyncDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine = create_engine(self.url)
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all(
+            [
+                issn_bibstem(issn="0004-637X", bibstem="ApJ", issn_type="print"),
+                identifier_doi(doi="10.1234/a", identifier="2000ApJ...999..999Z"),
+                alt_identifiers(
+                    identifier="2000ApJ...999..999Z",
+                    canonical_id="2000ApJ...999..999Z",
+                    idtype="canonical",
+                ),
+            ]
+        )
+        self.session.commit()
+        self.adb = database_async.AsyncDatabase(self.url, concurrency=2)
+
+    def tearDown(self):
+        self.adb.close()
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_query_bibstems(self):
+        records = [
+            {"publication": {"ISSN": [{"issnString": "1111-1111"}, {"issnString": "0004637X"}]}},
+            {"publication": {"ISSN": [{"issnString": "2222-2222"}]}},
+            {},
+        ]
+        self.assertEqual(self.adb.query_bibstems(records), ["ApJ", "", ""])
+
+    def test_query_bibstem_after_failed_issn(self):
+        # the session is rolled back after a failed query, so the next ISSN
+        # is still looked up
+        execute = AsyncSession.execute
+        calls = []
+
+        async def failing_first(session, *args, **kwargs):
+            calls.append(args[1]["issn"])
+            if len(calls) == 1:
+                raise Exception("query failed")
+            return await execute(session, *args, **kwargs)
+
+        record = {
+            "publication": {"ISSN": [{"issnString": "1111-1111"}, {"issnString": "0004637X"}]}
+        }
+        with patch.object(AsyncSession, "execute", failing_first), patch.object(
+            AsyncSession, "rollback", autospec=True, side_effect=AsyncSession.rollback
+        ) as mock_rollback:
+            self.assertEqual(self.adb.query_bibstems([record]), ["ApJ"])
+        self.assertEqual(calls, ["1111-1111", "0004-637X"])
+        mock_rollback.assert_called_once()
+
+    def test_query_classic_bibcodes_batch(self):
+        results = self.adb.query_classic_bibcodes_batch(
+            [("10.1234/a", "2000ApJ...999..999Z"), ("10.1234/b", ""), ("", "2001ApJ...999..999Z")]
+        )
+        self.assertEqual(len(results[0][0]), 1)
+        self.assertEqual(tuple(results[0][1][0]), ("2000ApJ...999..999Z",) * 2 + ("canonical",))
+        self.assertEqual(results[1], ([], []))
+        self.assertEqual(results[2], ([], []))
+
+    def test_write_matched_records(self):
+        results = self.adb.write_matched_records([_record("10.1234/a"), _record("10.1234/b")])
+        self.assertEqual(results, [True, True])
+        results = self.adb.write_matched_records(
+            [_record("10.1234/a", "Unmatched", "redo"), _record("10.1234/b")]
+        )
+        self.assertEqual(results, [True, False])
+        rows = dict(self.session.query(master.master_doi, master.status).all())
+        self.assertEqual(rows, {"10.1234/a": "Unmatched", "10.1234/b": "Matched"})
+
+    def test_failures_returned_in_place(self):
+        results = self.adb.write_matched_records([_record(None), _record("10.1234/c")])
+        self.assertIsInstance(results[0], DBWriteException)
+        self.assertTrue(results[1])
+
+    def test_get_async_db_cached_per_process(self):
+        adb = database_async.get_async_db(self.url)
+        self.assertIs(database_async.get_async_db(self.url), adb)
+        database_async._async_db_cache["pid"] = -1
+        self.assertIsNot(database_async.get_async_db(self.url), adb)
+        database_async._async_db_cache["db"].close()
+        database_async._async_db_cache["db"] = None
+        adb.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
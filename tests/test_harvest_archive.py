@@ -0,0 +1,132 @@
+import gzip
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from adscompstat import harvest_archive, utils
+from adscompstat.exceptions import HarvestArchiveException
+
+
+class TestHarvestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.tmpdir, "Crossref")
+        self.bundle_dir = os.path.join(self.tmpdir, "bundles")
+        self.files = {
+            "doi/10.3847/00/67/1/metadata.xml": b"<record>one</record>",
+            "doi/10.3847/00/67/2/metadata.xml": b"<record>two</record>",
+            "doi/10.3847/00/68/1/metadata.xml": b"<record>three</record>",
+            "doi/10.1093/01/02/1/metadata.xml": b"<record>four</record>",
+        }
+        for name, data in self.files.items():
+            filename = os.path.join(self.base_dir, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "wb") as fx:
+                fx.write(data)
+        harvest_archive.configure(None)
+
+    def tearDown(self):
+        harvest_archive.configure(None)
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, name):
+        with harvest_archive.open_harvest_file(os.path.join(self.base_dir, name)) as fx:
+            return fx.read()
+
+    def test_bundle_path(self):
+        self.assertEqual(
+            harvest_archive.bundle_path("/h/doi/10.3847/./00//67/1/metadata.xml", "/h/", 4),
+            ("doi/10.3847/00/67", "1/metadata.xml"),
+        )
+        self.assertIsNone(harvest_archive.bundle_path("/h/doi/metadata.xml", "/h/", 4))
+        self.assertIsNone(harvest_archive.bundle_path("/elsewhere/a/b/c/d/e.xml", "/h/", 4))
+        self.assertIsNone(harvest_archive.bundle_path("/h/a/b/c/d/e.xml", "/h/", None))
+
+    def test_read_plain_and_compressed(self):
+        name = "doi/10.3847/00/67/1/metadata.xml"
+        self.assertEqual(self._read(name), self.files[name])
+        filename = os.path.join(self.base_dir, name)
+        with gzip.open(filename + ".gz", "wb") as fz:
+            fz.write(self.files[name])
+        os.unlink(filename)
+        self.assertEqual(self._read(name), self.files[name])
+        self.assertEqual(
+            harvest_archive.harvest_file_size(filename), os.path.getsize(filename + ".gz")
+        )
+        with self.assertRaises(FileNotFoundError):
+            self._read("doi/10.3847/00/67/9/metadata.xml")
+
+    def test_pack_and_read_bundles(self):
+        (nbundles, nfiles) = harvest_archive.pack_harvest_tree(self.base_dir, self.bundle_dir, 4)
+        self.assertEqual((nbundles, nfiles), (3, 4))
+        with zipfile.ZipFile(os.path.join(self.bundle_dir, "doi/10.3847/00/67.zip")) as zf:
+            self.assertEqual(sorted(zf.namelist()), ["1/metadata.xml", "2/metadata.xml"])
+        # read from the bundles once the originals are gone
+        shutil.rmtree(self.base_dir)
+        harvest_archive.configure(self.base_dir, bundle_dir=self.bundle_dir, depth=4)
+        for name, data in self.files.items():
+            self.assertEqual(self._read(name), data)
+        self.assertEqual(
+            harvest_archive.harvest_file_size(os.path.join(self.base_dir, name)), len(data)
+        )
+        with utils.open_xml(os.path.join(self.base_dir, name)) as data:
+            self.assertEqual(data, self.files[name])
+
+    def test_pack_subdir_keeps_old_members(self):
+        harvest_archive.pack_harvest_tree(self.base_dir, self.bundle_dir, 4, subdir="doi/10.3847")
+        self.assertFalse(os.path.exists(os.path.join(self.bundle_dir, "doi/10.1093")))
+        # repacking adds new files and keeps those already packed
+        shutil.rmtree(os.path.join(self.base_dir, "doi/10.3847/00/67/1"))
+        new_file = os.path.join(self.base_dir, "doi/10.3847/00/67/3/metadata.xml.gz")
+        os.makedirs(os.path.dirname(new_file))
+        with gzip.open(new_file, "wb") as fz:
+            fz.write(b"<record>five</record>")
+        self.assertEqual(
+            harvest_archive.pack_bundle(self.base_dir, self.bundle_dir, "doi/10.3847/00/67"), 3
+        )
+        with zipfile.ZipFile(os.path.join(self.bundle_dir, "doi/10.3847/00/67.zip")) as zf:
+            self.assertEqual(zf.read("3/metadata.xml"), b"<record>five</record>")
+            self.assertEqual(zf.read("1/metadata.xml"), b"<record>one</record>")
+
+    def test_tar_bundle(self):
+        os.makedirs(os.path.join(self.bundle_dir, "doi/10.3847/00"))
+        with tarfile.open(os.path.join(self.bundle_dir, "doi/10.3847/00/68.tar"), "w") as tf:
+            tf.add(os.path.join(self.base_dir, "doi/10.3847/00/68"), arcname=".")
+        shutil.rmtree(self.base_dir)
+        harvest_archive.configure(self.base_dir, bundle_dir=self.bundle_dir, depth=4)
+        self.assertEqual(self._read("doi/10.3847/00/68/1/metadata.xml"), b"<record>three</record>")
+
+    def test_new_bundles_found_after_configure(self):
+        harvest_archive.configure(self.base_dir, bundle_dir=self.bundle_dir, depth=4)
+        name = "doi/10.1093/01/02/1/metadata.xml"
+        self.assertEqual(self._read(name), self.files[name])
+        harvest_archive.pack_harvest_tree(self.base_dir, self.bundle_dir, 4, subdir="doi/10.1093")
+        shutil.rmtree(os.path.join(self.base_dir, "doi/10.1093"))
+        with self.assertRaises(FileNotFoundError):
+            self._read(name)
+        harvest_archive.configure(self.base_dir, bundle_dir=self.bundle_dir, depth=4)
+        self.assertEqual(self._read(name), self.files[name])
+
+    def test_repacked_bundle_reopened(self):
+        harvest_archive.pack_harvest_tree(self.base_dir, self.bundle_dir, 4)
+        harvest_archive.configure(self.base_dir, bundle_dir=self.bundle_dir, depth=4)
+        new_file = os.path.join(self.base_dir, "doi/10.3847/00/67/3/metadata.xml")
+        os.makedirs(os.path.dirname(new_file))
+        with open(new_file, "wb") as fx:
+            fx.write(b"<record>five</record>")
+        # the bundle is open in this process before it's repacked
+        self.assertEqual(self._read("doi/10.3847/00/67/1/metadata.xml"), b"<record>one</record>")
+        harvest_archive.pack_bundle(self.base_dir, self.bundle_dir, "doi/10.3847/00/67")
+        os.unlink(new_file)
+        self.assertEqual(self._read("doi/10.3847/00/67/3/metadata.xml"), b"<record>five</record>")
+
+    def test_pack_without_bundle_dir(self):
+        with self.assertRaises(HarvestArchiveException):
+            harvest_archive.pack_harvest_tree(self.base_dir, None, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
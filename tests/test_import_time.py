@@ -0,0 +1,29 @@
+import unittest
+
+from adscompstat.profiling import import_times
+
+# Modules that are only needed to parse files, make bibcodes or use the
+# async database, and so mustn't be imported by the CLI or other tasks
+DEFERRED_MODULES = ["adsingestp", "adsenrich", "lxml", "sqlalchemy.ext.asyncio"]
+
+# Generous, as -X importtime slows imports down and test machines vary;
+# the deferred modules above are the main guard
+IMPORT_SECONDS_BUDGET = 2.0
+
+
+class TestImportTime(unittest.TestCase):
+    def test_tasks_import(self):
+        times = import_times("import adscompstat.tasks")
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, times)
+        self.assertNotIn("adscompstat.database_async", times)
+        self.assertLess(times["adscompstat.tasks"], IMPORT_SECONDS_BUDGET)
+
+    def test_utils_import(self):
+        times = import_times("import adscompstat.utils")
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, times)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,13 @@
 import os
 import unittest
 
-from adscompstat.match import CrossrefMatcher
+from adscompstat.match import (
+    CandidateIndex,
+    CrossrefMatcher,
+    candidate_prefixes,
+    make_bibstem_index,
+    split_bibcode,
+)
 
 
 class TestMatch(unittest.TestCase):
@@ -46,6 +52,18 @@ class TestMatch(unittest.TestCase):
         self.assertEqual(cm._compare_bibstems("ApJ..", "ApJS."), "related")
         self.assertFalse(cm._compare_bibstems("JGR..", "ApJ.."))
 
+    def test__compare_bibstems_bibstem_in_several_groups(self):
+        cm = CrossrefMatcher(related_bibstems=[["JGR..", "JGRA."], ["JGR..", "JGRD."]])
+        self.assertEqual(cm._compare_bibstems("JGRA.", "JGR.."), "related")
+        self.assertEqual(cm._compare_bibstems("JGR..", "JGRD."), "related")
+        self.assertFalse(cm._compare_bibstems("JGRA.", "JGRD."))
+
+    def test_make_bibstem_index(self):
+        index = make_bibstem_index([["JGR..", "JGRA."], ["JGR..", "JGRD."]])
+        self.assertEqual(
+            index, {"JGR..": frozenset([0, 1]), "JGRA.": frozenset([0]), "JGRD.": frozenset([1])}
+        )
+
     # ------------------------------------------------------------------
     # _match_bibcode_permutations
     # ------------------------------------------------------------------
@@ -243,6 +261,177 @@ class TestMatch(unittest.TestCase):
         self.assertEqual(result["match"], "partial")
         self.assertIn("bibstem", result.get("errs", {}))
 
+    def test__match_bibcode_permutations_short_bibcode(self):
+        # A bibcode too short to slice can't be compared → mismatch
+        cm = CrossrefMatcher()
+        result = cm._match_bibcode_permutations("2000ApJ...999", "2000ApJ...999..999Z")
+        self.assertEqual(result, {"match": "mismatch", "bibcode": "2000ApJ...999..999Z"})
+
+    def test__match_bibcode_permutations_numeric_vol_and_page(self):
+        # Lexically different but numerically equal volume/page are not errors;
+        # non-numeric ones always are
+        cm = CrossrefMatcher()
+        result = cm._match_bibcode_permutations("2000ApJ...0999.0012Z", "2000ApJ...0999.0012Z")
+        self.assertEqual(result["errs"], {})
+        result = cm._match_bibcode_permutations("2000ApJ...999..12.Z", "2000ApJ...999..012Z")
+        self.assertEqual(result["errs"], {"page": ".012"})
+
+    # ------------------------------------------------------------------
+    # split_bibcode
+    # ------------------------------------------------------------------
+
+    def test_split_bibcode(self):
+        self.assertEqual(
+            split_bibcode("2000ApJ...999L..12Z"),
+            ("2000", "ApJ..", ".999", "L", "..12", "Z", None, None),
+        )
+        self.assertEqual(
+            split_bibcode("2001PhRvD1234Q5678X"),
+            ("2001", "PhRvD", "1234", "Q", "5678", "X", 1234, 5678),
+        )
+        self.assertIsNone(split_bibcode("2001PhRvD"))
+
+    # ------------------------------------------------------------------
+    # match_batch
+    # ------------------------------------------------------------------
+
+    def test_match_batch_same_as_match(self):
+        cm = CrossrefMatcher(related_bibstems=[["JGR..", "JGRD."]])
+        cases = [
+            (
+                "2000ApJ...999..999Z",
+                [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "canonical")],
+                [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "canonical")],
+            ),
+            (
+                "2000ApJ...999..999Z",
+                [("2000ApJ...999..777Q", "2000ApJ...999..777Q", "canonical")],
+                [],
+            ),
+            (
+                "2000ApJ...999..999Z",
+                [("1900A&A...123..456X", "1900A&A...123..456X", "canonical")],
+                [],
+            ),
+            ("2000ApJ...999..999Z", [], []),
+            (
+                "2000ApJ...999..999Z",
+                [("2000ApJ...999..777Q", "2000ApJ...999..777Q", "canonical")],
+                [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "canonical")],
+            ),
+            (
+                "2000ApJ...999..999Z",
+                None,
+                [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "deleted")],
+            ),
+            (
+                "2000JGR...999..999Z",
+                [("2000JGRD..999..999Z", "2000JGRD..999..999Z", "canonical")],
+                [],
+            ),
+            (None, [("2000JGRD..999..999Z", "2000JGRD..999..999Z", "canonical")], []),
+        ]
+        bibcodes = [c[0] for c in cases]
+        fromDoi = [c[1] for c in cases]
+        fromBib = [c[2] for c in cases]
+        expected = [cm.match(*c) for c in cases]
+        self.assertEqual(cm.match_batch(bibcodes, fromDoi, fromBib), expected)
+
+    def test_match_batch_empty(self):
+        cm = CrossrefMatcher()
+        self.assertEqual(cm.match_batch([], [], []), [])
+
+    def test_match_batch_bad_record_only_affects_itself(self):
+        # a malformed candidate row fails only its own record
+        cm = CrossrefMatcher()
+        good = [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "canonical")]
+        results = cm.match_batch(
+            ["2000ApJ...999..999Z", "2000ApJ...999..999Z", "2000ApJ...999..999Z"],
+            [good, [("2000ApJ...999..999Z",)], good],
+            [[], [], []],
+        )
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]["match"], "canonical")
+        self.assertEqual(results[1], {})
+        self.assertEqual(results[2]["match"], "canonical")
+
+    # ------------------------------------------------------------------
+    # CandidateIndex / near-miss matching of unmatched records
+    # ------------------------------------------------------------------
+
+    CANDIDATE_ROWS = [
+        ("2000ApJ...999Q.999A", "2000ApJ...999Q.999A", "canonical"),
+        ("2001ApJ...999..999Z", "2001ApJ...999..999Z", "canonical"),
+        ("2000ApJ...999..123Z", "2000ApJ...999..123Z", "alternate"),
+        ("2000ApJ...998..999Z", "2000ApJ...998..999Z", "canonical"),
+        ("2003ApJ...999..999Z", "2003ApJ...999..999Z", "canonical"),
+        ("short", "short", "canonical"),
+    ]
+
+    def _lookup(self, prefixes):
+        self.lookups.append(prefixes)
+        return [r for r in self.CANDIDATE_ROWS if r[0].startswith(tuple(prefixes))]
+
+    def _candidate_index(self):
+        self.lookups = []
+        return CandidateIndex(self._lookup)
+
+    def test_candidate_prefixes(self):
+        self.assertEqual(
+            candidate_prefixes("2000ApJ...999..999Z"),
+            ["1999ApJ...999", "2000ApJ...999", "2001ApJ...999"],
+        )
+        self.assertEqual(candidate_prefixes("20XXApJ...999..999Z"), ["20XXApJ...999"])
+        self.assertEqual(candidate_prefixes("2000ApJ"), [])
+        self.assertEqual(candidate_prefixes(None), [])
+
+    def test_candidate_index_candidates(self):
+        index = self._candidate_index()
+        found = [row[0] for row in index.candidates("2000ApJ...999..999Z")]
+        # same stem/vol in 1999-2001: 999Q.999A, 999..123Z, 2001
+        self.assertEqual(
+            sorted(found),
+            sorted(["2000ApJ...999Q.999A", "2000ApJ...999..123Z", "2001ApJ...999..999Z"]),
+        )
+        # the volume's rows are only looked up once
+        index.candidates("2000ApJ...999..123Q")
+        self.assertEqual(len(self.lookups), 1)
+        self.assertEqual(index.candidates(None), [])
+        self.assertEqual(index.candidates("2000ApJ"), [])
+
+    def test_match_unmatched_finds_near_miss(self):
+        # candidates: qual+init differ (2 errs), year+1 (1 err), page (1 err, alternate),
+        # year+3 (rejected) → best is the canonical one-year offset
+        cm = CrossrefMatcher(candidate_index=self._candidate_index())
+        result = cm.match("2000ApJ...999..999Z", [], [])
+        self.assertEqual(
+            result,
+            {
+                "match": "partial",
+                "bibcode": "2001ApJ...999..999Z",
+                "errs": {"year": "2001", "DOI": "DOI not in classic"},
+            },
+        )
+
+    def test_match_unmatched_without_near_miss(self):
+        cm = CrossrefMatcher(candidate_index=self._candidate_index())
+        result = cm.match("2000ApJ...997..999Z", [], [])
+        self.assertEqual(
+            result, {"match": "unmatched", "bibcode": None, "errs": {"DOI": "DOI not in classic"}}
+        )
+
+    def test_match_unmatched_rejects_distant_year(self):
+        cm = CrossrefMatcher(
+            candidate_index=CandidateIndex(
+                lambda prefixes: [("2003ApJ...999..999Z", "2003ApJ...999..999Z", "canonical")]
+            )
+        )
+        self.assertEqual(cm.match("2000ApJ...999..999Z", [], [])["match"], "unmatched")
+
+    def test_match_without_candidate_index_unchanged(self):
+        cm = CrossrefMatcher()
+        self.assertEqual(cm.match("2000ApJ...999..999Z", [], [])["match"], "unmatched")
+
 
 if __name__ == "__main__":
     unittest.main()
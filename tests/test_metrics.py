@@ -0,0 +1,218 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from adscompstat import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.saved_totals = dict(metrics._totals)
+        metrics._totals.update(
+            {
+                "batches": 0,
+                "records": 0,
+                "unchanged": 0,
+                "batch_seconds": 0.0,
+                "last_records_per_second": 0.0,
+                "stage_seconds": {},
+                "failures": {},
+                "pool": {},
+                "bloom": {"checks": 0, "doi_skips": 0, "bibcode_skips": 0},
+                "bloom_fpr": None,
+                "prefetch": {"files": 0, "bytes": 0, "read_seconds": 0.0, "misses": 0},
+                "record_cache": {"hits": 0, "misses": 0},
+                "bibcode_memo": {"hits": 0, "misses": 0},
+            }
+        )
+
+    def tearDown(self):
+        metrics._totals.clear()
+        metrics._totals.update(self.saved_totals)
+
+    def test_failure_reason(self):
+        self.assertEqual(metrics.failure_reason("No DOI found"), "no_doi_found")
+        self.assertEqual(metrics.failure_reason("error: bad things happened"), "error")
+        self.assertEqual(metrics.failure_reason("DBQueryException"), "dbqueryexception")
+        self.assertEqual(metrics.failure_reason(""), "unknown")
+
+    def test_batch_metrics(self):
+        batch = metrics.BatchMetrics()
+        batch.start_record("a.xml")
+        with batch.stage("parse"):
+            pass
+        with batch.stage("classic"):
+            pass
+        batch.end_record()
+        batch.start_record("b.xml")
+        with self.assertRaises(ValueError):
+            with batch.stage("parse"):
+                raise ValueError("bad xml")
+        batch.failure("parse", "ValueError")
+        batch.end_record()
+
+        summary = batch.summary()
+        self.assertEqual(summary["records"], 2)
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(summary["failures"], {"parse:valueerror": 1})
+        self.assertEqual(set(summary["stage_ms"].keys()), set(metrics.STAGES))
+        self.assertGreaterEqual(summary["stage_ms"]["parse"], 0.0)
+        self.assertGreaterEqual(summary["db_ms"], summary["stage_ms"]["classic"])
+
+    def test_record_logging(self):
+        batch = metrics.BatchMetrics(log_records=True)
+        with patch("adscompstat.metrics.logger") as mock_logger:
+            batch.start_record("a.xml")
+            with batch.stage("parse"):
+                pass
+            batch.failure("parse", "No DOI found")
+            batch.end_record()
+            mock_logger.info.assert_called_once()
+            line = mock_logger.info.call_args[0][0]
+        self.assertIn('"file": "a.xml"', line)
+        self.assertIn('"failure": "parse:no_doi_found"', line)
+
+    def test_finish_and_prometheus_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            batch = metrics.BatchMetrics()
+            batch.start_record("a.xml")
+            with batch.stage("match"):
+                pass
+            batch.failure("lookup", "DBQueryException")
+            batch.end_record()
+            batch.unchanged += 1
+            summary = batch.finish(metrics_dir=tmpdir)
+            self.assertEqual(summary["records"], 1)
+            self.assertEqual(summary["unchanged"], 1)
+            self.assertEqual(metrics._totals["batches"], 1)
+            self.assertEqual(metrics._totals["records"], 1)
+
+            promfile = os.path.join(
+                tmpdir, "adscompstat_%s_%s.prom" % (socket.gethostname(), os.getpid())
+            )
+            with open(promfile, "r") as fp:
+                text = fp.read()
+            self.assertIn("# TYPE adscompstat_records_total counter", text)
+            self.assertIn('adscompstat_records_total{pid="%s"} 1' % os.getpid(), text)
+            self.assertIn('stage="match"', text)
+            self.assertIn('adscompstat_unchanged_records_total{pid="%s"} 1' % os.getpid(), text)
+            self.assertIn(
+                'adscompstat_record_failures_total{pid="%s",stage="lookup",reason="dbqueryexception"} 1'
+                % os.getpid(),
+                text,
+            )
+            self.assertEqual(os.listdir(tmpdir), [os.path.basename(promfile)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prometheus_files_of_exited_processes_removed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            proc = subprocess.Popen([sys.executable, "-c", "pass"])
+            proc.wait()
+            stale = os.path.join(
+                tmpdir, "adscompstat_%s_%s.prom" % (socket.gethostname(), proc.pid)
+            )
+            other = os.path.join(tmpdir, "node.prom")
+            # another host's files are left to it, whatever their pid
+            elsewhere = os.path.join(tmpdir, "adscompstat_otherhost_%s.prom" % proc.pid)
+            for name in [stale, other, elsewhere]:
+                with open(name, "w") as fp:
+                    fp.write("x 1\n")
+            promfile = metrics.write_prometheus_file(tmpdir)
+            kept = ["node.prom", os.path.basename(elsewhere)]
+            self.assertEqual(
+                sorted(os.listdir(tmpdir)), sorted([os.path.basename(promfile)] + kept)
+            )
+            metrics.remove_prometheus_file(tmpdir)
+            metrics.remove_prometheus_file(tmpdir)
+            self.assertEqual(sorted(os.listdir(tmpdir)), sorted(kept))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_pool_stats(self):
+        batch = metrics.BatchMetrics()
+        summary = batch.finish(pool_stats={"checkouts": 12, "wait_seconds": 0.5, "checked_out": 1})
+        self.assertEqual(summary["db_pool"]["checkouts"], 12)
+        text = metrics.format_prometheus()
+        self.assertIn("# TYPE adscompstat_db_pool_checkouts_total counter", text)
+        self.assertIn('adscompstat_db_pool_wait_seconds_total{pid="%s"} 0.5' % os.getpid(), text)
+        self.assertIn("# TYPE adscompstat_db_pool_checked_out gauge", text)
+        self.assertNotIn("adscompstat_db_pool_overflow", text)
+
+    def test_bloom_counts(self):
+        batch = metrics.BatchMetrics()
+        self.assertNotIn("bloom", batch.summary())
+        batch.bloom_fpr = 0.01
+        batch.bloom_check(True, False)
+        batch.bloom_check(True, True)
+        summary = batch.finish()
+        self.assertEqual(summary["bloom"]["checks"], 2)
+        self.assertEqual(summary["bloom"]["doi_skips"], 2)
+        self.assertEqual(summary["bloom"]["bibcode_skips"], 1)
+        text = metrics.format_prometheus()
+        self.assertIn('adscompstat_bloom_checks_total{pid="%s"} 2' % os.getpid(), text)
+        self.assertIn(
+            'adscompstat_bloom_skips_total{pid="%s",lookup="bibcode"} 1' % os.getpid(), text
+        )
+        self.assertIn(
+            'adscompstat_bloom_false_positive_rate{pid="%s"} 0.010000' % os.getpid(), text
+        )
+
+    def test_prefetch_stats(self):
+        batch = metrics.BatchMetrics()
+        self.assertNotIn("prefetch", batch.summary())
+        batch.prefetch = {
+            "files": 3,
+            "bytes": 1200,
+            "read_seconds": 0.25,
+            "max_buffered": 800,
+            "misses": 1,
+        }
+        summary = batch.finish()
+        self.assertEqual(summary["prefetch"]["bytes"], 1200)
+        self.assertIn("read", summary["stage_ms"])
+        text = metrics.format_prometheus()
+        self.assertIn('adscompstat_prefetch_bytes_total{pid="%s"} 1200' % os.getpid(), text)
+        self.assertIn('adscompstat_prefetch_misses_total{pid="%s"} 1' % os.getpid(), text)
+
+    def test_record_cache_counts(self):
+        batch = metrics.BatchMetrics()
+        self.assertNotIn("record_cache", batch.summary())
+        batch.record_cache_lookup(True)
+        batch.record_cache_lookup(True)
+        batch.record_cache_lookup(False)
+        summary = batch.finish()
+        self.assertEqual(summary["record_cache"], {"hits": 2, "misses": 1})
+        text = metrics.format_prometheus()
+        self.assertIn(
+            'adscompstat_record_cache_lookups_total{pid="%s",result="hit"} 2' % os.getpid(), text
+        )
+        self.assertIn(
+            'adscompstat_record_cache_lookups_total{pid="%s",result="miss"} 1' % os.getpid(), text
+        )
+
+    def test_bibcode_memo_counts(self):
+        batch = metrics.BatchMetrics()
+        self.assertNotIn("bibcode_memo", batch.summary())
+        for hit in [True, True, True, False]:
+            batch.bibcode_memo_lookup(hit)
+        summary = batch.finish()
+        self.assertEqual(summary["bibcode_memo"], {"hits": 3, "misses": 1, "hit_rate": 0.75})
+        text = metrics.format_prometheus()
+        self.assertIn(
+            'adscompstat_bibcode_memo_lookups_total{pid="%s",result="hit"} 3' % os.getpid(), text
+        )
+
+    def test_finish_bad_metrics_dir(self):
+        batch = metrics.BatchMetrics()
+        with patch("adscompstat.metrics.logger") as mock_logger:
+            batch.finish(metrics_dir="/nonexistent_path/")
+            mock_logger.warning.assert_called_once()
+        self.assertEqual(metrics._totals["batches"], 1)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import wait
+
+from adscompstat import prefetch
+
+
+class TestReadAhead(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(10):
+            filename = os.path.join(self.tmpdir, "%s.xml" % i)
+            with open(filename, "wb") as fx:
+                fx.write(b"<record>%d</record>" % i)
+            self.files.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reads_in_order(self):
+        with prefetch.ReadAhead(self.files, depth=3) as reader:
+            data = [reader.get(i) for i in range(len(self.files))]
+        self.assertEqual(data, [b"<record>%d</record>" % i for i in range(10)])
+        self.assertEqual(reader.stats["files"], 10)
+        self.assertEqual(reader.stats["misses"], 0)
+        self.assertEqual(reader.stats["bytes"], sum([len(d) for d in data]))
+
+    def test_depth_limits_read_ahead(self):
+        release = threading.Event()
+
+        def read(infile):
+            release.wait(5)
+            return b"x"
+
+        with prefetch.ReadAhead(self.files, depth=2, threads=10, read=read) as reader:
+            # the first file and the two after it
+            self.assertEqual(sorted(reader._futures), [0, 1, 2])
+            release.set()
+            reader.get(0)
+            self.assertEqual(sorted(reader._futures), [1, 2, 3])
+
+    def test_max_bytes_holds_back_reads(self):
+        with prefetch.ReadAhead(self.files, depth=5, max_bytes=1, threads=1) as reader:
+            wait(list(reader._futures.values()))
+            self.assertEqual(reader.get(0), b"<record>0</record>")
+            # nothing more is read ahead while 5 files are waiting
+            self.assertEqual(sorted(reader._futures), [1, 2, 3, 4, 5])
+            data = [reader.get(i) for i in range(1, len(self.files))]
+        self.assertEqual(data, [b"<record>%d</record>" % i for i in range(1, 10)])
+        self.assertEqual(reader.stats["max_buffered"], 6 * len(data[0]))
+
+    def test_read_errors(self):
+        files = [self.files[0], os.path.join(self.tmpdir, "missing.xml"), self.files[1]]
+        with prefetch.ReadAhead(files, depth=2) as reader:
+            data = [reader.get(i) for i in range(3)]
+        self.assertEqual(data, [b"<record>0</record>", None, b"<record>1</record>"])
+        self.assertEqual(reader.stats["misses"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
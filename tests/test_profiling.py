@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+from unittest.mock import patch
+
+from adscompstat import profiling
+
+
+def _work(infile_batch):
+    return sum([len(str(x)) for x in infile_batch])
+
+
+class TestProfileTask(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _config(self, rate):
+        return {"PROFILE_SAMPLE_RATE": rate, "PROFILE_OUTPUT_DIR": self.tmpdir}
+
+    def test_disabled(self):
+        for config in [{}, self._config(0.0), {"PROFILE_SAMPLE_RATE": 1.0}]:
+            wrapped = profiling.profile_task(config)(_work)
+            self.assertEqual(wrapped(["a", "bb"]), 3)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_wraps(self):
+        wrapped = profiling.profile_task({})(_work)
+        self.assertEqual(wrapped.__name__, "_work")
+        self.assertEqual(wrapped.__module__, _work.__module__)
+
+    def test_sampled_call_writes_reports(self):
+        wrapped = profiling.profile_task(self._config(1.0))(_work)
+        self.assertEqual(wrapped(["a", "bb", "ccc"]), 6)
+        files = sorted(os.listdir(self.tmpdir))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].startswith("_work_local_n3_"))
+        self.assertTrue(files[0].endswith(".prof"))
+        self.assertTrue(files[1].endswith(".txt"))
+        with open(os.path.join(self.tmpdir, files[1]), "r") as fr:
+            report = fr.read()
+        self.assertIn("function calls", report)
+        self.assertIn("allocations", report)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_unsampled_call(self):
+        wrapped = profiling.profile_task(self._config(0.5))(_work)
+        with patch("adscompstat.profiling.random.random", return_value=0.9):
+            wrapped(["a"])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_exception_still_profiled(self):
+        def _fail(infile_batch):
+            raise ValueError("bad batch")
+
+        wrapped = profiling.profile_task(self._config(1.0))(_fail)
+        with self.assertRaises(ValueError):
+            wrapped(["a"])
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+    def test_report_failure_does_not_fail_task(self):
+        wrapped = profiling.profile_task(
+            {"PROFILE_SAMPLE_RATE": 1.0, "PROFILE_OUTPUT_DIR": "/nonexistent_path/x"}
+        )(_work)
+        with patch("adscompstat.profiling.os.makedirs", side_effect=OSError("denied")), patch(
+            "adscompstat.profiling.logger"
+        ) as mock_logger:
+            self.assertEqual(wrapped(["a"]), 1)
+            mock_logger.warning.assert_called_once()
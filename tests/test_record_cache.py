@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from adscompstat import record_cache
+from adscompstat.exceptions import RecordCacheException
+
+RECORD = {
+    "record": {"title": {"textEnglish": "A title"}, "authors": [{"name": {"surname": "Doe"}}]},
+    "harvest_filepath": "/path/x.xml",
+    "master_doi": "10.1000/xyz",
+    "issns": {"print": "1234-5678"},
+    "master_bibcode": None,
+    "master_bibdata": {"publication": {"pubYear": "2020"}, "pagination": None},
+}
+
+
+class TestRecordCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = record_cache.RecordCache(self.tmpdir, max_bytes=1000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        key = self.cache.key("full:1", "/path/x.xml", b"<doi_record/>")
+        self.assertEqual(key, self.cache.key("full:1", "/path/x.xml", b"<doi_record/>"))
+        self.assertNotEqual(key, self.cache.key("full:1", "/path/x.xml", b"<doi_record />"))
+        self.assertNotEqual(key, self.cache.key("full:1", "/path/y.xml", b"<doi_record/>"))
+        self.assertNotEqual(key, self.cache.key("fast:1", "/path/x.xml", b"<doi_record/>"))
+        self.assertNotEqual(key, self.cache.key("full:2", "/path/x.xml", b"<doi_record/>"))
+
+    def test_put_and_get(self):
+        key = self.cache.key("full:1", "/path/x.xml", b"<doi_record/>")
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, RECORD)
+        self.assertEqual(self.cache.get(key), RECORD)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, key[0:2])), [key + ".rec"])
+
+    def test_json_fallback(self):
+        with patch("adscompstat.record_cache.msgpack", None):
+            blob = record_cache.dumps(RECORD)
+            self.assertEqual(blob[0:1], record_cache.ZJSON)
+            self.assertEqual(record_cache.loads(blob), RECORD)
+        # entries written without msgpack can be read with it
+        self.assertEqual(record_cache.loads(blob), RECORD)
+        with self.assertRaises(RecordCacheException):
+            record_cache.loads(b"X1234")
+
+    def test_unreadable_entry_discarded(self):
+        key = self.cache.key("full:1", "/path/x.xml", b"<doi_record/>")
+        self.cache.put(key, RECORD)
+        entry = os.path.join(self.tmpdir, key[0:2], key + ".rec")
+        with open(entry, "wb") as fc:
+            fc.write(b"Jnot zlib")
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(os.path.exists(entry))
+
+    def test_evicts_least_recently_used(self):
+        keys = [self.cache.key("full:1", "/path/%s.xml" % i, b"") for i in range(5)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, RECORD)
+            entry = os.path.join(self.tmpdir, key[0:2], key + ".rec")
+            os.utime(entry, (1000 + i, 1000 + i))
+        size = os.path.getsize(entry)
+        # using the oldest entry makes it the most recently used
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.cache.max_bytes = size * 4
+        self.assertEqual(self.cache.evict(), 2)
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNone(self.cache.get(keys[2]))
+        self.assertIsNotNone(self.cache.get(keys[3]))
+        self.assertIsNotNone(self.cache.get(keys[4]))
+
+    def test_put_evicts_past_max_bytes(self):
+        key = self.cache.key("full:1", "/path/0.xml", b"")
+        self.cache.put(key, RECORD)
+        self.cache.max_bytes = os.path.getsize(os.path.join(self.tmpdir, key[0:2], key + ".rec"))
+        self.cache.put(self.cache.key("full:1", "/path/1.xml", b""), RECORD)
+        self.assertLessEqual(self.cache._total, self.cache.max_bytes)
+
+    def test_get_record_cache(self):
+        cache = record_cache.get_record_cache(self.tmpdir, max_bytes=500)
+        self.assertIs(cache, record_cache.get_record_cache(self.tmpdir, max_bytes=500))
+        self.assertEqual(cache.max_bytes, 500)
+        with open(os.path.join(self.tmpdir, "afile"), "w") as fc:
+            fc.write("x")
+        self.assertIsNone(record_cache.get_record_cache(os.path.join(self.tmpdir, "afile", "x")))
+
+
+if __name__ == "__main__":
+    unittest.main()
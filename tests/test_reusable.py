@@ -0,0 +1,111 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from adscompstat import reusable
+
+
+class Parser(object):
+    made = 0
+
+    def __init__(self, name="parser"):
+        Parser.made += 1
+        self.name = name
+        self.metadata = {}
+        self.authors = []
+        self.index = {"affiliations": [], "seen": {"dois": set()}}
+        self.index["self"] = self.index
+
+    def parse(self, title, author):
+        self.metadata["title"] = title
+        self.authors.append(author)
+        self.last = title
+        return dict(self.metadata, authors=list(self.authors))
+
+    def index_record(self, affiliation, doi):
+        self.index["affiliations"].append(affiliation)
+        self.index["seen"]["dois"].add(doi)
+
+
+class Slotted(object):
+    __slots__ = ["value"]
+
+    def __init__(self):
+        self.value = 1
+
+
+class TestReusableInstances(unittest.TestCase):
+    def setUp(self):
+        self.instances = reusable.ReusableInstances()
+        Parser.made = 0
+
+    def test_reused_and_reset(self):
+        parser = self.instances.get(Parser)
+        self.assertEqual(parser.parse("A", "Doe"), {"title": "A", "authors": ["Doe"]})
+        parser.name = "changed"
+        again = self.instances.get(Parser)
+        self.assertIs(again, parser)
+        # nothing from the first record is left on it
+        self.assertEqual(again.name, "parser")
+        self.assertEqual(again.metadata, {})
+        self.assertEqual(again.authors, [])
+        self.assertFalse(hasattr(again, "last"))
+        self.assertEqual(again.parse("B", "Roe"), {"title": "B", "authors": ["Roe"]})
+        self.assertEqual(Parser.made, 1)
+        self.assertEqual(self.instances.created, 1)
+        self.assertEqual(self.instances.reused, 1)
+
+    def test_nested_attributes_reset(self):
+        parser = self.instances.get(Parser)
+        parser.index_record("CfA", "10.1000/a")
+        again = self.instances.get(Parser)
+        self.assertIs(again, parser)
+        self.assertEqual(again.index["affiliations"], [])
+        self.assertEqual(again.index["seen"], {"dois": set()})
+        self.assertIs(again.index["self"], again.index)
+        again.index_record("STScI", "10.1000/b")
+        # each reuse gets its own copies, not ones shared with the last
+        third = self.instances.get(Parser)
+        self.assertEqual(third.index["affiliations"], [])
+        self.assertEqual(third.index["seen"]["dois"], set())
+
+    def test_keyed_by_class_and_args(self):
+        parser = self.instances.get(Parser)
+        other = self.instances.get(Parser, "other")
+        self.assertIsNot(parser, other)
+        self.assertEqual(other.name, "other")
+        self.assertIs(self.instances.get(Parser, "other"), other)
+
+    def test_per_thread(self):
+        parser = self.instances.get(Parser)
+        found = []
+        thread = threading.Thread(target=lambda: found.append(self.instances.get(Parser)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(found[0], parser)
+        self.assertIs(self.instances.get(Parser), parser)
+
+    def test_reset(self):
+        parser = self.instances.get(Parser)
+        self.instances.reset()
+        self.assertIsNot(self.instances.get(Parser), parser)
+
+    def test_new_process(self):
+        parser = self.instances.get(Parser)
+        with patch("adscompstat.reusable.os.getpid", return_value=-1):
+            self.assertIsNot(self.instances.get(Parser), parser)
+
+    def test_not_resettable(self):
+        self.assertIsNot(self.instances.get(Slotted), self.instances.get(Slotted))
+
+    def test_mock_class(self):
+        mock_cls = MagicMock()
+        mock_cls.return_value.parse.return_value = "parsed"
+        self.assertEqual(self.instances.get(mock_cls).parse("x"), "parsed")
+        self.assertEqual(self.instances.get(mock_cls).parse("y"), "parsed")
+        mock_cls.assert_called_once_with()
+        self.assertEqual(mock_cls.return_value.parse.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
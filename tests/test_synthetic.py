@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from adscompstat import synthetic, utils
+from adscompstat.match import CrossrefMatcher
+
+
+class TestSynthetic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rates = {
+            "canonical": 0.3,
+            "alternate": 0.15,
+            "deleted": 0.1,
+            "partial": 0.15,
+            "mismatch": 0.1,
+            "unmatched": 0.1,
+            "failed": 0.1,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_normalize_rates(self):
+        rates = synthetic.normalize_rates({"canonical": 3, "unmatched": 1})
+        self.assertEqual(rates["canonical"], 0.75)
+        self.assertEqual(rates["unmatched"], 0.25)
+        self.assertEqual(rates["partial"], 0.0)
+        with self.assertRaises(ValueError):
+            synthetic.normalize_rates({"bogus": 1.0})
+        with self.assertRaises(ValueError):
+            synthetic.normalize_rates({"canonical": 0.0})
+
+    def test_rates_and_reproducibility(self):
+        corpus = synthetic.SyntheticCorpus(2000, rates=self.rates, seed=7)
+        counts = {}
+        for rec in corpus.records():
+            counts[rec["matchtype"]] = counts.get(rec["matchtype"], 0) + 1
+        for k, rate in self.rates.items():
+            self.assertAlmostEqual(counts.get(k, 0), rate * 2000, delta=3)
+        self.assertEqual(
+            corpus.record(123), synthetic.SyntheticCorpus(2000, self.rates, 7).record(123)
+        )
+        self.assertNotEqual(
+            [r["matchtype"] for r in corpus.records()][0:20],
+            [r["matchtype"] for r in synthetic.SyntheticCorpus(2000, self.rates, 8).records()][
+                0:20
+            ],
+        )
+
+    def test_bibcodes_unique(self):
+        corpus = synthetic.SyntheticCorpus(5000, rates=self.rates)
+        identifiers = [row[0] for rec in corpus.records() for row in rec["classic_rows"]]
+        self.assertEqual(len(identifiers), len(set(identifiers)))
+        for rec in corpus.records():
+            self.assertEqual(len(rec["bibcode"]), 19)
+
+    def test_match_cases_exercise_matcher(self):
+        corpus = synthetic.SyntheticCorpus(500, rates=self.rates)
+        files = corpus.write_classic_files(self.tmpdir)
+        with open(files["JOURNALSDB_RELATED_BIBSTEMS"], "r") as fj:
+            related = json.load(fj)["related_bibstems"]
+        xmatch = CrossrefMatcher(related_bibstems=related)
+        (bibcodes, doiRows, bibRows) = zip(*corpus.match_cases())
+        results = xmatch.match_batch(bibcodes, doiRows, bibRows)
+        for rec, result in zip(corpus.records(), results):
+            expected = rec["matchtype"]
+            if expected == "failed":
+                # fails at parsing, so it never reaches the matcher
+                expected = "unmatched"
+            self.assertEqual(result["match"], expected, rec)
+
+    def test_classic_files_load(self):
+        corpus = synthetic.SyntheticCorpus(1000, rates=self.rates)
+        files = corpus.write_classic_files(self.tmpdir)
+        expected_rows = sorted([row for rec in corpus.records() for row in rec["classic_rows"]])
+        merged = utils.merge_bibcode_lists(
+            files["CLASSIC_CANONICAL"],
+            files["CLASSIC_ALTBIBS"],
+            files["CLASSIC_DELBIBS"],
+            files["CLASSIC_ALLBIBS"],
+        )
+        self.assertEqual(
+            sorted([(r["identifier"], r["canonical_id"], r["idtype"]) for r in merged]),
+            expected_rows,
+        )
+        links = utils.load_classic_doi_bib_map(files["CLASSIC_DOI_FILE"])
+        expected_links = [
+            {"doi": rec["doi"], "identifier": rec["classic_bibcode"]}
+            for rec in corpus.records()
+            if rec["classic_bibcode"]
+        ]
+        self.assertEqual(links, expected_links)
+        issns = utils.load_journalsdb_issn_bibstem_list(files["JOURNALSDB_ISSN_BIBSTEM"])
+        self.assertEqual(len(issns), 2 * len(synthetic.JOURNALS))
+
+    def test_write_harvest(self):
+        corpus = synthetic.SyntheticCorpus(25, rates=self.rates)
+        harvest = corpus.write_all(self.tmpdir, xml_limit=20)
+        logs = utils.get_updateagent_logs(harvest["HARVEST_LOG_DIR"])
+        self.assertEqual(len(logs), 1)
+        (dates, pubdois) = utils.parse_pub_and_date_from_logs(logs)
+        self.assertEqual(dates, [synthetic.HARVEST_DATE])
+        self.assertEqual(pubdois, [synthetic.DOI_PREFIX])
+        xmlfiles = utils.read_updateagent_log(logs[0])
+        self.assertEqual(len(xmlfiles), 20)
+        for i, relpath in enumerate(xmlfiles):
+            with open(harvest["HARVEST_BASE_DIR"] + relpath, "r") as fx:
+                data = fx.read()
+            rec = corpus.record(i)
+            self.assertIn("<surname>%s</surname>" % rec["surname"], data)
+            if rec["matchtype"] == "failed":
+                self.assertNotIn("<doi_data>", data)
+            else:
+                self.assertIn("<doi>%s</doi>" % rec["doi"], data)
+        self.assertTrue(os.path.exists(harvest["CLASSIC_DOI_FILE"]))
+
+    def test_master_rows(self):
+        corpus = synthetic.SyntheticCorpus(100, rates=self.rates)
+        for rec, row in zip(corpus.records(), corpus.master_rows()):
+            self.assertEqual(row["matchtype"], rec["matchtype"])
+            self.assertEqual(row["master_doi"], rec["doi"])
+            if rec["matchtype"] in ["mismatch", "unmatched"]:
+                self.assertEqual(row["status"], "Unmatched")
@@ -23,7 +23,10 @@ Inside each test we then patch ``adscompstat.tasks.db``,
 
 import json
 import math
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -66,11 +69,18 @@ for _mod in [
     if _mod not in sys.modules:
         _INJECT[_mod] = MagicMock()
 
+# tasks.py imports BibcodeGenerator from adsenrich.bibcodes when it's used,
+# so patching adsenrich.bibcodes.BibcodeGenerator must reach that module
+if "adsenrich" in _INJECT and "adsenrich.bibcodes" in _INJECT:
+    _INJECT["adsenrich"].bibcodes = _INJECT["adsenrich.bibcodes"]
+
 for _mod, _mock in _INJECT.items():
     if _mod not in sys.modules:
         sys.modules[_mod] = _mock
 
 from adscompstat import tasks  # noqa: E402  (import must follow sys.modules setup)
+from adscompstat import bibcode_memo, reusable  # noqa: E402
+from adscompstat.metrics import BatchMetrics  # noqa: E402
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -164,38 +174,51 @@ class TestTaskWriteMatchedRecordToDb(unittest.TestCase):
     @patch("adscompstat.tasks.db")
     def test_none_record_skips_db(self, mock_db):
         tasks.task_write_matched_record_to_db(None)
-        mock_db.query_master_by_doi.assert_not_called()
         mock_db.write_matched_record.assert_not_called()
 
     @patch("adscompstat.tasks.db")
-    def test_new_record_queries_and_writes(self, mock_db):
-        mock_db.query_master_by_doi.return_value = []
-        rec = _make_record()
-        tasks.task_write_matched_record_to_db(rec)
-        mock_db.query_master_by_doi.assert_called_once_with(tasks.app, rec[1])
-        mock_db.write_matched_record.assert_called_once_with(tasks.app, [], rec)
-
-    @patch("adscompstat.tasks.db")
-    def test_existing_record_passes_result_to_write(self, mock_db):
-        existing = [("row",)]
-        mock_db.query_master_by_doi.return_value = existing
+    def test_record_upserted(self, mock_db):
         rec = _make_record()
         tasks.task_write_matched_record_to_db(rec)
-        mock_db.write_matched_record.assert_called_once_with(tasks.app, existing, rec)
+        mock_db.write_matched_record.assert_called_once_with(tasks.app, rec)
 
     @patch("adscompstat.tasks.db")
     def test_db_exception_is_caught(self, mock_db):
-        mock_db.query_master_by_doi.side_effect = Exception("query failed")
+        mock_db.write_matched_record.side_effect = Exception("write failed")
         tasks.task_write_matched_record_to_db(_make_record())
 
+    @patch("adscompstat.tasks.db")
+    def test_run_batch_counts_write(self, mock_db):
+        tasks.task_write_matched_record_to_db(_make_record(), "run1", "a.out", 2)
+        mock_db.update_run_batch.assert_called_once_with(
+            tasks.app, "run1", "a.out", 2, 1, 0, queued=-1
+        )
+        mock_db.update_run_batch.reset_mock()
+        mock_db.write_matched_record.side_effect = Exception("write failed")
+        tasks.task_write_matched_record_to_db(_make_record(), "run1", "a.out", 2)
+        mock_db.update_run_batch.assert_called_once_with(
+            tasks.app, "run1", "a.out", 2, 0, 1, queued=-1
+        )
+
 
 # ---------------------------------------------------------------------------
 # task_process_logfile
 # ---------------------------------------------------------------------------
 
 
+def _delay_calls(mock_meta):
+    """
+    Returns a mock called with the args and kwargs of each apply_async call
+    to mock_meta, as delay would have been.
+    """
+    delay = MagicMock()
+    for c in mock_meta.apply_async.call_args_list:
+        delay(*c[1]["args"], **c[1]["kwargs"])
+    return delay
+
+
 class TestTaskProcessLogfile(unittest.TestCase):
-    def _run(self, files, batch_count=100, harvest_dir="/harvest/"):
+    def _run(self, files, batch_count=100, harvest_dir="/harvest/", run_id=None, mock_db=None):
         def conf_get(key, default=None):
             if key == "RECORDS_PER_BATCH":
                 return batch_count
@@ -205,12 +228,13 @@ class TestTaskProcessLogfile(unittest.TestCase):
 
         with patch("adscompstat.tasks.app") as mock_app, patch(
             "adscompstat.tasks.utils"
-        ) as mock_utils, patch.object(tasks, "task_process_meta") as mock_meta:
+        ) as mock_utils, patch("adscompstat.tasks.db", mock_db or MagicMock()), patch.object(
+            tasks, "task_process_meta"
+        ) as mock_meta:
             mock_app.conf.get.side_effect = conf_get
             mock_utils.read_updateagent_log.return_value = files
-            mock_meta.delay = MagicMock()
-            tasks.task_process_logfile("/some/logfile.log")
-            return mock_meta.delay
+            tasks.task_process_logfile("/some/logfile.log", run_id)
+            return _delay_calls(mock_meta)
 
     def test_empty_logfile_no_delay(self):
         delay = self._run([])
@@ -243,6 +267,414 @@ class TestTaskProcessLogfile(unittest.TestCase):
             mock_utils.read_updateagent_log.side_effect = Exception("file not found")
             tasks.task_process_logfile("/missing.log")
 
+    def test_failed_logfile_marked_in_run(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils, patch("adscompstat.tasks.db") as mock_db:
+            mock_app.conf.get.return_value = 100
+            mock_utils.read_updateagent_log.side_effect = Exception("file not found")
+            tasks.task_process_logfile("/missing.log", "run1")
+            mock_db.fail_run_logfile.assert_called_once_with(mock_app, "run1", "/missing.log")
+            mock_db.fail_run_logfile.side_effect = Exception("db down")
+            tasks.task_process_logfile("/missing.log", "run1")
+
+    def test_run_batches_recorded(self):
+        mock_db = MagicMock()
+        files = [f"file{i}.xml" for i in range(5)]
+        delay = self._run(files, batch_count=3, harvest_dir="/h/", run_id="run1", mock_db=mock_db)
+        self.assertEqual(
+            mock_db.write_run_batches.call_args[0][1:], ("run1", "/some/logfile.log", [3, 2])
+        )
+        self.assertEqual(delay.call_args_list[1][0][1:], ("run1", "/some/logfile.log", 1))
+
+    def test_fast_parse_passed_to_batches(self):
+        def conf_get(key, default=None):
+            return 100 if key == "RECORDS_PER_BATCH" else default
+
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils, patch.object(tasks, "task_process_meta") as mock_meta:
+            mock_app.conf.get.side_effect = conf_get
+            mock_utils.read_updateagent_log.return_value = ["a.xml"]
+            tasks.task_process_logfile("/some/logfile.log", None, True)
+            _delay_calls(mock_meta).assert_called_once_with(["/a.xml"], fast_parse=True)
+
+    def test_batch_sizes_passed_to_batches(self):
+        def conf_get(key, default=None):
+            return {"RECORDS_PER_BATCH": 2, "BATCH_TARGET_BYTES": 1000}.get(key, default)
+
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils, patch.object(tasks, "task_process_meta") as mock_meta:
+            mock_app.conf.get.side_effect = conf_get
+            mock_utils.read_updateagent_log.return_value = ["a.xml", "b.xml", "c.xml"]
+            mock_utils.get_file_size.return_value = 10
+            tasks.task_process_logfile("/some/logfile.log")
+            delay = _delay_calls(mock_meta)
+        self.assertEqual(
+            [c[1] for c in delay.call_args_list], [{"batch_bytes": 20}, {"batch_bytes": 10}]
+        )
+
+    def test_batches_share_one_producer(self):
+        def conf_get(key, default=None):
+            return 2 if key == "RECORDS_PER_BATCH" else default
+
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils, patch.object(tasks, "task_process_meta") as mock_meta, patch(
+            "adscompstat.tasks.logger"
+        ) as mock_logger:
+            mock_app.conf.get.side_effect = conf_get
+            mock_utils.read_updateagent_log.return_value = [f"file{i}.xml" for i in range(5)]
+            tasks.task_process_logfile("/some/logfile.log")
+            mock_app.producer_or_acquire.assert_called_once_with()
+            producer = mock_app.producer_or_acquire.return_value.__enter__.return_value
+            self.assertEqual(
+                [c[1]["producer"] for c in mock_meta.apply_async.call_args_list], [producer] * 3
+            )
+            message = mock_logger.info.call_args[0][0]
+        self.assertTrue(message.startswith("process-meta dispatch metrics: "))
+        dispatch = json.loads(message.split(": ", 1)[1])
+        self.assertEqual((dispatch["batches"], dispatch["records"]), (3, 5))
+        self.assertEqual(dispatch["logfile"], "/some/logfile.log")
+
+    def test_run_tracking_failure_still_dispatches(self):
+        mock_db = MagicMock()
+        mock_db.write_run_batches.side_effect = Exception("db down")
+        delay = self._run(["a.xml"], run_id="run1", mock_db=mock_db)
+        delay.assert_called_once()
+
+
+class TestRunTracking(unittest.TestCase):
+    def test_start_run(self):
+        with patch("adscompstat.tasks.db") as mock_db:
+            run_id = tasks.task_start_run(["a.out", "b.out"])
+            mock_db.write_run_logfiles.assert_called_once_with(
+                tasks.app, run_id, ["a.out", "b.out"]
+            )
+        self.assertNotEqual(run_id, tasks.task_start_run([]))
+
+    def test_get_run_status_defaults_to_latest(self):
+        with patch("adscompstat.tasks.db") as mock_db:
+            mock_db.query_latest_run_id.return_value = "run2"
+            mock_db.query_run_status.return_value = {"run_id": "run2"}
+            self.assertEqual(tasks.task_get_run_status(), {"run_id": "run2"})
+            mock_db.query_run_status.assert_called_once_with(tasks.app, "run2")
+            mock_db.query_latest_run_id.return_value = None
+            self.assertIsNone(tasks.task_get_run_status())
+
+
+# ---------------------------------------------------------------------------
+# _get_matcher
+# ---------------------------------------------------------------------------
+
+
+class TestGetMatcher(unittest.TestCase):
+    def setUp(self):
+        tasks._matcher_cache.update({"matcher": None, "filename": None, "mtime": None})
+
+    def tearDown(self):
+        tasks._matcher_cache.update({"matcher": None, "filename": None, "mtime": None})
+
+    def _write_related(self, filename, related, mtime):
+        with open(filename, "w") as fj:
+            fj.write(json.dumps({"related_bibstems": related}))
+        os.utime(filename, (mtime, mtime))
+
+    def test_matcher_reused_and_reloaded_on_change(self):
+        with tempfile.TemporaryDirectory() as tmpdir, patch("adscompstat.tasks.app") as mock_app:
+            related_file = os.path.join(tmpdir, "related.json")
+            mock_app.conf.get.side_effect = lambda key, default=None: (
+                related_file if key == "JOURNALSDB_RELATED_BIBSTEMS" else default
+            )
+            self._write_related(related_file, [["ApJ..", "ApJS."]], 1000000)
+            first = tasks._get_matcher()
+            self.assertIs(tasks._get_matcher(), first)
+            self.assertEqual(first._compare_bibstems("ApJ..", "ApJS."), "related")
+
+            self._write_related(related_file, [["JGR..", "JGRD."]], 2000000)
+            second = tasks._get_matcher()
+            self.assertIsNot(second, first)
+            self.assertIsNone(second._compare_bibstems("ApJ..", "ApJS."))
+            self.assertEqual(second._compare_bibstems("JGR..", "JGRD."), "related")
+
+    def test_missing_file_gives_matcher_without_relations(self):
+        with patch("adscompstat.tasks.app") as mock_app:
+            mock_app.conf.get.side_effect = lambda key, default=None: (
+                "/nonexistent/related.json" if key == "JOURNALSDB_RELATED_BIBSTEMS" else default
+            )
+            matcher = tasks._get_matcher()
+            self.assertEqual(matcher.related_bibstems, [])
+            self.assertIs(tasks._get_matcher(), matcher)
+
+
+# ---------------------------------------------------------------------------
+# init_worker_process
+# ---------------------------------------------------------------------------
+
+
+class TestInitWorkerProcess(unittest.TestCase):
+    def setUp(self):
+        tasks._matcher_cache.update({"matcher": None, "filename": None, "mtime": None})
+
+    def tearDown(self):
+        tasks._matcher_cache.update({"matcher": None, "filename": None, "mtime": None})
+
+    def test_reusable_objects_made_at_start(self):
+        instances = reusable.ReusableInstances()
+        with patch.object(reusable, "instances", instances), patch(
+            "adsenrich.bibcodes.BibcodeGenerator"
+        ) as mock_bibgen_cls, patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks.app"
+        ) as mock_app:
+            mock_app.conf.get.return_value = None
+            tasks.init_worker_process()
+            mock_bibgen_cls.assert_called_once_with()
+            mock_utils.get_crossref_parser.assert_called_once_with()
+            self.assertIsNotNone(tasks._matcher_cache["matcher"])
+            # and reused by the tasks that follow
+            self.assertIs(tasks._get_bibcode_generator(), mock_bibgen_cls.return_value)
+            mock_bibgen_cls.assert_called_once_with()
+
+    def test_setup_failure_logged(self):
+        with patch.object(reusable, "instances", reusable.ReusableInstances()), patch(
+            "adsenrich.bibcodes.BibcodeGenerator", side_effect=Exception("no config")
+        ), patch("adscompstat.tasks.logger") as mock_logger:
+            tasks.init_worker_process()
+            mock_logger.warning.assert_called_once()
+
+
+# ---------------------------------------------------------------------------
+# shutdown_worker_process
+# ---------------------------------------------------------------------------
+
+
+class TestShutdownWorkerProcess(unittest.TestCase):
+    def test_removes_metrics_file(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.remove_prometheus_file"
+        ) as mock_remove:
+            mock_app.conf.get.side_effect = lambda key, default=None: (
+                "/metrics" if key == "METRICS_DIR" else default
+            )
+            tasks.shutdown_worker_process()
+            mock_remove.assert_called_once_with("/metrics")
+            mock_app.conf.get.side_effect = lambda key, default=None: default
+            tasks.shutdown_worker_process()
+            mock_remove.assert_called_once()
+
+
+# ---------------------------------------------------------------------------
+# _get_candidate_index
+# ---------------------------------------------------------------------------
+
+
+class TestGetCandidateIndex(unittest.TestCase):
+    def _conf(self, enabled):
+        conf = {"FUZZY_MATCH_UNMATCHED": enabled}
+        return lambda key, default=None: conf.get(key, default)
+
+    def test_disabled_returns_none(self):
+        with patch("adscompstat.tasks.app") as mock_app:
+            mock_app.conf.get.side_effect = self._conf(False)
+            self.assertIsNone(tasks._get_candidate_index())
+            self.assertIsNone(tasks._get_candidate_index(MagicMock()))
+
+    def test_database_lookup_per_volume(self):
+        rows = [("2000ApJ...999..999Z", "2000ApJ...999..999Z", "canonical")]
+        with patch("adscompstat.tasks.app") as mock_app, patch("adscompstat.tasks.db") as mock_db:
+            mock_app.conf.get.side_effect = self._conf(True)
+            mock_db.query_candidate_bibcodes.return_value = rows
+            index = tasks._get_candidate_index()
+            mock_db.query_candidate_bibcodes.assert_not_called()
+            self.assertEqual(index.candidates("2000ApJ...999Q.999A"), rows)
+            self.assertEqual(index.candidates("2000ApJ...999..123Z"), rows)
+            mock_db.query_candidate_bibcodes.assert_called_once_with(
+                mock_app, ["1999ApJ...999", "2000ApJ...999", "2001ApJ...999"]
+            )
+
+    def test_store_lookup(self):
+        store = MagicMock()
+        store.lookup_prefixes.return_value = []
+        with patch("adscompstat.tasks.app") as mock_app, patch("adscompstat.tasks.db") as mock_db:
+            mock_app.conf.get.side_effect = self._conf(True)
+            index = tasks._get_candidate_index(store)
+            self.assertEqual(index.candidates("2000ApJ...999Q.999A"), [])
+            store.lookup_prefixes.assert_called_once()
+            mock_db.query_candidate_bibcodes.assert_not_called()
+
+    def test_lookup_failure_is_caught(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch("adscompstat.tasks.db") as mock_db:
+            mock_app.conf.get.side_effect = self._conf(True)
+            mock_db.query_candidate_bibcodes.side_effect = Exception("db err")
+            self.assertEqual(tasks._get_candidate_index().candidates("2000ApJ...999Q.999A"), [])
+
+
+# ---------------------------------------------------------------------------
+# _get_classic_store / _query_classic_bibcodes
+# ---------------------------------------------------------------------------
+
+
+class TestClassicStoreLookup(unittest.TestCase):
+    def test_no_store_configured(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.classic_store"
+        ) as mock_store:
+            mock_app.conf.get.return_value = None
+            self.assertIsNone(tasks._get_classic_store())
+            mock_store.get_classic_store.assert_not_called()
+
+    def test_store_configured(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.classic_store"
+        ) as mock_store:
+            mock_app.conf.get.return_value = "/tmp/classic_store.bin"
+            self.assertIs(tasks._get_classic_store(), mock_store.get_classic_store.return_value)
+            mock_store.get_classic_store.assert_called_once_with("/tmp/classic_store.bin")
+
+    def test_query_uses_store(self):
+        store = MagicMock()
+        store.query_classic_bibcodes.return_value = (["a"], ["b"])
+        with patch("adscompstat.tasks.db") as mock_db:
+            result = tasks._query_classic_bibcodes(store, "10.1/x", "2020ApJ...900..100A")
+            mock_db.query_classic_bibcodes.assert_not_called()
+        self.assertEqual(result, (["a"], ["b"]))
+
+    def test_query_falls_back_to_db(self):
+        with patch("adscompstat.tasks.db") as mock_db:
+            mock_db.query_classic_bibcodes.return_value = ([], [])
+            result = tasks._query_classic_bibcodes(None, "10.1/x", "2020ApJ...900..100A")
+        self.assertEqual(result, ([], []))
+
+    def test_query_skips_bloom_misses(self):
+        bloom = MagicMock()
+        bloom.may_contain_doi.return_value = False
+        bloom.may_contain_bibcode.return_value = True
+        metrics = BatchMetrics()
+        with patch("adscompstat.tasks.db") as mock_db:
+            mock_db.query_classic_bibcodes.return_value = ([], ["b"])
+            result = tasks._query_classic_bibcodes(
+                None, "10.1/x", "2020ApJ...900..100A", bloom=bloom, metrics=metrics
+            )
+            self.assertEqual(
+                mock_db.query_classic_bibcodes.call_args[0][1:], ("", "2020ApJ...900..100A")
+            )
+        self.assertEqual(result, ([], ["b"]))
+        self.assertEqual(metrics.bloom, {"checks": 1, "doi_skips": 1, "bibcode_skips": 0})
+
+    def test_query_skipped_entirely(self):
+        bloom = MagicMock()
+        bloom.may_contain_doi.return_value = False
+        bloom.may_contain_bibcode.return_value = False
+        metrics = BatchMetrics()
+        with patch("adscompstat.tasks.db") as mock_db:
+            result = tasks._query_classic_bibcodes(
+                None, "10.1/x", "2020ApJ...900..100A", bloom=bloom, metrics=metrics
+            )
+            mock_db.query_classic_bibcodes.assert_not_called()
+        self.assertEqual(result, ([], []))
+        self.assertEqual(metrics.bloom["bibcode_skips"], 1)
+
+
+# ---------------------------------------------------------------------------
+# _make_batches
+# ---------------------------------------------------------------------------
+
+
+class TestMakeBatches(unittest.TestCase):
+    def _run(self, files, sizes, conf, cost_model=None):
+        def conf_get(key, default=None):
+            return conf.get(key, default)
+
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils:
+            mock_app.conf.get.side_effect = conf_get
+            mock_utils.get_file_size.side_effect = lambda f: sizes[f]
+            mock_utils.load_batch_cost_model.return_value = cost_model
+            self.sized = [nbytes for (batch, nbytes) in tasks._make_batches(files)]
+            return [batch for (batch, nbytes) in tasks._make_batches(files)]
+
+    def test_no_target_batches_by_count_only(self):
+        # no sizes given: get_file_size would raise KeyError if it were called
+        files = ["a", "b", "c"]
+        batches = self._run(files, {}, {"RECORDS_PER_BATCH": 2})
+        self.assertEqual(batches, [["a", "b"], ["c"]])
+        self.assertEqual(self.sized, [None, None])
+
+    def test_target_bytes_closes_batch_on_size(self):
+        files = ["a", "b", "c", "d"]
+        sizes = {"a": 600, "b": 600, "c": 100, "d": 100}
+        conf = {"RECORDS_PER_BATCH": 100, "BATCH_TARGET_BYTES": 1000}
+        batches = self._run(files, sizes, conf)
+        self.assertEqual(batches, [["a", "b"], ["c", "d"]])
+        self.assertEqual(self.sized, [1200, 200])
+
+    def test_target_bytes_still_capped_by_record_count(self):
+        files = ["a", "b", "c"]
+        sizes = {"a": 1, "b": 1, "c": 1}
+        conf = {"RECORDS_PER_BATCH": 2, "BATCH_TARGET_BYTES": 1000}
+        batches = self._run(files, sizes, conf)
+        self.assertEqual(batches, [["a", "b"], ["c"]])
+
+    def test_target_seconds_uses_cost_model(self):
+        # each file costs 1 s + 1 ms/byte → a: 2 s, b: 2 s, c: 11 s
+        files = ["a", "b", "c", "d"]
+        sizes = {"a": 1000, "b": 1000, "c": 10000, "d": 0}
+        conf = {
+            "RECORDS_PER_BATCH": 100,
+            "BATCH_TARGET_SECONDS": 4,
+            "BATCH_TARGET_BYTES": 1,
+        }
+        model = {"per_record": 1.0, "per_byte": 0.001}
+        batches = self._run(files, sizes, conf, cost_model=model)
+        self.assertEqual(batches, [["a", "b"], ["c"], ["d"]])
+
+    def test_target_seconds_without_model_falls_back_to_bytes(self):
+        files = ["a", "b", "c"]
+        sizes = {"a": 5, "b": 5, "c": 5}
+        conf = {"RECORDS_PER_BATCH": 100, "BATCH_TARGET_SECONDS": 4, "BATCH_TARGET_BYTES": 10}
+        batches = self._run(files, sizes, conf, cost_model=None)
+        self.assertEqual(batches, [["a", "b"], ["c"]])
+
+    def test_target_seconds_without_model_still_sizes(self):
+        # so that the batches' timings can be recorded to fit the model
+        files = ["a", "b", "c"]
+        sizes = {"a": 5, "b": 5, "c": 5}
+        conf = {"RECORDS_PER_BATCH": 2, "BATCH_TARGET_SECONDS": 4}
+        batches = self._run(files, sizes, conf, cost_model=None)
+        self.assertEqual(batches, [["a", "b"], ["c"]])
+        self.assertEqual(self.sized, [10, 5])
+
+
+class TestRecordBatchTiming(unittest.TestCase):
+    def _conf(self, key, default=None):
+        return {"BATCH_COST_MODEL_FILE": "/model.json", "BATCH_TARGET_BYTES": 1000}.get(
+            key, default
+        )
+
+    def test_uses_dispatched_size(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils:
+            mock_app.conf.get.side_effect = self._conf
+            tasks._record_batch_timing(["a", "b"], 2.0, nbytes=300)
+            mock_utils.get_file_size.assert_not_called()
+            mock_utils.update_batch_cost_model.assert_called_once_with(
+                "/model.json", 2, 300, 2.0, decay=0.95
+            )
+
+    def test_sizes_files_without_dispatched_size(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils:
+            mock_app.conf.get.side_effect = self._conf
+            mock_utils.get_file_size.return_value = 100
+            tasks._record_batch_timing(["a", "b"], 2.0)
+            mock_utils.update_batch_cost_model.assert_called_once_with(
+                "/model.json", 2, 200, 2.0, decay=0.95
+            )
+
 
 # ---------------------------------------------------------------------------
 # task_process_meta
@@ -275,9 +707,9 @@ class TestTaskProcessMeta(unittest.TestCase):
 
         with patch("adscompstat.tasks.utils") as mock_utils, patch(
             "adscompstat.tasks.db"
-        ) as mock_db, patch("adscompstat.tasks.BibcodeGenerator") as mock_bibgen_cls, patch(
-            "adscompstat.tasks.CrossrefMatcher"
-        ) as mock_matcher_cls, patch.object(
+        ) as mock_db, patch("adsenrich.bibcodes.BibcodeGenerator") as mock_bibgen_cls, patch(
+            "adscompstat.tasks._get_matcher"
+        ) as mock_get_matcher, patch.object(
             tasks, "task_write_matched_record_to_db"
         ) as mock_write:
             mock_write.delay = MagicMock()
@@ -297,8 +729,10 @@ class TestTaskProcessMeta(unittest.TestCase):
             mock_bibgen_cls.return_value = mock_bibgen
 
             mock_xmatch = MagicMock()
-            mock_xmatch.match.return_value = resolved_xmatch
-            mock_matcher_cls.return_value = mock_xmatch
+            mock_xmatch.match_batch.side_effect = lambda bibcodes, fromDoi, fromBib: [
+                resolved_xmatch for b in bibcodes
+            ]
+            mock_get_matcher.return_value = mock_xmatch
 
             tasks.task_process_meta(infile_batch)
             return mock_write.delay
@@ -381,6 +815,62 @@ class TestTaskProcessMeta(unittest.TestCase):
         self.assertEqual(record[5], "NoIndex")
         self.assertEqual(record[6], "other")
 
+    def test_fast_parse_uses_fast_extractor(self):
+        process_return = {
+            "status": "",
+            "master_doi": "10.1234/test",
+            "issns": {},
+            "master_bibdata": {},
+            "record": {},
+        }
+        with patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks.db"
+        ) as mock_db, patch("adsenrich.bibcodes.BibcodeGenerator"), patch(
+            "adscompstat.tasks._get_matcher"
+        ) as mock_get_matcher, patch.object(
+            tasks, "task_write_matched_record_to_db"
+        ) as mock_write:
+            mock_utils.process_one_meta_xml_fast.return_value = process_return
+            mock_db.query_classic_bibcodes.return_value = ([], [])
+            mock_get_matcher.return_value.match_batch.return_value = [
+                {"match": "canonical", "bibcode": "2000ApJ...999..999Z", "errs": {}}
+            ]
+            tasks.task_process_meta(["/path/fast.xml"], fast_parse=True)
+            mock_utils.process_one_meta_xml_fast.assert_called_once_with("/path/fast.xml")
+            mock_utils.process_one_meta_xml.assert_not_called()
+            self.assertEqual(mock_write.delay.call_args[0][0][5], "Matched")
+
+    def test_run_batch_counts_queued_records(self):
+        process_return = {
+            "status": "",
+            "master_doi": "10.1234/test",
+            "issns": {},
+            "master_bibdata": {},
+            "record": {},
+        }
+        with patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks.db"
+        ) as mock_db, patch("adsenrich.bibcodes.BibcodeGenerator"), patch(
+            "adscompstat.tasks._get_matcher"
+        ) as mock_get_matcher, patch.object(
+            tasks, "task_write_matched_record_to_db"
+        ) as mock_write:
+            mock_utils.process_one_meta_xml.side_effect = [
+                process_return,
+                {"status": "MissingDOI"},
+            ]
+            mock_db.query_classic_bibcodes.return_value = ([], [])
+            mock_get_matcher.return_value.match_batch.return_value = [
+                {"match": "canonical", "bibcode": "2000ApJ...999..999Z", "errs": {}}
+            ]
+            tasks.task_process_meta(["/a.xml", "/b.xml"], "run1", "a.out", 3)
+            # the matched record is counted by write-db once it's written
+            self.assertEqual(mock_write.delay.call_args_list[0][0][1:], ("run1", "a.out", 3))
+            self.assertEqual(mock_write.delay.call_args_list[1][0][1:], ())
+            mock_db.update_run_batch.assert_called_once_with(
+                tasks.app, "run1", "a.out", 3, 0, 1, queued=1
+            )
+
     def test_matching_exception_writes_failed_record(self):
         process_return = {
             "status": "",
@@ -391,7 +881,9 @@ class TestTaskProcessMeta(unittest.TestCase):
         }
         with patch("adscompstat.tasks.utils") as mock_utils, patch(
             "adscompstat.tasks.db"
-        ) as mock_db, patch("adscompstat.tasks.BibcodeGenerator") as mock_bibgen_cls, patch.object(
+        ) as mock_db, patch(
+            "adsenrich.bibcodes.BibcodeGenerator"
+        ) as mock_bibgen_cls, patch.object(
             tasks, "task_write_matched_record_to_db"
         ) as mock_write:
             mock_write.delay = MagicMock()
@@ -421,10 +913,309 @@ class TestTaskProcessMeta(unittest.TestCase):
         self.assertEqual(record[5], "Matched")
         self.assertEqual(record[6], "deleted")
 
+    def test_batch_matched_once_and_order_preserved(self):
+        process_return = {
+            "status": "",
+            "master_doi": "10.1234/test",
+            "issns": {},
+            "master_bibdata": {},
+            "record": {},
+        }
+
+        def process(infile):
+            if infile == "/path/bad.xml":
+                raise Exception("parse error")
+            return process_return
+
+        with patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks.db"
+        ) as mock_db, patch("adsenrich.bibcodes.BibcodeGenerator") as mock_bibgen_cls, patch(
+            "adscompstat.tasks._get_matcher"
+        ) as mock_get_matcher, patch.object(
+            tasks, "task_write_matched_record_to_db"
+        ) as mock_write:
+            mock_write.delay = MagicMock()
+            mock_utils.process_one_meta_xml.side_effect = process
+            mock_db.query_classic_bibcodes.return_value = ([], [])
+            mock_bibgen_cls.return_value.make_bibcode.return_value = "2000ApJ...999..999Z"
+            mock_xmatch = mock_get_matcher.return_value
+            mock_xmatch.match_batch.return_value = [
+                {"match": "canonical", "bibcode": "2000ApJ...999..999Z", "errs": {}},
+                {"match": "unmatched", "bibcode": None, "errs": {}},
+            ]
+            tasks.task_process_meta(["/path/a.xml", "/path/bad.xml", "/path/c.xml"])
+            mock_xmatch.match_batch.assert_called_once()
+            self.assertEqual(len(mock_xmatch.match_batch.call_args[0][0]), 2)
+            records = [c[0][0] for c in mock_write.delay.call_args_list]
+            self.assertEqual(
+                [r[0] for r in records], ["/path/a.xml", "/path/bad.xml", "/path/c.xml"]
+            )
+            self.assertEqual([r[6] for r in records], ["canonical", "failed", "unmatched"])
+
     def test_batch_outer_exception_is_caught(self):
         # Passing a non-iterable should trigger the outer except
         tasks.task_process_meta(None)
 
+    def test_batch_metrics_collected(self):
+        with patch("adscompstat.tasks.BatchMetrics") as mock_metrics_cls:
+            mock_metrics = mock_metrics_cls.return_value
+            self._run_meta(["/path/a.xml", "/path/b.xml"], process_raise=ValueError("bad"))
+        self.assertEqual(mock_metrics.start_record.call_count, 2)
+        mock_metrics.failure.assert_called_with("parse", "ValueError")
+        self.assertEqual(mock_metrics.end_record.call_count, 2)
+        # (plus a "read" stage per file, if PREFETCH_DEPTH is configured)
+        stages = [c[0][0] for c in mock_metrics.stage.call_args_list if c[0][0] != "read"]
+        self.assertEqual(stages, ["parse", "parse", "match", "dispatch"])
+        mock_metrics.finish.assert_called_once()
+
+    def test_read_ahead_data_passed_to_parser(self):
+        tmpdir = tempfile.mkdtemp()
+        infiles = []
+        for i in range(3):
+            infiles.append(os.path.join(tmpdir, "%s.xml" % i))
+            with open(infiles[-1], "wb") as fx:
+                fx.write(b"<record>%d</record>" % i)
+        infiles.append(os.path.join(tmpdir, "missing.xml"))
+        metrics = BatchMetrics()
+        try:
+            with patch("adscompstat.tasks.app") as mock_app, patch(
+                "adscompstat.tasks.utils"
+            ) as mock_utils:
+                mock_app.conf.get.side_effect = lambda key, default=None: (
+                    2 if key == "PREFETCH_DEPTH" else default
+                )
+                mock_utils.process_one_meta_xml.return_value = {"status": "No DOI found"}
+                with tasks._read_ahead(infiles, metrics) as read_ahead:
+                    for i, infile in enumerate(infiles):
+                        tasks._parse_record(infile, metrics, data=read_ahead(i))
+                calls = mock_utils.process_one_meta_xml.call_args_list
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(calls[0][1], {"data": b"<record>0</record>"})
+        # a file that couldn't be read ahead is left to the parser to read
+        self.assertEqual(calls[3][0], (infiles[3],))
+        self.assertEqual(calls[3][1], {})
+        self.assertEqual(metrics.prefetch["files"], 3)
+        self.assertEqual(metrics.prefetch["misses"], 1)
+        self.assertGreaterEqual(metrics.stage_seconds["read"], 0.0)
+
+    def test_record_cache_skips_parser(self):
+        tmpdir = tempfile.mkdtemp()
+        infile = os.path.join(tmpdir, "0.xml")
+        with open(infile, "wb") as fx:
+            fx.write(b"<record>0</record>")
+        processedRecord = {"harvest_filepath": infile, "master_doi": "10.1000/xyz"}
+        metrics = BatchMetrics()
+        try:
+            with patch("adscompstat.tasks.app") as mock_app, patch(
+                "adscompstat.tasks.utils"
+            ) as mock_utils:
+                mock_app.conf.get.side_effect = lambda key, default=None: (
+                    os.path.join(tmpdir, "cache") if key == "PARSED_RECORD_CACHE_DIR" else default
+                )
+                mock_utils.PROCESSED_RECORD_VERSION = 1
+                mock_utils.process_one_meta_xml.return_value = processedRecord
+                first = tasks._parse_record(infile, metrics)
+                second = tasks._parse_record(infile, metrics)
+                # the fast parser's records are cached separately
+                mock_utils.process_one_meta_xml_fast.return_value = processedRecord
+                tasks._parse_record(infile, metrics, fast_parse=True)
+                with open(infile, "wb") as fx:
+                    fx.write(b"<record>1</record>")
+                tasks._parse_record(infile, metrics)
+                # nor are records made by a different version of the extraction
+                mock_utils.PROCESSED_RECORD_VERSION = 2
+                tasks._parse_record(infile, metrics)
+                calls = mock_utils.process_one_meta_xml.call_args_list
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(first, (processedRecord, None))
+        self.assertEqual(second, (processedRecord, None))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0][1], {"data": b"<record>0</record>"})
+        self.assertEqual(calls[1][1], {"data": b"<record>1</record>"})
+        self.assertEqual(calls[2][1], {"data": b"<record>1</record>"})
+        mock_utils.process_one_meta_xml_fast.assert_called_once()
+        self.assertEqual(metrics.record_cache, {"hits": 1, "misses": 4})
+
+    def test_batch_metrics_finished_on_outer_exception(self):
+        with patch("adscompstat.tasks.BatchMetrics") as mock_metrics_cls:
+            tasks.task_process_meta(None)
+        mock_metrics_cls.return_value.finish.assert_called_once()
+
+    def test_async_db_batch(self):
+        adb = MagicMock()
+        adb.query_bibstems.return_value = ["ApJ..", Exception("lookup failed")]
+        adb.query_classic_bibcodes_batch.return_value = [([("b1", "b1", "canonical")], [])]
+        adb.write_matched_records.side_effect = lambda records: [None] * len(records)
+        with patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks._get_async_db", return_value=adb
+        ), patch("adsenrich.bibcodes.BibcodeGenerator") as mock_bibgen_cls, patch(
+            "adscompstat.tasks._get_matcher"
+        ) as mock_get_matcher, patch(
+            "adscompstat.tasks._get_classic_store", return_value=None
+        ), patch(
+            "adscompstat.tasks.db"
+        ) as mock_db, patch.object(
+            tasks, "task_write_matched_record_to_db"
+        ) as mock_write:
+            mock_utils.process_one_meta_xml.side_effect = [
+                {"record": {}, "master_doi": "10.1/a"},
+                {"record": {}, "master_doi": "10.1/b"},
+                {"status": "MissingDOI"},
+            ]
+            mock_bibgen_cls.return_value.make_bibcode.return_value = "2000ApJ...999..999Z"
+            mock_get_matcher.return_value.match_batch.side_effect = lambda b, d, c: [
+                {"match": "canonical", "bibcode": "2000ApJ...999..999Z", "errs": {}} for x in b
+            ]
+            tasks.task_process_meta(["/a.xml", "/b.xml", "/c.xml"])
+            mock_db.query_bibstem.assert_not_called()
+            mock_write.delay.assert_not_called()
+        adb.query_classic_bibcodes_batch.assert_called_once_with(
+            [("10.1/a", "2000ApJ...999..999Z")]
+        )
+        records = adb.write_matched_records.call_args[0][0]
+        self.assertEqual([r[5] for r in records], ["Matched", "Failed", "Failed"])
+        self.assertEqual([r[0] for r in records], ["/a.xml", "/b.xml", "/c.xml"])
+
+    def test_async_write_failures_counted(self):
+        adb = MagicMock()
+        adb.query_bibstems.return_value = ["ApJ..", "ApJ.."]
+        adb.query_classic_bibcodes_batch.return_value = [([], []), ([], [])]
+        adb.write_matched_records.side_effect = lambda records: [Exception("write failed"), None]
+        with patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks._get_async_db", return_value=adb
+        ), patch("adsenrich.bibcodes.BibcodeGenerator") as mock_bibgen_cls, patch(
+            "adscompstat.tasks._get_matcher"
+        ) as mock_get_matcher, patch(
+            "adscompstat.tasks._get_classic_store", return_value=None
+        ), patch(
+            "adscompstat.tasks.db"
+        ) as mock_db:
+            mock_utils.process_one_meta_xml.side_effect = [
+                {"record": {}, "master_doi": "10.1/a"},
+                {"record": {}, "master_doi": "10.1/b"},
+            ]
+            mock_bibgen_cls.return_value.make_bibcode.return_value = "2000ApJ...999..999Z"
+            mock_get_matcher.return_value.match_batch.side_effect = lambda b, d, c: [
+                {"match": "canonical", "bibcode": "2000ApJ...999..999Z", "errs": {}} for x in b
+            ]
+            tasks.task_process_meta(["/a.xml", "/b.xml"], "run1", "a.out", 0)
+            mock_db.update_run_batch.assert_called_once_with(
+                tasks.app, "run1", "a.out", 0, 1, 1, queued=0
+            )
+
+    def _memo_records(self):
+        record = {
+            "publication": {"ISSN": [{"pubtype": "print", "issnString": "0004-637X"}]},
+            "pagination": {"firstPage": "1"},
+            "authors": [{"name": {"surname": "Doe"}}],
+        }
+        other = dict(record, pagination={"firstPage": "2"})
+        return [
+            {"record": record, "master_doi": "10.1/a"},
+            {"record": dict(record), "master_doi": "10.1/b"},
+            {"record": other, "master_doi": "10.1/c"},
+        ]
+
+    def test_memoized_bibcodes(self):
+        memo = bibcode_memo.BibcodeMemo(10)
+        metrics = BatchMetrics()
+        bibgen = MagicMock()
+        bibgen.make_bibcode.side_effect = ["2000ApJ...999....1D", "2000ApJ...999....2D"]
+        store = MagicMock()
+        store.query_classic_bibcodes.return_value = ([], [])
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils, patch("adscompstat.tasks.db") as mock_db:
+            mock_app.conf.get.return_value = None
+            mock_utils.process_one_meta_xml.side_effect = self._memo_records()
+            mock_db.query_bibstem.return_value = "ApJ.."
+            (matched, toMatch, fromDoi, fromBib) = tasks._prepare_batch(
+                ["/a.xml", "/b.xml", "/c.xml"], bibgen, store, metrics, memo=memo
+            )
+            self.assertEqual(mock_db.query_bibstem.call_count, 2)
+        self.assertEqual(bibgen.make_bibcode.call_count, 2)
+        self.assertEqual(
+            [t[3] for t in toMatch],
+            ["2000ApJ...999....1D", "2000ApJ...999....1D", "2000ApJ...999....2D"],
+        )
+        self.assertEqual(metrics.bibcode_memo, {"hits": 1, "misses": 2})
+        self.assertEqual(len(memo), 2)
+
+    def test_memoized_bibcodes_async(self):
+        memo = bibcode_memo.BibcodeMemo(10)
+        metrics = BatchMetrics()
+        bibgen = MagicMock()
+        bibgen.make_bibcode.side_effect = lambda r, bibstem: "2000%s999....%sD" % (
+            bibstem,
+            r["pagination"]["firstPage"],
+        )
+        adb = MagicMock()
+        adb.query_bibstems.side_effect = lambda records: ["ApJ.."] * len(records)
+        adb.query_classic_bibcodes_batch.side_effect = lambda lookups: [([], [])] * len(lookups)
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.utils"
+        ) as mock_utils:
+            mock_app.conf.get.return_value = None
+            mock_utils.process_one_meta_xml.side_effect = self._memo_records()[0:2]
+            tasks._prepare_batch_async(adb, ["/a.xml", "/c.xml"], bibgen, None, metrics, memo=memo)
+            mock_utils.process_one_meta_xml.side_effect = self._memo_records()
+            (matched, toMatch, fromDoi, fromBib) = tasks._prepare_batch_async(
+                adb, ["/a.xml", "/b.xml", "/c.xml"], bibgen, None, metrics, memo=memo
+            )
+        # in the second batch, only the record not in the first is looked up
+        self.assertEqual(len(adb.query_bibstems.call_args[0][0]), 1)
+        self.assertEqual(bibgen.make_bibcode.call_count, 3)
+        self.assertEqual(
+            [t[3] for t in toMatch],
+            ["2000ApJ..999....1D", "2000ApJ..999....1D", "2000ApJ..999....2D"],
+        )
+        self.assertEqual([t[0] for t in toMatch], [0, 1, 2])
+        self.assertEqual(metrics.bibcode_memo, {"hits": 2, "misses": 3})
+
+    def test_unchanged_records_skipped(self):
+        records = [_make_record(), _make_record(doi="10.1/other")]
+        metrics = MagicMock(unchanged=0)
+        with patch("adscompstat.tasks.db") as mock_db:
+            mock_db.query_master_hashes.return_value = {records[0][1]: "same", "10.1/other": "old"}
+            mock_db.record_hash.side_effect = lambda r: "same" if r is records[0] else "new"
+            self.assertEqual(tasks._changed_records(records, metrics), [records[1]])
+            self.assertEqual(metrics.unchanged, 1)
+            mock_db.query_master_hashes.side_effect = Exception("db down")
+            self.assertEqual(tasks._changed_records(records, metrics), records)
+
+    def test_get_async_db_fallback(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.database_async.get_async_db", side_effect=ImportError("no asyncpg")
+        ):
+            mock_app.conf.get.side_effect = lambda k, d=None: True if k == "ASYNC_DB" else d
+            self.assertIsNone(tasks._get_async_db())
+            mock_app.conf.get.side_effect = lambda k, d=None: d
+            self.assertIsNone(tasks._get_async_db())
+
+    def test_run_batch_updated(self):
+        with patch("adscompstat.tasks.utils") as mock_utils, patch(
+            "adscompstat.tasks.db"
+        ) as mock_db, patch.object(tasks, "task_write_matched_record_to_db"):
+            mock_utils.process_one_meta_xml.side_effect = [
+                Exception("parse error"),
+                {"status": "MissingDOI"},
+            ]
+            tasks.task_process_meta(["/a.xml", "/b.xml"], "run1", "a.out", 4)
+            mock_db.update_run_batch.assert_called_once_with(
+                tasks.app, "run1", "a.out", 4, 0, 2, queued=0
+            )
+
+    def test_run_batch_updated_on_outer_exception(self):
+        with patch("adscompstat.tasks.db") as mock_db, patch(
+            "adscompstat.tasks._get_matcher", side_effect=Exception("no matcher")
+        ):
+            tasks.task_process_meta(["/a.xml"], "run1", "a.out", 0)
+            mock_db.update_run_batch.assert_called_once_with(
+                tasks.app, "run1", "a.out", 0, 0, 1, queued=0
+            )
+
 
 # ---------------------------------------------------------------------------
 # task_completeness_per_bibstem
@@ -685,10 +1476,9 @@ class TestTaskRetryRecords(unittest.TestCase):
             "adscompstat.tasks.db"
         ) as mock_db, patch.object(tasks, "task_process_meta") as mock_meta:
             mock_app.conf.get.side_effect = conf_get
-            mock_meta.delay = MagicMock()
             mock_db.query_retry_files.return_value = db_rows
             tasks.task_retry_records("unmatched")
-            return mock_meta.delay
+            return _delay_calls(mock_meta)
 
     def test_empty_result_no_delay(self):
         delay = self._run([])
@@ -720,6 +1510,68 @@ class TestTaskRetryRecords(unittest.TestCase):
             mock_db.query_retry_files.side_effect = Exception("query error")
             tasks.task_retry_records("failed")
 
+    def test_bundled_files_sized_for_batches(self):
+        # the bundle location isn't yet configured on a worker that hasn't
+        # processed a logfile
+        tmpdir = tempfile.mkdtemp()
+        base_dir = os.path.join(tmpdir, "Crossref") + "/"
+        bundle_dir = os.path.join(tmpdir, "bundles")
+        files = []
+        for i, size in enumerate([600, 600, 300]):
+            filename = os.path.join(base_dir, "doi/10.3847/00/67/%s/metadata.xml" % i)
+            os.makedirs(os.path.dirname(filename))
+            with open(filename, "wb") as fx:
+                fx.write(b"x" * size)
+            files.append(filename)
+        conf = {
+            "RECORDS_PER_BATCH": 100,
+            "BATCH_TARGET_BYTES": 1000,
+            "HARVEST_BASE_DIR": base_dir,
+            "HARVEST_BUNDLE_DIR": bundle_dir,
+            "HARVEST_BUNDLE_DEPTH": 4,
+        }
+        try:
+            tasks.harvest_archive.pack_harvest_tree(base_dir, bundle_dir, 4)
+            shutil.rmtree(os.path.join(base_dir, "doi"))
+            tasks.harvest_archive.configure(None)
+            with patch("adscompstat.tasks.app") as mock_app, patch(
+                "adscompstat.tasks.db"
+            ) as mock_db, patch.object(tasks, "task_process_meta") as mock_meta:
+                mock_app.conf.get.side_effect = lambda key, default=None: conf.get(key, default)
+                mock_db.query_retry_files.return_value = [(f,) for f in files]
+                tasks.task_retry_records("failed")
+                delay = _delay_calls(mock_meta)
+        finally:
+            tasks.harvest_archive.configure(None)
+            shutil.rmtree(tmpdir)
+        self.assertEqual([len(c[0][0]) for c in delay.call_args_list], [2, 1])
+        self.assertEqual(
+            [c[1] for c in delay.call_args_list], [{"batch_bytes": 1200}, {"batch_bytes": 300}]
+        )
+
+    def test_failed_retry_marked_in_run(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch("adscompstat.tasks.db") as mock_db:
+            mock_app.conf.get.return_value = 100
+            mock_db.query_retry_files.side_effect = Exception("query error")
+            tasks.task_retry_records("failed", "run1")
+            mock_db.fail_run_logfile.assert_called_once_with(mock_app, "run1", "retry:failed")
+
+    def test_run_batches_recorded(self):
+        with patch("adscompstat.tasks.app") as mock_app, patch(
+            "adscompstat.tasks.db"
+        ) as mock_db, patch.object(tasks, "task_process_meta") as mock_meta:
+            mock_app.conf.get.side_effect = lambda key, default=None: (
+                100 if key == "RECORDS_PER_BATCH" else default
+            )
+            mock_db.query_retry_files.return_value = [("/path/a.xml",)]
+            tasks.task_retry_records("failed", "run1")
+            mock_db.write_run_batches.assert_called_once_with(
+                mock_app, "run1", "retry:failed", [1]
+            )
+            _delay_calls(mock_meta).assert_called_once_with(
+                ["/path/a.xml"], "run1", "retry:failed", 0
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
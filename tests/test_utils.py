@@ -1,4 +1,6 @@
+import codecs
 import json
+import multiprocessing
 import os
 import tempfile
 import unittest
@@ -6,10 +8,13 @@ from unittest.mock import patch
 
 from adscompstat import utils
 from adscompstat.exceptions import (
+    BatchCostModelException,
     CompletenessFractionException,
+    FastParseException,
     JsonExportException,
     LoadIssnDataException,
     MissingFilenameException,
+    XmlEncodingException,
 )
 
 
@@ -93,11 +98,65 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(Exception):
             utils.read_updateagent_log(test_logfile_fail)
 
+    # ------------------------------------------------------------------
+    # get_file_size / batch cost model
+    # ------------------------------------------------------------------
+
+    def test_get_file_size(self):
+        self.assertEqual(utils.get_file_size("tests/stubdata/input/canonical_list"), 119)
+        self.assertEqual(utils.get_file_size("/nonexistent/path"), 0)
+
+    def test_load_batch_cost_model_missing_file(self):
+        self.assertIsNone(utils.load_batch_cost_model("/nonexistent/path"))
+        self.assertIsNone(utils.load_batch_cost_model(None))
+
+    def test_batch_cost_model_fit(self):
+        # batches timed at exactly 0.5 s/record + 0.001 s/byte
+        with tempfile.TemporaryDirectory() as tmpdir:
+            statefile = os.path.join(tmpdir, "model.json")
+            for nrec, nbytes in [(10, 1000), (100, 5000), (50, 50000)]:
+                seconds = 0.5 * nrec + 0.001 * nbytes
+                utils.update_batch_cost_model(statefile, nrec, nbytes, seconds)
+            model = utils.load_batch_cost_model(statefile)
+        self.assertAlmostEqual(model["per_record"], 0.5)
+        self.assertAlmostEqual(model["per_byte"], 0.001)
+
+    def test_batch_cost_model_degenerate_falls_back_to_per_byte(self):
+        # every batch has the same bytes/record, so the terms can't be separated
+        with tempfile.TemporaryDirectory() as tmpdir:
+            statefile = os.path.join(tmpdir, "model.json")
+            utils.update_batch_cost_model(statefile, 10, 1000, 2.0)
+            utils.update_batch_cost_model(statefile, 20, 2000, 4.0)
+            model = utils.load_batch_cost_model(statefile)
+        self.assertEqual(model["per_record"], 0.0)
+        self.assertAlmostEqual(model["per_byte"], 0.002)
+
+    def test_update_batch_cost_model_concurrent(self):
+        # updates from several processes at once aren't lost
+        with tempfile.TemporaryDirectory() as tmpdir:
+            statefile = os.path.join(tmpdir, "model.json")
+
+            def update():
+                for i in range(20):
+                    utils.update_batch_cost_model(statefile, 10, 1000, 2.0)
+
+            procs = [multiprocessing.Process(target=update) for i in range(4)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+            with open(statefile, "r") as fs:
+                self.assertEqual(json.load(fs)["batches"], 80)
+
+    def test_update_batch_cost_model_bad_path(self):
+        with self.assertRaises(BatchCostModelException):
+            utils.update_batch_cost_model("/nonexistent_dir/model.json", 1, 1, 1.0)
+
     # ------------------------------------------------------------------
     # process_one_meta_xml
     # ------------------------------------------------------------------
 
-    @patch("adscompstat.utils.CrossrefParser")
+    @patch("adsingestp.parsers.crossref.CrossrefParser")
     def test_process_one_meta_xml(self, mock_parser_class):
         # Mock the parser so this test does not require a real CrossRef XML file
         # or the adsingestp package's exact XML format.  We are testing that
@@ -129,6 +188,123 @@ class TestUtils(unittest.TestCase):
         self.assertIn("error", result["status"])
         self.assertEqual(result.get("harvest_filepath"), "/nonexistent/path/metadata.xml")
 
+    @patch("adsingestp.parsers.crossref.CrossrefParser")
+    def test_process_one_meta_xml_encoding_error(self, mock_parser_class):
+        tmpname = self._write_xml(b"<crossref>caf\xe9</crossref>")
+        result = utils.process_one_meta_xml(tmpname)
+        self.assertEqual(
+            result["status"], "encoding error: invalid utf-8 at byte 13: invalid continuation byte"
+        )
+        mock_parser_class.return_value.parse.assert_not_called()
+
+    @patch("adsingestp.parsers.crossref.CrossrefParser")
+    def test_process_one_meta_xml_passes_text(self, mock_parser_class):
+        # the parser gets the file decoded once, as declared, whether it was
+        # read here or read ahead
+        content = b'<?xml version="1.0" encoding="ISO-8859-1"?><crossref>caf\xe9</crossref>'
+        tmpname = self._write_xml(content)
+        received = []
+
+        def parse(data):
+            received.append(data)
+            return {}
+
+        mock_parser_class.return_value.parse.side_effect = parse
+        utils.process_one_meta_xml(tmpname)
+        utils.process_one_meta_xml(tmpname, data=content)
+        self.assertEqual(received, [content.decode("latin-1")] * 2)
+
+    def test_xml_encoding(self):
+        self.assertEqual(utils.xml_encoding(b"<a/>"), "utf-8")
+        self.assertEqual(
+            utils.xml_encoding(b"<?xml version='1.0' encoding='latin-1'?><a/>"), "latin-1"
+        )
+        self.assertEqual(utils.xml_encoding(codecs.BOM_UTF8 + b"<a/>"), "utf-8-sig")
+        with self.assertRaises(XmlEncodingException):
+            utils.decode_xml(b'<?xml version="1.0" encoding="bogus"?><a/>')
+        with self.assertRaises(XmlEncodingException):
+            utils.decode_xml("<a>\u00e9</a>".encode("utf-8")[0:4] + b"<")
+        self.assertEqual(utils.decode_xml("<a>\u00e9</a>".encode("utf-8")), "<a>\u00e9</a>")
+        self.assertEqual(utils.decode_xml(codecs.BOM_UTF8 + b"<a/>"), "<a/>")
+
+    # ------------------------------------------------------------------
+    # extract_matching_fields / process_one_meta_xml_fast
+    # ------------------------------------------------------------------
+
+    def _write_xml(self, content):
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with tempfile.NamedTemporaryFile(mode=mode, suffix=".xml", delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.unlink, f.name)
+        return f.name
+
+    def test_process_one_meta_xml_fast(self):
+        # the fast path gives the same matching fields as the full parser
+        infile = os.path.join(self.inputdir, "test_metadata.xml")
+        with open(os.path.join(self.outputdir, "test_metadata.json"), "r") as fj:
+            expected = json.load(fj)
+        with patch("adsingestp.parsers.crossref.CrossrefParser") as mock_parser_class:
+            result = utils.process_one_meta_xml_fast(infile)
+            mock_parser_class.assert_not_called()
+        for key in ["master_doi", "issns", "master_bibcode"]:
+            self.assertEqual(result[key], expected[key])
+        # compared as json, since key order matters for the content hash
+        self.assertEqual(
+            json.dumps(result["master_bibdata"]), json.dumps(expected["master_bibdata"])
+        )
+        self.assertEqual(result["record"]["pubDate"], expected["record"]["pubDate"])
+
+    def test_extract_matching_fields_stops_at_citations(self):
+        infile = self._write_xml(
+            '<crossref xmlns="http://www.crossref.org/xschema/1.1"><journal>'
+            "<journal_metadata><full_title>Icarus</full_title>"
+            '<issn media_type="print">00191035</issn></journal_metadata>'
+            '<journal_issue><publication_date media_type="print"><year>2021</year>'
+            "</publication_date><journal_volume><volume>355</volume></journal_volume>"
+            "</journal_issue><journal_article><titles><title>Rings of <i>Saturn</i></title>"
+            '</titles><contributors><person_name sequence="first" contributor_role="author">'
+            "<surname>Smith</surname></person_name></contributors>"
+            "<publisher_item><item_number>114123</item_number></publisher_item>"
+            "<doi_data><doi>10.1016/j.icarus.2020.114123</doi></doi_data>"
+            "<citation_list><citation><unclosed></citation_list>"
+        )
+        record = utils.extract_matching_fields(infile)
+        self.assertEqual(
+            record["publication"],
+            {
+                "pubName": "Icarus",
+                "volumeNum": "355",
+                "pubYear": "2021",
+                "ISSN": [{"pubtype": "print", "issnString": "00191035"}],
+            },
+        )
+        self.assertEqual(record["pagination"], {"electronicID": "114123"})
+        self.assertEqual(record["authors"], [{"name": {"surname": "Smith"}}])
+        self.assertEqual(record["title"], {"textEnglish": "Rings of Saturn"})
+        self.assertEqual(record["persistentIDs"], [{"DOI": "10.1016/j.icarus.2020.114123"}])
+        processed = utils._processed_record(infile, record)
+        self.assertEqual(processed["issns"], {"print": "0019-1035"})
+
+    def test_process_one_meta_xml_fast_falls_back(self):
+        # non-journal records and organizational first authors go to the
+        # full parser
+        infiles = [
+            os.path.join(self.inputdir, "test_null.xml"),
+            self._write_xml(
+                "<crossref><journal><journal_article><contributors>"
+                '<organization sequence="first" contributor_role="author">LIGO</organization>'
+                "</contributors><doi_data><doi>10.1/x</doi></doi_data></journal_article>"
+                "</journal></crossref>"
+            ),
+        ]
+        for infile in infiles:
+            with self.assertRaises(FastParseException):
+                utils.extract_matching_fields(infile)
+            with patch("adscompstat.utils.process_one_meta_xml") as mock_full:
+                result = utils.process_one_meta_xml_fast(infile)
+                mock_full.assert_called_once_with(infile, data=None)
+            self.assertIs(result, mock_full.return_value)
+
     # ------------------------------------------------------------------
     # load_classic_doi_bib_map
     # ------------------------------------------------------------------